@@ -0,0 +1,344 @@
+"""
+Benchmark lexic on a reproducible corpus of synthetic scanned PDFs
+
+Usage:
+    lexic bench [options] [--] [LEXIC_OPTION...]
+    lexic bench -h
+
+Arguments:
+    LEXIC_OPTION    extra options to pass on to lexic for the run, e.g. -- --stream --threads=4
+
+Options:
+    -h --help               show this message
+    --corpus=DIR            directory to generate the corpus in [default: bench_corpus]
+    --seed=SEED             random seed for generating the corpus [default: 0]
+    --save=FILE             save the results to FILE, to use as a baseline later
+    --baseline=FILE         compare the results against a baseline saved with --save
+    --tolerance=PERCENT     how much worse than the baseline a result can be before it is a regression [default: 10]
+
+"""
+import sys, os, logging, time, json, random, shutil
+from collections import namedtuple, OrderedDict
+from pathlib import Path
+
+from docopt import docopt
+import curio
+import psutil
+
+from .version import __version__
+
+logger = logging.getLogger(__name__)
+
+"""
+    Generate a synthetic corpus, run the pipeline on it and measure every stage
+"""
+
+CorpusDoc = namedtuple('CorpusDoc', ['name', 'pages', 'dpi', 'mode', 'kinds', 'rotations'])
+
+# Page kinds: scan is a page of scanned text, blank is a scan of an empty page, vector is
+# born-digital text with no image, and mixed has both vector text and a scanned block
+CORPUS = [
+    CorpusDoc('receipt',  1, 200, 'L', ['scan'], [0]),
+    CorpusDoc('letter',   3, 300, 'L', ['scan', 'scan', 'blank'], [0]),
+    CorpusDoc('fax',      5, 200, '1', ['scan'], [0]),
+    CorpusDoc('rotated',  4, 300, 'L', ['scan'], [0, 90, 180, 270]),
+    CorpusDoc('report',  12, 150, 'L', ['scan', 'vector', 'mixed', 'blank'], [0, 0, 90]),
+    CorpusDoc('hires',    2, 400, 'L', ['scan'], [0]),
+]
+
+WORDS = ('invoice account payment total amount balance date number customer order service '
+         'statement period tax due please remit the of and to for with from this our your '
+         'insurance policy claim medical office annual report summary quarter revenue').split()
+
+# Don't call a difference a regression unless it is at least this big, so stages that
+# only take a few milliseconds don't trip the tolerance on noise
+NOISE_FLOOR = {'wall': 0.1, 'cpu': 0.1, 'peak_rss': 10 * 2**20, 'disk_bytes': 2**20}
+
+
+def _sentence(rng, n_words):
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words)).capitalize()
+
+
+def _font(size):
+    from PIL import ImageFont
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        return ImageFont.load_default()   # Older Pillow only has the small bitmap font
+
+
+def make_scan(rng, width, height, dpi, blank=False):
+    """ Draw a page image that looks roughly like a scanned page of text
+    """
+    from PIL import Image, ImageDraw
+    image = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    if not blank:
+        font = _font(int(dpi * 0.15))
+        margin, line_height = dpi, int(dpi * 0.25)
+        y = margin
+        while y < height - margin:
+            if rng.random() < 0.15:
+                y += line_height   # Paragraph break
+            draw.text((margin, y), _sentence(rng, rng.randint(4, 12)), fill=rng.randint(0, 60), font=font)
+            y += line_height
+    # Scanner noise
+    for _ in range(width * height // 4000):
+        draw.point((rng.randrange(width), rng.randrange(height)), fill=rng.randint(0, 200))
+    # Pages never go through the scanner perfectly straight
+    return image.rotate(rng.uniform(-1.0, 1.0), resample=Image.BICUBIC, fillcolor=255)
+
+
+def make_pdf(doc, filename, seed):
+    """ Write doc out as a PDF, the same every time for the same seed
+    """
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import letter
+
+    rng = random.Random(f'{seed}:{doc.name}')
+    pdf = canvas.Canvas(str(filename), pagesize=letter, invariant=1)
+    for _ in range(doc.pages):
+        kind = rng.choice(doc.kinds)
+        rotation = rng.choice(doc.rotations)
+        page_width, page_height = letter
+        if rotation in (90, 270):
+            page_width, page_height = page_height, page_width
+        pdf.setPageSize((page_width, page_height))
+
+        if kind in ('scan', 'blank'):
+            width, height = int(letter[0] / 72 * doc.dpi), int(letter[1] / 72 * doc.dpi)
+            image = make_scan(rng, width, height, doc.dpi, blank=kind == 'blank')
+            image = image.rotate(rotation, expand=True).convert(doc.mode)
+            pdf.drawInlineImage(image, 0, 0, width=page_width, height=page_height)
+        else:
+            pdf.setFont('Helvetica', 11)
+            y = page_height - 72
+            bottom = page_height / 2 if kind == 'mixed' else 72
+            while y > bottom:
+                pdf.drawString(72, y, _sentence(rng, rng.randint(6, 14)))
+                y -= 14
+            if kind == 'mixed':
+                block_width, block_height = page_width - 144, page_height / 2 - 108
+                width, height = int(block_width / 72 * doc.dpi), int(block_height / 72 * doc.dpi)
+                image = make_scan(rng, width, height, doc.dpi).convert(doc.mode)
+                pdf.drawInlineImage(image, 72, 72, width=block_width, height=block_height)
+        pdf.showPage()
+    pdf.save()
+
+
+def make_corpus(corpus_dir, seed):
+    """ Generate any corpus files that aren't already there, and return their filenames
+    """
+    corpus_dir = Path(corpus_dir, f'seed_{seed}')
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    filenames = []
+    for doc in CORPUS:
+        filename = corpus_dir / f'{doc.name}.pdf'
+        if not filename.exists():
+            print(f'Generating {filename} ({doc.pages} pages at {doc.dpi}dpi)')
+            make_pdf(doc, filename.with_suffix('.tmp'), seed)
+            os.replace(filename.with_suffix('.tmp'), filename)
+        filenames.append(str(filename.resolve()))
+    return filenames
+
+
+def _cpu_time():
+    # Includes the tools run as child processes, once they've been waited on
+    t = os.times()
+    cpu = t.user + t.system + t.children_user + t.children_system
+    # and the processes still running, like the curio workers behind run_cpu_bound, which
+    # live for the whole run and so are never waited on
+    for child in psutil.Process().children(recursive=True):
+        try:
+            c = child.cpu_times()
+        except psutil.Error:
+            continue   # Already finished
+        cpu += c.user + c.system + c.children_user + c.children_system
+    return cpu
+
+
+def _tree_rss():
+    process = psutil.Process()
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            pass   # Already finished
+    return rss
+
+
+def _dir_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return size
+
+
+class StageStats:
+    """
+        Collects wall time, cpu time, peak memory (lexic plus all the tools it runs)
+        and bytes written to the work directory for each stage of the pipeline.
+
+        Hooked into the pipeline through Lexic.stats.  The numbers are only meaningful
+        when documents are processed one at a time, which is how bench runs them.
+    """
+
+    SAMPLE_INTERVAL = 0.05   # seconds between memory samples
+
+    def __init__(self):
+        self.stages = OrderedDict()   # stage => totals over all documents
+        self.peak_rss = 0
+
+    async def measure(self, label, coro, work_dir=None):
+        """ Run coro and add what it used to the totals for label
+        """
+        self.peak_rss = _tree_rss()
+        sampler = await curio.spawn(self._sample_rss, daemon=True)
+        disk_before = _dir_size(work_dir) if work_dir else 0
+        start_wall, start_cpu = time.perf_counter(), _cpu_time()
+        try:
+            result = await coro
+        finally:
+            wall, cpu = time.perf_counter() - start_wall, _cpu_time() - start_cpu
+            await sampler.cancel()
+        # The setup stage is what creates the work directory
+        work_dir = work_dir or getattr(result, 'common_dir', None)
+        disk_bytes = max(0, _dir_size(work_dir) - disk_before) if work_dir else 0
+        self._add(label, wall=wall, cpu=cpu, peak_rss=self.peak_rss, disk_bytes=disk_bytes)
+        return result
+
+    async def _sample_rss(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, _tree_rss())
+            await curio.sleep(self.SAMPLE_INTERVAL)
+
+    def _add(self, label, **values):
+        stage = self.stages.setdefault(label, {'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0, 'disk_bytes': 0})
+        stage['wall'] += values['wall']
+        stage['cpu'] += values['cpu']
+        stage['disk_bytes'] += values['disk_bytes']
+        stage['peak_rss'] = max(stage['peak_rss'], values['peak_rss'])
+
+    def total(self):
+        total = {'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0, 'disk_bytes': 0}
+        for stage in self.stages.values():
+            total['wall'] += stage['wall']
+            total['cpu'] += stage['cpu']
+            total['disk_bytes'] += stage['disk_bytes']
+            total['peak_rss'] = max(total['peak_rss'], stage['peak_rss'])
+        return total
+
+
+class Bench:
+
+    def __init__(self, argv):
+        self.args = docopt(__doc__, argv=['bench'] + argv, version=__version__)
+        self.seed = int(self.args['--seed'])
+        self.corpus_dir = Path(self.args['--corpus']).resolve()
+
+    def go(self):
+        from .lexic import Lexic
+
+        pdf_files = make_corpus(self.corpus_dir, self.seed)
+        n_pages = sum(doc.pages for doc in CORPUS)
+
+        output_dir = self.corpus_dir / 'output'
+        shutil.rmtree(output_dir, ignore_errors=True)
+        output_dir.mkdir()
+
+        lexic_options = self.args['LEXIC_OPTION']
+        if not any(option.startswith('--docs') for option in lexic_options):
+            lexic_options = lexic_options + ['--docs=1']
+
+        stats = StageStats()
+        script = Lexic()
+        script.stats = stats
+        cwd = os.getcwd()
+        os.chdir(output_dir)   # lexic writes its output files to the current dir
+        try:
+            start = time.perf_counter()
+            script.go(pdf_files + lexic_options)
+            wall = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+
+        missing = [doc.name for doc in CORPUS if not (output_dir / f'{doc.name}.ocr.pdf').exists()]
+        if missing:
+            print(f'No output for {", ".join(missing)}, not reporting a benchmark from a failed run')
+            return 2
+
+        results = {
+            'version': __version__,
+            'seed': self.seed,
+            'lexic_options': lexic_options,
+            'pages': n_pages,
+            'wall': wall,
+            'pages_per_sec': n_pages / wall,
+            'output_bytes': _dir_size(output_dir),
+            'stages': stats.stages,
+            'total': stats.total(),
+        }
+        self.report(results)
+
+        if self.args['--save']:
+            with open(self.args['--save'], 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f'Saved results to {self.args["--save"]}')
+
+        if self.args['--baseline']:
+            with open(self.args['--baseline']) as f:
+                baseline = json.load(f)
+            regressions = self.compare(results, baseline, float(self.args['--tolerance']))
+            if regressions:
+                print(f'{len(regressions)} regression(s) against {self.args["--baseline"]}:')
+                for regression in regressions:
+                    print(f'    {regression}')
+                return 1
+            print(f'No regressions against {self.args["--baseline"]}')
+        return 0
+
+    def report(self, results):
+        mb = 2**20
+        print()
+        print(f'{"stage":<40} {"wall s":>9} {"cpu s":>9} {"peak RSS MB":>12} {"disk MB":>9}')
+        rows = list(results['stages'].items()) + [('total', results['total'])]
+        for label, stage in rows:
+            print(f'{label:<40} {stage["wall"]:>9.2f} {stage["cpu"]:>9.2f} '
+                  f'{stage["peak_rss"] / mb:>12.1f} {stage["disk_bytes"] / mb:>9.1f}')
+        print()
+        print(f'{results["pages"]} pages in {results["wall"]:.2f}s: {results["pages_per_sec"]:.2f} pages/sec, '
+              f'{results["output_bytes"] / mb:.1f}MB of output')
+
+    def compare(self, results, baseline, tolerance):
+        """ Return a description of every measurement that is more than tolerance percent
+            worse than the baseline
+        """
+        regressions = []
+        if baseline.get('seed') != results['seed']:
+            logger.warning(f'Baseline was run on a different corpus (seed {baseline.get("seed")})')
+
+        def check(what, metric, new, old):
+            if old is None:
+                return
+            if new - old > old * tolerance / 100 and new - old > NOISE_FLOOR.get(metric, 0):
+                change = (new - old) / old * 100 if old else float('inf')
+                regressions.append(f'{what} {metric}: {old:.2f} -> {new:.2f} (+{change:.0f}%)')
+
+        for label, stage in list(results['stages'].items()) + [('total', results['total'])]:
+            old_stage = baseline['total'] if label == 'total' else baseline['stages'].get(label)
+            if old_stage is None:
+                continue
+            for metric in ('wall', 'cpu', 'peak_rss', 'disk_bytes'):
+                check(label, metric, stage[metric], old_stage.get(metric))
+        check('run', 'wall', results['wall'], baseline.get('wall'))
+        check('output', 'disk_bytes', results['output_bytes'], baseline.get('output_bytes'))
+        return regressions
+
+
+def main(argv):
+    sys.exit(Bench(argv).go())
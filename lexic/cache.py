@@ -0,0 +1,89 @@
+import logging, os, shutil, hashlib, tempfile
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+"""
+    Persistent cache for OCR output, shared between runs
+"""
+
+class OcrCache:
+    """
+        Content-addressed, on-disk cache of OCR results.
+
+        Entries are keyed by the hash of the page image plus everything else that
+        changes the result (tool version, language, psm and other options), so the
+        same pixels are only OCR'ed once no matter which work directory they end up in.
+
+        Each entry is stored as root/ab/abcdef....ext.  A hit touches the entry, and once
+        the cache grows past max_mb the least recently used entries are evicted.
+    """
+
+    CHUNK_SIZE = 2**20
+
+    def __init__(self, root, max_mb):
+        self.root = Path(root)
+        self.max_bytes = max_mb * 2**20
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.size = sum(f.stat().st_size for f in self._entries())
+        logger.debug(f'OCR cache {self.root} holds {self.size} bytes')
+
+    def key(self, filename, *params):
+        """ Hash the contents of filename together with params
+        """
+        h = hashlib.sha256()
+        for param in params:
+            h.update(str(param).encode('utf-8'))
+            h.update(b'\0')
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def get(self, key, ext, dest_filename):
+        """ Copy the cached entry to dest_filename, returning False if there isn't one
+        """
+        entry = self._entry_path(key, ext)
+        try:
+            shutil.copyfile(entry, dest_filename)
+        except FileNotFoundError:
+            return False
+        os.utime(entry)   # Mark as recently used
+        logger.debug(f'OCR cache hit for {dest_filename}')
+        return True
+
+    def put(self, key, ext, src_filename):
+        """ Store a copy of src_filename under key
+        """
+        entry = self._entry_path(key, ext)
+        entry.parent.mkdir(exist_ok=True)
+        # Write to a temp file first, so another process never sees a partial entry
+        fd, tmp_filename = tempfile.mkstemp(dir=entry.parent)
+        os.close(fd)
+        shutil.copyfile(src_filename, tmp_filename)
+        try:
+            self.size -= entry.stat().st_size   # Replacing an entry that's already counted
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_filename, entry)
+        self.size += entry.stat().st_size
+        if self.size > self.max_bytes:
+            self._evict()
+
+    def _entry_path(self, key, ext):
+        return self.root / key[:2] / f'{key}.{ext}'
+
+    def _entries(self):
+        return (f for f in self.root.glob('??/*') if f.is_file())
+
+    def _evict(self):
+        # Go down to 90% of the limit so we don't have to rescan on every put
+        target = self.max_bytes * 0.9
+        entries = sorted(((f.stat(), f) for f in self._entries()), key=lambda e: e[0].st_mtime)
+        self.size = sum(stat.st_size for stat, _ in entries)
+        for stat, f in entries:
+            if self.size <= target:
+                break
+            logger.debug(f'Evicting {f} from OCR cache')
+            f.unlink()
+            self.size -= stat.st_size
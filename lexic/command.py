@@ -2,17 +2,14 @@
 """
     Base class to represent all the external commands we have to invoke
 """
-import platform, logging, shutil, os, sys, io, base64
+import platform, logging, shutil, os, sys, io, base64, re, time, glob
+import subprocess as sync_subprocess
 from pathlib import Path
-from requests import Request, Session
-import requests
 from tenacity import retry, wait_random, wait_fixed, stop_after_attempt, wait_random_exponential, stop_after_delay
 from curio import subprocess, spawn, Queue
 from curio.file import aopen
-import curio, asks
-asks.init('curio')
-
-import boto3
+from curio.io import FileStream
+import curio
 
 from tqdm import tqdm
 import yaml
@@ -22,13 +19,33 @@ logger = logging.getLogger(__name__)
 
 from .exc import UnsupportedOSError, UnknownExecutableError
 from .item import ItemList
-
-
-session = Session()
-session_adapter = requests.adapters.HTTPAdapter(pool_connections=20, pool_maxsize=100)
-session.mount('https://', session_adapter)
-
-asks_session = asks.Session(connections=100)
+from .scheduler import Scheduler, AdaptiveLimit
+from .trace import current_span
+
+
+# Environment variables that cap the threads a tool starts (tesseract uses OpenMP)
+THREAD_LIMIT_VARS = ['OMP_THREAD_LIMIT', 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+# The http sessions are only needed for remote (aws) runs, so they're created on first use
+session = None
+asks_session = None
+
+def get_session():
+    global session
+    if session is None:
+        import requests
+        session = requests.Session()
+        session_adapter = requests.adapters.HTTPAdapter(pool_connections=20, pool_maxsize=100)
+        session.mount('https://', session_adapter)
+    return session
+
+def get_asks_session():
+    global asks_session
+    if asks_session is None:
+        import asks
+        asks.init('curio')
+        asks_session = asks.Session(connections=100)
+    return asks_session
 
 class Cmd:
 
@@ -37,7 +54,28 @@ class Cmd:
     pre_step = []
     post_step = []
     inputs_from = []
+    per_page = False    # Set to True by plugins that implement run_page (map stages)
+    default = True      # False for alternative plugins, only used for their stage when picked with --plugins
+    also_provides = {}  # stage => extension of the file written next to each output that stands in for that stage's output
     N_THREADS = 1
+    N_PROCESSES = 0     # Worker processes for cpu-bound Python code (0 runs it in threads instead)
+    scheduler = Scheduler()
+    remote_limit = AdaptiveLimit(32)    # Requests to the remote OCR service in flight at once
+    output_dir = None   # Where final outputs go (defaults to the current directory)
+    scratch_dir = None  # Where to make the work directories, instead of next to each PDF file
+    work_size = None    # Set by analyze to the bytes it expects the document's work directory to need
+    cache = None        # OcrCache shared by the OCR plugins, if enabled
+    tool_versions = {}  # executable => version string
+    incremental = False # Reuse the last work directory and only redo what changed
+    fingerprints = None # Fingerprints for this document's work directory, when running incrementally
+    always_run = False  # Set by steps with side effects, so they are never skipped as up to date
+    tracer = None       # Tracer recording every task and command, when --trace is given
+    max_dpi = None      # Highest resolution to render pages at
+    target_dpi = None   # Resolution to render every page at, instead of the one it was scanned at
+    page_markers = ['text', 'blank']    # Why a page can be marked as not needing ocr: it already has text, or it's blank
+    reads_markers = page_markers        # The page markers this plugin goes by (so they're part of its fingerprints)
+    page_store = None   # PageStore holding the per-page files kept in memory, with --in_memory
+    in_memory = False   # Set by plugins that read and write their per-page files through the page store
     msg_queue = Queue()
 
     def __init__(self, config, skip=False):
@@ -45,6 +83,7 @@ class Cmd:
         self._find_executable()
         self.skip = skip
         self.queue = {}
+        self.transfers = {}     # page => [bytes uploaded, bytes downloaded] in remote runs
         logging.debug(f'{self.name} skip={skip}')
 
 
@@ -75,6 +114,59 @@ class Cmd:
             #raise UnknownExecutableError(f'Could not find executable for {self.__class__.__name__}')
             raise UnknownExecutableError(f'Could not find executable for {self.__class__.name}')
 
+    @property
+    def tool(self):
+        """ Name used to look up this plugin's limit in the scheduler (the executable's name if it has one)
+        """
+        executable = getattr(self, 'executable', None)
+        if executable:
+            return os.path.basename(executable.split()[0])
+        return self.name
+
+    def tool_version(self):
+        """ Return the version string printed by the executable (looked up once per executable)
+        """
+        executable = getattr(self, 'executable', None)
+        if not executable:
+            return ''
+        if executable not in Cmd.tool_versions:
+            try:
+                out = sync_subprocess.run(f'{executable} --version', shell=True, stdout=sync_subprocess.PIPE,
+                                          stderr=sync_subprocess.STDOUT).stdout
+                Cmd.tool_versions[executable] = out.decode('utf-8', 'replace').strip()
+            except OSError:
+                Cmd.tool_versions[executable] = ''
+        return Cmd.tool_versions[executable]
+
+    async def cache_key(self, filename, *params):
+        """ Key for the OCR cache, from the contents of filename, the tool version and params
+        """
+        return await curio.run_in_thread(Cmd.cache.key, filename, self.tool_version(), *params)
+
+    async def fingerprint(self, *inputs, pages=None):
+        """ Fingerprint of running this plugin, with its current options, on inputs.  The page
+            markers it goes by count as inputs too: those of pages, or every one in the work directory.
+        """
+        inputs = [*inputs, self.marker_contents(pages)]
+        return await curio.run_in_thread(self.fingerprints.fingerprint, self.name, self.config, self.tool_version(), inputs)
+
+    def marker_contents(self, pages=None):
+        """ The contents of the markers in reads_markers for pages (or all pages), by marker file
+        """
+        work_dir = os.path.dirname(self.fingerprints.filename)
+        if pages is None:
+            filenames = sorted(f for reason in self.reads_markers for f in glob.glob(os.path.join(work_dir, f'page_*.{reason}')))
+        else:
+            filenames = [self.page_marker(work_dir, page, reason) for page in sorted(pages) for reason in self.reads_markers]
+        contents = {}
+        for filename in filenames:
+            try:
+                with open(filename) as f:
+                    contents[os.path.basename(filename)] = f.read().strip()
+            except FileNotFoundError:
+                pass
+        return contents
+
     def _get_filename_base(self, path):
         """ Return the base name without the extension
         """
@@ -110,13 +202,111 @@ class Cmd:
                 yield item
                 pbar.update(1)
 
-    async def _run_command(self, cmd):
+    async def _run_command(self, cmd, pipe=False, input=b''):
+        """ Run cmd and return its output.  With pipe, cmd is given input on stdin and just
+            its stdout is returned (stderr is only logged), for tools that read and write
+            the page itself through pipes instead of files.
+        """
         logger.debug(cmd)
-        output = await subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+        threads = Cmd.scheduler.take_threads()
+        try:
+            env = self._thread_limit_env(threads)
+            if Cmd.tracer is None:
+                output, returncode, rusage = await self._exec(cmd, env, pipe, input)
+            else:
+                output, returncode, rusage = await self._exec_traced(cmd, env, threads, pipe, input)
+        finally:
+            Cmd.scheduler.return_threads(threads)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd, output=output)
         return output
+
+    async def _exec_traced(self, cmd, env, threads, pipe=False, input=b''):
+        span = await current_span()
+        lane = span['lane'] if span else Cmd.tracer.take_lane()
+        start = Cmd.tracer.now()
+        try:
+            output, returncode, rusage = await self._exec(cmd, env, pipe, input)
+        finally:
+            if not span:
+                Cmd.tracer.free_lane(lane)
+        cpu = rusage.ru_utime + rusage.ru_stime
+        if span:
+            span['cpu'] += cpu
+        Cmd.tracer.add_span(os.path.basename(cmd.split()[0]), 'command', start, Cmd.tracer.now(), lane,
+                            plugin=self.name, stage=self.stage, page=span['page'] if span else None,
+                            cpu=cpu, max_rss_kb=rusage.ru_maxrss, exit_code=returncode, threads=threads, cmd=cmd)
+        return output, returncode, rusage
+
+    def _thread_limit_env(self, threads):
+        """ Return the environment for a command limited to this many threads, or None
+            to inherit ours unchanged
+        """
+        if not threads:
+            return None
+        env = dict(os.environ)
+        for var in THREAD_LIMIT_VARS:
+            # Never raise a limit the user has set themselves
+            if env.get(var, '').isdigit():
+                env[var] = str(min(threads, int(env[var])))
+            else:
+                env[var] = str(threads)
+        return env
+
+    async def _exec(self, cmd, env=None, pipe=False, input=b''):
+        """ Run cmd in a shell and return its output (stdout and stderr, or just stdout with
+            pipe), exit code and resource usage
+        """
+        if not pipe:
+            proc = sync_subprocess.Popen(cmd, shell=True, stdout=sync_subprocess.PIPE, stderr=sync_subprocess.STDOUT, env=env)
+        else:
+            proc = sync_subprocess.Popen(cmd, shell=True, stdin=sync_subprocess.PIPE, stdout=sync_subprocess.PIPE,
+                                         stderr=sync_subprocess.PIPE, env=env)
+        try:
+            if pipe:
+                # Feed stdin and drain stderr in threads, so a full pipe never blocks the command
+                feeder = await spawn(curio.run_in_thread, self._feed_stdin, proc.stdin, input)
+                errors = await spawn(curio.run_in_thread, proc.stderr.read)
+            async with FileStream(proc.stdout) as stdout:
+                output = await stdout.readall()
+            if pipe:
+                await feeder.join()
+                error_output = await errors.join()
+                if error_output:
+                    logger.debug(error_output.decode('utf-8', 'replace'))
+            # wait4 instead of wait, to also get the cpu time and memory the command used
+            _, status, rusage = await curio.run_in_thread(os.wait4, proc.pid, 0)
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        proc.returncode = self._exit_code(status)
+        if pipe and proc.returncode:
+            output = error_output   # The command's complaints are more use in the error than its partial output
+        return output, proc.returncode, rusage
+
+    @staticmethod
+    def _exit_code(status):
+        """ Decode a wait status like Popen does: the exit code, or minus the signal that killed it
+        """
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+    @staticmethod
+    def _feed_stdin(stdin, input):
+        try:
+            stdin.write(input)
+        except BrokenPipeError:
+            pass    # The command exited without reading it all; its exit code says why
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
     
     async def _get_aws_signed_url(self, url):
-        response = await asks_session.get(url, retries=3)
+        response = await get_asks_session().get(url, retries=3)
         response.raise_for_status()
         return response.json()
 
@@ -127,9 +317,10 @@ class Cmd:
         upload_filename = upload_data['key']
         with open(filename, 'rb') as f:
             files = {'file': (upload_filename, f)}
+            from requests import Request
             req = Request('POST', upload_url, data=upload_data, files=files)
             prepared_req = req.prepare()
-            http_response = session.send(prepared_req)
+            http_response = get_session().send(prepared_req)
             http_response.raise_for_status()
 
     async def _aws_asks_post_file(self, filename, signed_response):
@@ -139,20 +330,75 @@ class Cmd:
 
         data = upload_data
         data['file'] = Path(filename)
-        http_response = await asks_session.post(upload_url, multipart=data)
+        http_response = await get_asks_session().post(upload_url, multipart=data)
         http_response.raise_for_status()
 
+    async def _remote_request(self, coro):
+        """ Await a request to the remote service once Cmd.remote_limit lets it go, and let
+            the limit know how it went
+        """
+        await Cmd.remote_limit.acquire()
+        succeeded = False
+        try:
+            result = await coro
+            succeeded = True
+            return result
+        finally:
+            await Cmd.remote_limit.release(succeeded)
+
     @retry(sleep=curio.sleep, wait=wait_random_exponential(multiplier=1, max=60), stop=stop_after_delay(10))
     async def _aws_upload_file(self, url, filename):
         # Get signed URL for AWS S3
         # POst to signed URL
         #url_response = await curio.run_in_thread(self.get_aws_signed_url, url)
-        url_response = await self._get_aws_signed_url(url)
+        url_response = await self._remote_request(self._get_aws_signed_url(url))
 
         # Not sure why i can't use asks here to post the files
         #response = await curio.run_in_thread(self._aws_post_file, filename, url_response)
-        response = await self._aws_asks_post_file(filename, url_response)
-        return url_response
+        response = await self._remote_request(self._aws_asks_post_file(filename, url_response))
+        return url_response, self._count_transfer(filename, 0, os.path.getsize(filename))
+
+    @retry(sleep=curio.sleep, wait=wait_random_exponential(multiplier=1, max=60), stop=stop_after_delay(10))
+    async def _aws_download_file(self, url, filename):
+        """ Stream a file from url straight to disk
+        """
+        async def download():
+            response = await get_asks_session().get(url, stream=True)
+            response.raise_for_status()
+            n_bytes = 0
+            async with aopen(str(filename), 'wb') as f:
+                async with response.body:
+                    async for chunk in response.body:
+                        await f.write(chunk)
+                        n_bytes += len(chunk)
+            return n_bytes
+        n_bytes = self._count_transfer(filename, 1, await self._remote_request(download()))
+        await self._release_download(url)
+        return n_bytes
+
+    async def _release_download(self, url):
+        """ Let a lexic worker know it can remove a file we've downloaded (it would remove it
+            after a while anyway, and other services may not take a DELETE at all)
+        """
+        try:
+            await get_asks_session().delete(url)
+        except Exception as e:
+            logger.debug(f'Could not release {url}: {e}')
+
+    def _count_transfer(self, filename, direction, n_bytes):
+        page = self._page_of(filename)
+        self.transfers.setdefault(page, [0, 0])[direction] += n_bytes
+        logger.debug(f'{"Downloaded" if direction else "Uploaded"} {n_bytes} bytes for {os.path.basename(filename)}')
+        return n_bytes
+
+    def transfer_summary(self):
+        """ Describe how much was sent to and fetched from the remote service, in total and per page
+        """
+        up = sum(up for up, down in self.transfers.values())
+        down = sum(down for up, down in self.transfers.values())
+        n = max(1, len(self.transfers))
+        return (f'transferred {up/2**20:.2f}MB up and {down/2**20:.2f}MB down for {len(self.transfers)} pages '
+                f'({up/n/2**10:.0f}KB up and {down/n/2**10:.0f}KB down per page)')
 
     @retry(sleep=curio.sleep, wait=wait_random_exponential(multiplier=1, max=60), stop=stop_after_delay(10))
     async def _aws_run_command(self, url, input_files, cmd, output_filenames):
@@ -163,21 +409,33 @@ class Cmd:
             'input_files': input_files,
             'cmd': cmd,
             'output_files': [os.path.basename(fn) for fn in output_filenames],
+            'stream_outputs': True,     # Services that can't stream them send them in the response instead
         }
-        response = await asks_session.post(url, json=json)
-        response.raise_for_status()
-        return response.json()
+        async def post():
+            response = await get_asks_session().post(url, json=json)
+            response.raise_for_status()
+            return response.json()
+        return await self._remote_request(post())
 
     async def run_command_aws(self, cmd, input_filenames, output_filenames, url):
+        """ Run cmd remotely (on aws, or a lexic worker) on the input files, and download the
+            output files.  cmd can also be a list of commands, e.g. one per page, to run in
+            the same request.
+        """
         logger.debug(f'Running in aws: {cmd}')
         endpoint_run_ocr = f'{url}/ocr'
         endpoint_get_signed_url = f'{url}/geturl'
 
-        # First, upload the input_files
-        input_files = []
+        # First, upload the input_files, all at once (as far as Cmd.remote_limit allows)
+        upload_tasks = []
         for input_filename in input_filenames:
             logger.debug(f'Uploading file {input_filename} to S3')
-            url_response = await self._aws_upload_file(endpoint_get_signed_url, input_filename)
+            upload_tasks.append(await spawn(self._aws_upload_file, endpoint_get_signed_url, input_filename))
+        input_files = []
+        bytes_up = bytes_down = 0
+        for input_filename, task in zip(input_filenames, upload_tasks):
+            url_response, n_bytes = await task.join()
+            bytes_up += n_bytes
             input_files.append((url_response['fields']['key'], os.path.basename(input_filename)))
 
         logging.info(f'Posting to aws {cmd}')
@@ -185,13 +443,52 @@ class Cmd:
         logging.debug (response_dict['message'])
 
         #print (list(response_dict['output_files'].keys()))
-        for output_filename in output_filenames:
-            contents = response_dict['output_files'][os.path.basename(output_filename)]
-            b64 = base64.b64decode(contents)
-            async with aopen(str(output_filename), 'wb') as f:
-                await f.write(b64)
+        if 'output_urls' in response_dict:
+            download_tasks = [await spawn(self._aws_download_file, response_dict['output_urls'][os.path.basename(output_filename)], output_filename)
+                              for output_filename in output_filenames]
+            for task in download_tasks:
+                bytes_down += await task.join()
+        else:
+            for output_filename in output_filenames:
+                contents = response_dict['output_files'][os.path.basename(output_filename)]
+                b64 = base64.b64decode(contents)
+                bytes_down += self._count_transfer(output_filename, 1, len(contents))
+                async with aopen(str(output_filename), 'wb') as f:
+                    await f.write(b64)
+
+        span = await current_span()
+        if span is not None:
+            span['bytes_up'] = span.get('bytes_up', 0) + bytes_up
+            span['bytes_down'] = span.get('bytes_down', 0) + bytes_down
 
             
+    async def get_pages(self, *inputs):
+        """ Return the page numbers to stream through a group of per-page stages.
+
+            Only called on the first per-page stage of a group.  By default, assume
+            the first input is an ItemList with one file per page.
+        """
+        return list(range(1, len(inputs[0])+1))
+
+    async def run_page(self, page, *inputs):
+        """ Process a single page and return the output filename for that page.
+
+            Each input is either this page's output from a preceding per-page stage,
+            or the full ItemList from a document-level stage.
+        """
+        raise NotImplementedError(f'{self.name} cannot be run one page at a time')
+
+    async def run_cpu_bound(self, func, *args):
+        """ Run a cpu-heavy, pure-Python function in a worker process, where it isn't held up
+            by the GIL (or in a thread, if worker processes are turned off).
+
+            func must be a module-level function, and its arguments and result are pickled to
+            and from the worker, so pass filenames and small values rather than big objects.
+        """
+        if Cmd.N_PROCESSES > 0:
+            return await curio.run_in_process(func, *args)
+        return await curio.run_in_thread(func, *args)
+
     async def add_to_queue(self, output_filename, task_func, *task_args):
         self.queue[output_filename] = (task_func, *task_args)
 
@@ -208,12 +505,151 @@ class Cmd:
             await Cmd.msg_queue.task_done()
         return msgs
 
-    async def spawn_with_update(self, pbar, task):
-        await task[0](*task[1:]) 
+    async def run_in_slot(self, task_func, *task_args, page=None):
+        """ Wait for the scheduler to allow another task of this tool, then run it
+        """
+        queued = time.perf_counter()
+        await Cmd.scheduler.acquire(self.tool)
+        try:
+            if Cmd.tracer is None:
+                return await task_func(*task_args)
+            return await self._run_traced(time.perf_counter() - queued, page, task_func, *task_args)
+        finally:
+            await Cmd.scheduler.release(self.tool)
+
+    async def _run_traced(self, queue_wait, page, task_func, *task_args):
+        """ Run a task as a span of the trace; the commands it runs add their cpu time to it
+        """
+        tracer = Cmd.tracer
+        task = await curio.current_task()
+        span = task.trace_span = {'lane': tracer.take_lane(), 'page': page, 'cpu': 0.0}
+        start = tracer.now()
+        error = None
+        try:
+            return await task_func(*task_args)
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            del task.trace_span
+            tracer.free_lane(span['lane'])
+            name = self.name if page is None else f'{self.name} p{page}'
+            tracer.add_span(name, 'task', start, tracer.now(), span['lane'], plugin=self.name, stage=self.stage,
+                            page=page, cpu=span['cpu'], queue_wait=queue_wait, error=error,
+                            bytes_up=span.get('bytes_up'), bytes_down=span.get('bytes_down'))
+
+    def task_outputs(self, output_filename):
+        """ The files the task queued under output_filename leaves behind, for the fingerprints
+            to check the next time (overridden when a task is queued under a file it removes)
+        """
+        return [output_filename, *self.provided_outputs(output_filename).values()]
+
+    def provided_outputs(self, filename):
+        """ Return the files written alongside filename for the stages in also_provides, by stage
+        """
+        return {stage: self._change_ext(filename, ext) for stage, ext in self.also_provides.items()}
+
+    def render_dpi(self, xdpi, ydpi):
+        """ Return the resolution to render a page scanned at xdpi x ydpi at, after applying
+            --target_dpi and --max_dpi.  Both directions are scaled by the same factor.
+        """
+        scale = 1.0
+        if Cmd.target_dpi:
+            scale = Cmd.target_dpi / max(xdpi, ydpi)
+        elif Cmd.max_dpi and max(xdpi, ydpi) > Cmd.max_dpi:
+            scale = Cmd.max_dpi / max(xdpi, ydpi)
+        return max(1, round(xdpi * scale)), max(1, round(ydpi * scale))
+
+    def keep_in_memory(self):
+        """ Whether this plugin's per-page outputs go into the page store instead of the work directory
+        """
+        return Cmd.page_store is not None and self.in_memory
+
+    async def read_page_file(self, filename):
+        """ Contents of a per-page file, whether it's only in memory or on disk
+        """
+        if Cmd.page_store is not None and filename in Cmd.page_store:
+            return Cmd.page_store.get(filename)
+        async with aopen(filename, 'rb') as f:
+            return await f.read()
+
+    async def write_page_file(self, filename, data):
+        """ Write a per-page file, into memory if this plugin keeps its outputs there
+        """
+        if self.keep_in_memory():
+            Cmd.page_store.put(filename, data)
+        else:
+            async with aopen(filename, 'wb') as f:
+                await f.write(data)
+
+    async def materialise(self, *inputs):
+        """ Write any of the inputs (filenames or ItemLists) that are only in memory out to
+            disk, for a plugin (or a mode of one) that needs real files
+        """
+        if Cmd.page_store is None:
+            return
+        for item_list in inputs:
+            for filename in ([item_list] if isinstance(item_list, str) else item_list):
+                await curio.run_in_thread(Cmd.page_store.save, filename)
+
+    def page_marker(self, work_dir, page, reason):
+        """ The file that marks a page as not needing ocr for reason (one of page_markers)
+        """
+        return os.path.join(work_dir, f'page_{page}.{reason}')
+
+    def read_page_marker(self, filename, reason):
+        work_dir = os.path.dirname(os.path.abspath(filename))
+        try:
+            with open(self.page_marker(work_dir, self._page_of(filename), reason)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def skipped_page(self, filename):
+        """ Return what to do with the page that filename belongs to if it doesn't need ocr
+            ('keep' it as it is or 'drop' it from the output), or None if it does
+        """
+        for reason in self.reads_markers:
+            action = self.read_page_marker(filename, reason)
+            if action:
+                return action
+        return None
+
+    def _page_of(self, filename):
+        """ Page number of a per-page file like doc_3.png or doc_3.pre.png, if it has one
+        """
+        match = re.search(r'_(\d+)(\.[^._]+)*$', os.path.basename(filename))
+        return int(match.group(1)) if match else None
+
+    async def spawn_with_update(self, pbar, output_filename, task):
+        page = self._page_of(output_filename)
+        if self.fingerprints:
+            # Only redo this task if its inputs or our options changed since it last ran
+            inputs = [arg for arg in task[1:] if arg != output_filename]
+            # Along with the markers of the pages it's for (a task can do a batch of them)
+            pages = {self._page_of(f) for f in [output_filename, *self._filenames(inputs)]} - {None}
+            fingerprint = await self.fingerprint(*inputs, pages=pages)
+            if not self.fingerprints.is_current(output_filename, fingerprint):
+                await self.run_in_slot(*task, page=page)
+                self.fingerprints.record(output_filename, fingerprint, self.task_outputs(output_filename))
+        else:
+            await self.run_in_slot(*task, page=page)
         pbar.update(1)
 
+    def _filenames(self, values):
+        """ The filenames among values (filenames, lists of them and anything else)
+        """
+        for value in values:
+            if isinstance(value, str):
+                yield value
+            elif isinstance(value, (list, tuple, ItemList)):
+                yield from self._filenames(value)
+
     async def run_queue(self):
-        t_list = []  # All currently executing tasks
+        """ Spawn every queued task at once; the scheduler decides when each one
+            actually starts, so a new task starts as soon as any slot frees up.
+        """
+        t_list = []  # All spawned tasks
         output_filenames = []
         n = len(self.queue)
         if self.skip:
@@ -225,16 +661,10 @@ class Cmd:
             for output_filename, task in self.queue.items():
                 output_filenames.append(output_filename)
                 if not self.skip:
-                    t = await spawn(self.spawn_with_update, pbar, task)
+                    t = await spawn(self.spawn_with_update, pbar, output_filename, task)
                     t_list.append(t)
-                    if len(t_list) == self.N_THREADS:
-                        for t in t_list:
-                            await t.join()
-                        t_list = []
-            if not self.skip:
-                # Flush out any remaining jobs in the queue (when N_THREADS is not an int factor of the task count)
-                for t in t_list:
-                    await t.join()
+            for t in t_list:
+                await t.join()
         self.queue = {}  # Empty all the jobs
         return ItemList([os.path.abspath(p) for p in output_filenames])
 
@@ -243,10 +673,15 @@ class Cmd:
         sys.exit(-1)
 
     async def write_yaml_to_file (self, filename, python_dict):
+        if self.keep_in_memory():
+            Cmd.page_store.put(filename, yaml.dump(python_dict).encode('utf-8'))
+            return
         with open(filename, 'w') as f:
             yaml.dump(python_dict,f)
     
     async def read_yaml_from_file(self, filename):
+        if Cmd.page_store is not None and filename in Cmd.page_store:
+            return yaml.load(Cmd.page_store.get(filename))
         with open(filename) as f:
             d = yaml.load(f)
         return d
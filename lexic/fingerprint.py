@@ -0,0 +1,86 @@
+import logging, os, hashlib, json
+
+from .item import ItemList
+
+logger = logging.getLogger(__name__)
+
+"""
+    Keep track of what produced each file in a work directory, so reruns only redo what changed
+"""
+
+class Fingerprints:
+    """
+        Record of each step (or page of a step) run in a work directory.
+
+        A fingerprint is a hash of everything that goes into producing an output: the
+        plugin name and options, the version of the tool it runs, and the contents of
+        every input file.  If a step's fingerprint matches the one recorded the last time
+        and its outputs are still there, it doesn't need to be run again.
+
+        Records are appended to a log file in the work directory as soon as each one
+        completes, so a crashed run can pick up from the last finished page.
+    """
+
+    FILENAME = '.lexic_fingerprints'
+    CHUNK_SIZE = 2**20
+
+    def __init__(self, work_dir):
+        self.filename = os.path.join(work_dir, self.FILENAME)
+        self.records = {}       # key => (fingerprint, outputs)
+        self.file_hashes = {}   # (path, size, mtime) => hash of contents
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue   # Partially written line from a crashed run
+                    self.records[record['key']] = (record['fingerprint'], record['outputs'])
+            logger.debug(f'Loaded {len(self.records)} fingerprints from {self.filename}')
+
+    def fingerprint(self, name, config, version, inputs):
+        """ Hash the plugin name, its options, the tool version and all the inputs
+        """
+        h = hashlib.sha256()
+        h.update(name.encode('utf-8'))
+        h.update(json.dumps(config, sort_keys=True, default=str).encode('utf-8'))
+        h.update(version.encode('utf-8'))
+        for value in inputs:
+            self._hash_input(h, value)
+        return h.hexdigest()
+
+    def is_current(self, key, fingerprint):
+        record = self.records.get(key)
+        if record is None or record[0] != fingerprint:
+            return False
+        return all(os.path.exists(output) for output in record[1])
+
+    def outputs(self, key):
+        return self.records[key][1]
+
+    def record(self, key, fingerprint, outputs):
+        outputs = [os.path.abspath(output) for output in outputs]
+        self.records[key] = (fingerprint, outputs)
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps({'key': key, 'fingerprint': fingerprint, 'outputs': outputs}) + '\n')
+
+    def _hash_input(self, h, value):
+        if isinstance(value, str) and os.path.isfile(value):
+            h.update(self._hash_file(value).encode('utf-8'))
+        elif isinstance(value, (list, tuple, ItemList)):
+            for item in value:
+                self._hash_input(h, item)
+        else:
+            h.update(repr(value).encode('utf-8'))
+        h.update(b'\0')
+
+    def _hash_file(self, filename):
+        stat = os.stat(filename)
+        signature = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+        if signature not in self.file_hashes:
+            file_hash = hashlib.sha256()
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                    file_hash.update(chunk)
+            self.file_hashes[signature] = file_hash.hexdigest()
+        return self.file_hashes[signature]
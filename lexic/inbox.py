@@ -0,0 +1,116 @@
+import logging, os, time, ctypes, ctypes.util
+from pathlib import Path
+
+import curio
+from curio.io import FileStream
+
+logger = logging.getLogger(__name__)
+
+"""
+    Watch an inbox directory for new PDF files
+"""
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+
+
+def open_inotify(path):
+    """ Return an inotify file descriptor watching path for files being written or moved in,
+        or None if inotify isn't available (e.g. not on Linux)
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class InboxWatcher:
+    """
+        Hands out each PDF file that shows up in the inbox, once (or again, if a new file
+        is put in with the same name).
+
+        A file is only handed out after its size and modification time have stayed the
+        same for SETTLE_TIME seconds, so we don't pick up a scan that is still being
+        written.  inotify is used to wake up as soon as something arrives; without it
+        we fall back to polling the directory every POLL_INTERVAL seconds.
+    """
+
+    SETTLE_TIME = 2.0
+    POLL_INTERVAL = 5.0
+
+    def __init__(self, inbox, output_dir):
+        self.inbox = Path(inbox)
+        self.output_dir = Path(output_dir)
+        self.seen = {}        # Files already handed out => their (size, mtime) at the time
+        self.pending = {}     # Files still settling => ((size, mtime), time first seen with that signature)
+        fd = open_inotify(self.inbox)
+        if fd is None:
+            logger.info(f'inotify not available, polling {self.inbox} every {self.POLL_INTERVAL}s')
+            self.events = None
+        else:
+            self.events = FileStream(open(fd, 'rb', buffering=0))
+
+    async def next_files(self):
+        """ Wait until at least one new PDF file is ready, and return all the ready ones
+        """
+        while True:
+            ready = self._scan()
+            if ready:
+                return ready
+            # Recheck soon if something is still settling, otherwise wait for the next event
+            timeout = self.SETTLE_TIME if self.pending else self.POLL_INTERVAL
+            if self.events:
+                if self.pending:
+                    await curio.ignore_after(timeout, self.events.read(4096))
+                else:
+                    await self.events.read(4096)
+            else:
+                await curio.sleep(timeout)
+
+    def _scan(self):
+        ready = []
+        paths = sorted(self.inbox.iterdir())
+        # Forget the files that are gone, so one put back under the same name is picked up
+        present = set(paths)
+        for gone in [path for path in self.seen if path not in present]:
+            del self.seen[gone]
+        for gone in [path for path in self.pending if path not in present]:
+            del self.pending[gone]
+        for path in paths:
+            if not self._is_input_pdf(path):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue   # Moved away before we got to it
+            signature = (stat.st_size, stat.st_mtime)
+            if self.seen.get(path) == signature:
+                continue
+            last_signature, since = self.pending.get(path, (None, None))
+            if last_signature != signature:
+                self.pending[path] = (signature, time.monotonic())
+            elif time.monotonic() - since >= self.SETTLE_TIME:
+                del self.pending[path]
+                self.seen[path] = signature
+                if self._already_processed(path, stat):
+                    logger.info(f'Skipping {path}, output already exists')
+                else:
+                    ready.append(str(path))
+        return ready
+
+    def _is_input_pdf(self, path):
+        name = path.name.lower()
+        return path.is_file() and name.endswith('.pdf') and not name.endswith('.ocr.pdf')
+
+    def _already_processed(self, path, stat):
+        # An output older than the file is from an earlier scan with the same name
+        output = self.output_dir / f'{path.stem}.ocr.pdf'
+        return output.exists() and output.stat().st_mtime >= stat.st_mtime
@@ -16,6 +16,9 @@ class ItemList(UserList):
 
     """
 
+    change_dir = True   # Turned off when several documents are processed at the same time
+    page_store = None   # PageStore with the files kept in memory, with --in_memory
+
     def __init__(self, *items):
         self.common_dir = None
         super().__init__(*items)
@@ -28,7 +31,8 @@ class ItemList(UserList):
         abspath = os.path.abspath(filename)
         dirname = os.path.dirname(abspath)
         # Assert that this is a file
-        assert os.path.isfile(abspath), f'Cannot find {abspath} to file list'
+        in_memory = self.page_store is not None and abspath in self.page_store
+        assert in_memory or os.path.isfile(abspath), f'Cannot find {abspath} to file list'
 
         if self.common_dir:
             assert self.common_dir == dirname, f'New item has dir {dirname} while earlier common dir is {self.common_dir}'
@@ -45,13 +49,15 @@ class ItemList(UserList):
         self.data.append(value)
 
     def __enter__(self):
-        self.cwd = os.getcwd()
         assert self.common_dir is not None, f'Common dir is not defined!'
-        os.chdir(self.common_dir)
-        logger.debug(f'Changed dir in context manager to {self.common_dir}')
+        if self.change_dir:
+            self.cwd = os.getcwd()
+            os.chdir(self.common_dir)
+            logger.debug(f'Changed dir in context manager to {self.common_dir}')
         return self.data
 
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        os.chdir(self.cwd)
+        if self.change_dir:
+            os.chdir(self.cwd)
 
@@ -11,12 +11,29 @@ from textblob import TextBlob
 
 logger = logging.getLogger(__name__)
 
+
+def extract_page_texts(pdf_filename):
+    """ Return the text of every page in the pdf (run it in a worker process with Cmd.run_cpu_bound)
+    """
+    reader = PdfFileReader(pdf_filename)
+    num_pages = reader.getNumPages()
+    logger.debug(f'Found {num_pages} pages to scan in {pdf_filename}')
+    texts = []
+    for page_num in range(num_pages):
+        text = reader.getPage(page_num).extractText()
+        text = text.encode('ascii', 'ignore')
+        text = text.decode('utf-8')
+        text = text.replace('\n', ' ')
+        texts.append(text)
+    return texts
+
+
 class KeywordFiler:
 
-    def __init__(self, config, pdf_filename):
+    def __init__(self, config, pdf_filename, page_texts=None):
         #self._load_yaml_and_validate(keyword_filename)
         self.pdf_filename = pdf_filename
-        self.reader = PdfFileReader(pdf_filename)
+        self.page_texts = page_texts   # Extracted on first use if not passed in
         self.root_path = config['root']
         self.default_path = config['default']
         self.folders_to_keywords = config['yaml']['folders']
@@ -39,14 +56,9 @@ class KeywordFiler:
         self.keywords_to_folders = self.reverse_keyword_dict(self.folders_to_keywords)
 
     def iter_page_text(self):
-        num_pages = self.reader.getNumPages()
-        logger.debug(f'Found {num_pages} pages to scan in {self.pdf_filename}')
-        for page_num in range(num_pages):
-            text = self.reader.getPage(page_num).extractText()
-            text = text.encode('ascii', 'ignore')
-            text = text.decode('utf-8')
-            text = text.replace('\n', ' ')
-            yield text
+        if self.page_texts is None:
+            self.page_texts = extract_page_texts(self.pdf_filename)
+        yield from self.page_texts
     
     def reverse_keyword_dict(self, folder_dict):
         keywords_to_folders = {}
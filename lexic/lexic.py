@@ -16,14 +16,16 @@
 Run OCR on a scanned PDF and optionally file it automatically based on content
 
 Usage:
-    lexic.py [options] PDFFILE 
     lexic.py [options] PDFFILE (%s)...
     lexic.py [options] PDFFILE filters (%s)... 
     lexic.py [options] PDFFILE filters (%s)... (%s)...
+    lexic.py [options] serve --inbox=DIR
+    lexic.py [options] PDFFILE...
     lexic.py -h
 
 Arguments:
-    PDFFILE     PDF file to OCR
+    PDFFILE     PDF file(s) to OCR; can also be a directory or a glob pattern
+    serve       Keep running, and OCR every PDF file that arrives in the inbox directory
     default     Run default steps in the flow (%s)
 
 Options:
@@ -33,6 +35,26 @@ Options:
     --graph_plugins           debug plot of plugin dependencies
     --conf=FILE               load options from file
     --threads=<THREADS>       number of parallel threads [default: max]
+    --plugins=NAMES           plugins to use instead of the default ones for their steps, e.g. ocr_libtesseract,orientation_libtesseract
+    --processes=<PROCESSES>   number of worker processes for cpu-heavy Python steps, 0 to use threads [default: max]
+    --stream                  flow each page through the per-page stages as soon as it is ready
+    --tool_threads=LIMITS     per-tool limits on parallel tasks, e.g. gs:2,tesseract:8
+    --cpu_budget=THREADS      threads to share out between the tools running at once, 0 to not limit them [default: max]
+    --max_cpu=PERCENT         only start another task while cpu usage is below this
+    --min_mem=MB              only start another task while this much memory is free
+    --docs=<DOCS>             number of PDF files to process at the same time [default: 2]
+    --scratch=DIR             make the work directories in DIR (e.g. /dev/shm or a local disk) instead of next to each PDF file
+    --scratch_spill=DIR       where to make the work directory of a PDF file that won't fit in --scratch instead (next to the file by default)
+    --max_dpi=DPI             render pages scanned at a higher resolution than this at this resolution instead
+    --target_dpi=DPI          render every page at this resolution, whatever it was scanned at
+    --inbox=DIR               directory to watch for new PDF files in serve mode
+    --remote_limit=N          most requests to have in flight to the remote OCR service at once (the limit adapts up to this) [default: 32]
+    --cache=DIR               keep OCR and orientation results in this directory to reuse across runs
+    --cache_size=MB           maximum size of the OCR cache [default: 2048]
+    --incremental             reuse the last work directory and only redo steps and pages whose inputs changed
+    --in_memory               hand the page images, tsv, text locations and overlays from step to step in memory instead of through the work directory
+    --trace=FILE              save a trace of every task and command run to FILE, for chrome://tracing or Perfetto
+    --startup_profile         show how long each module takes to import for this run, then exit
 
 """
 
@@ -46,25 +68,31 @@ from docopt import docopt
 import yaml
 from yamlinclude import YamlIncludeConstructor
 
-import sys, os, logging, shutil, smtplib, traceback
+import sys, os, logging, shutil, traceback, glob
 from collections import ChainMap
-from schema import Schema, And, Optional, Or, Use, SchemaError
 from pathlib import Path
 import warnings
 
-from curio import run, subprocess
-import networkx as nx
+from curio import run, subprocess, Queue, TaskGroup, CancelledError, Semaphore, spawn
+import curio.workers
 import psutil
-from ssl import SSLError
 import tqdm
 
 from .version import __version__
 from .utils import ordered_load, merge_args
 from .command import Cmd
+from .scheduler import Scheduler, AdaptiveLimit
 #from .imaging import ImageMagick
 #from .tesseract import Tesseract, TsvParse
 #from .pdf import PdfOverlay, PdfMerge
 from .item import ItemList
+from .plugin_manifest import LazyPlugin
+from .plugin_manifest_data import PLUGINS
+from .inbox import InboxWatcher
+from .cache import OcrCache
+from .fingerprint import Fingerprints
+from .trace import Tracer
+from .page_store import PageStore
 #from .command import Setup
 
 
@@ -98,6 +126,8 @@ class Lexic:
         self.flow_actions = ['skip']
         warnings.simplefilter('ignore')   # get rid of stupid matplotlib warnings for now
         self.status_messages = []
+        self.stats = None   # Set by bench to measure each stage
+        self.scratch_reserved = 0   # Bytes of --scratch the documents being processed expect to need
 
 
 
@@ -116,14 +146,14 @@ class Lexic:
         """
         padding = max([len(x) for x in self.flow.keys()]) # Find max length of flow step names for padding with white space
         action_specifier_list = []
-        docstring = __doc__ % ('|'.join(self.required_flow_steps),
+        docstring = self.usage % ('|'.join(self.required_flow_steps),
                                '|'.join(self.filters),
                                '|'.join(self.filters),
                                '|'.join(self.required_flow_steps),
                                '|'.join(self.required_flow_steps)) # The desc in default
                               #'\n'.join(['    '+k+' '*(padding+4-len(k))+v for k,v  in self.flow.items()]))
         
-        args = docopt(docstring, version=__version__)
+        args = docopt(docstring, argv=argv, version=__version__)
         if args['--debug']:
             logging.basicConfig(level=logging.DEBUG, format='%(message)s')
         elif args['--verbose']:
@@ -148,6 +178,41 @@ class Lexic:
         else:
             Cmd.N_THREADS = int(threads)
         logger.info(f'Using {Cmd.N_THREADS} parallel threads')
+        processes = args.get('--processes', 0)
+        if processes == 'max':
+            Cmd.N_PROCESSES = psutil.cpu_count()
+        else:
+            Cmd.N_PROCESSES = int(processes)
+        curio.workers.MAX_WORKER_PROCESSES = max(Cmd.N_PROCESSES, 1)
+        max_cpu = float(args['--max_cpu']) if args.get('--max_cpu') else None
+        min_mem = int(args['--min_mem']) if args.get('--min_mem') else None
+        cpu_budget = args.get('--cpu_budget', 0)
+        cpu_budget = psutil.cpu_count() if cpu_budget == 'max' else int(cpu_budget)
+        Cmd.scheduler = Scheduler(Cmd.N_THREADS, Scheduler.parse_tool_limits(args.get('--tool_threads')), max_cpu, min_mem, cpu_budget)
+        Cmd.remote_limit = AdaptiveLimit(int(args.get('--remote_limit') or 32))
+        Cmd.max_dpi = int(args['--max_dpi']) if args.get('--max_dpi') else None
+        Cmd.target_dpi = int(args['--target_dpi']) if args.get('--target_dpi') else None
+        Cmd.incremental = bool(args.get('--incremental'))
+        if args.get('--scratch'):
+            Cmd.scratch_dir = os.path.abspath(args['--scratch'])
+            os.makedirs(Cmd.scratch_dir, exist_ok=True)
+            logger.info(f'Making work directories in {Cmd.scratch_dir}')
+        if args.get('--in_memory'):
+            if Cmd.incremental:
+                print('ERROR: --in_memory cannot be used with --incremental, which needs every intermediate file on disk')
+                sys.exit(-1)
+            Cmd.page_store = ItemList.page_store = PageStore()
+        if args.get('--cache'):
+            Cmd.cache = OcrCache(args['--cache'], int(args['--cache_size']))
+            logger.info(f'Using OCR cache in {args["--cache"]}')
+        Cmd.tracer = Tracer() if args.get('--trace') else None
+
+        self.chosen_plugins = [name.strip() for name in (args.get('--plugins') or '').split(',') if name.strip()]
+        known_plugins = [name for stage, plugins in Cmd.plugin_list.items() if stage != 'filter' for name in plugins]
+        for name in self.chosen_plugins:
+            if name not in known_plugins:
+                print(f'ERROR: Unknown plugin {name} in --plugins (choose from {", ".join(known_plugins)})')
+                sys.exit(-1)
 
         # If no flow steps have been specified, then assume user wants to run all steps
         for f in self.required_flow_steps:
@@ -206,40 +271,123 @@ class Lexic:
         logging.info('Analyzing options...')
         self.get_options(argv)
         logging.info('Setting up run...')
-        run(self.system)
+        Cmd.output_dir = os.getcwd()
+        try:
+            if self.args['serve']:
+                run(self.serve)
+            else:
+                run(self.system)
+        finally:
+            if Cmd.tracer:
+                Cmd.tracer.save(self.args['--trace'])
 
     def load_plugins(self):
-        import importlib
-        plugin_dir = Path(__file__).parent / 'plugins'
-        logger.debug(f'Looking for plugins in {plugin_dir}')
+        """ Register every plugin listed in the plugin manifest, and add their options to the usage.
+
+            Plugin modules are not imported here; each one is only imported once its
+            step is set up in the pipeline (see LazyPlugin)
+        """
+        logger.debug(f'Registering plugins from the plugin manifest')
         self.flow = {}
         self.filters = {}
+        self.usage = __doc__
     
-        num_plugins = len(list(plugin_dir.glob('*.py')))
-        with tqdm.tqdm(desc='Loading plugins', total=num_plugins) as pbar:
-            for plugin_file in plugin_dir.iterdir():
-                if plugin_file.suffix == '.py':
-                    # Let's import this!
-                    logger.debug(f'Found plugin {plugin_file.stem}')
-                    pkg = importlib.import_module(f'.plugins.{plugin_file.stem}', 'lexic')
-                    plugin = pkg.Plugin
-                    # Gets imported as lexic.plugins.plugin_name
-                    # Now we need to insert the doc strings
-                    new_options = plugin.options
-                    global __doc__
-                    __doc__ = __doc__ + '\n'.join([f'    {opt}' for opt in new_options])
-                    if len(new_options) != 0:
-                        __doc__ += '\n'
-                    Cmd.register_plugin(plugin)
-                    
-                    if plugin.stage != 'filter': 
-                        self.flow[plugin.stage] = plugin.desc
-                    else:
-                        self.filters[plugin.name] = plugin.desc
-                    pbar.update(1)
+        for entry in PLUGINS:
+            plugin = LazyPlugin(entry)
+            logger.debug(f'Found plugin {plugin.module}')
+            # Now we need to insert the doc strings
+            new_options = plugin.options
+            self.usage = self.usage + '\n'.join([f'    {opt}' for opt in new_options])
+            if len(new_options) != 0:
+                self.usage += '\n'
+            Cmd.register_plugin(plugin)
+            
+            if plugin.stage != 'filter': 
+                self.flow[plugin.stage] = plugin.desc
+            else:
+                self.filters[plugin.name] = plugin.desc
 
 
     async def system(self):
+        """ Run the pipeline on every PDF file given on the command line.
+
+            With more than one file, up to --docs files are processed at the same time
+            in this kernel.  All their tasks share the same scheduler, so pages from the
+            next document can start as soon as the current one stops using every slot.
+        """
+        pdf_filenames = self.find_pdf_files(self.args['PDFFILE'])
+        if len(pdf_filenames) == 0:
+            print('ERROR: no PDF files found')
+            sys.exit(-1)
+        elif len(pdf_filenames) == 1:
+            await self.process_pdf(pdf_filenames[0])
+        else:
+            # Documents run concurrently, so don't let them chdir under each other
+            ItemList.change_dir = False
+            logger.info(f'Processing {len(pdf_filenames)} PDF files')
+            doc_slots = Semaphore(int(self.args['--docs']))
+            async with TaskGroup() as g:
+                for pdf_filename in pdf_filenames:
+                    await g.spawn(self._process_pdf_in_slot, doc_slots, pdf_filename)
+            failed = [pdf_filename for pdf_filename, ok in zip(pdf_filenames, g.results) if not ok]
+            print(f'Processed {len(pdf_filenames)-len(failed)} of {len(pdf_filenames)} PDF files')
+            for pdf_filename in failed:
+                print(f'  failed: {pdf_filename}')
+
+    async def serve(self):
+        """ Keep running and process every PDF file that arrives in the inbox.
+
+            The plugins, options and scheduler are only set up once, so each new
+            scan only pays for its own pipeline run.
+        """
+        inbox = InboxWatcher(self.args['--inbox'], Cmd.output_dir)
+        ItemList.change_dir = False
+        doc_slots = Semaphore(int(self.args['--docs']))
+        print(f'Watching {self.args["--inbox"]} for new PDF files')
+        while True:
+            for pdf_filename in await inbox.next_files():
+                logger.info(f'Found new file {pdf_filename}')
+                await spawn(self._process_pdf_in_slot, doc_slots, pdf_filename, daemon=True)
+
+    async def _process_pdf_in_slot(self, doc_slots, pdf_filename):
+        async with doc_slots:
+            try:
+                await self.process_pdf(pdf_filename)
+                return True
+            except Exception as e:
+                print(f'ERROR processing {pdf_filename}: {e}')
+                print(traceback.format_exc())
+                return False
+
+    def find_pdf_files(self, paths):
+        """ Expand the PDFFILE arguments into a list of PDF files.
+
+            Each argument can be a file, a directory (all the PDFs directly inside it)
+            or a glob pattern.  Our own .ocr.pdf outputs are left out of directories and globs.
+        """
+        pdf_filenames = []
+        for path in paths:
+            if os.path.isdir(path):
+                candidates = sorted(str(p) for p in Path(path).iterdir() if p.suffix.lower() == '.pdf')
+            elif glob.has_magic(path):
+                candidates = sorted(glob.glob(path))
+            else:
+                pdf_filenames.append(path)
+                continue
+            pdf_filenames.extend(c for c in candidates if not c.lower().endswith('.ocr.pdf'))
+        return pdf_filenames
+
+    def _choose_plugin(self, stage):
+        """ Use the plugin picked with --plugins for this stage, otherwise the stage's default one
+        """
+        candidates = Cmd.plugin_list[stage]
+        for name in self.chosen_plugins:
+            if name in candidates:
+                return candidates[name]
+        defaults = [plugin for plugin in candidates.values() if plugin.default]
+        return (defaults or list(candidates.values()))[0]
+
+    def build_pipeline(self, pdf_filename):
 
         """ First, construct the graph of all the required steps
 
@@ -259,7 +407,7 @@ class Lexic:
             2. filter before a stage
             3. filter after a stage
 
-            Build up a graph from networkx and then traverse it
+            Build up the chain of steps in order, and then run through it
 
             Each stage and filter must be skippable
                 - In order to be skippable, that means it must be able to return the
@@ -272,107 +420,348 @@ class Lexic:
         #   error out if more than one choice at each step
         logger.debug(f'flow steps available from plugiins')
         logger.debug(Cmd.plugin_list)
-        G = nx.DiGraph()
-        prev_step = None
-        with tqdm.tqdm(desc='Setting up OCR pipeline', total=len(required_flow_steps)) as pbar:
-            for step in required_flow_steps:
-                logger.debug(f'Setting up flow step {step}')
-                if step not in Cmd.plugin_list:
-                    logger.debug(f'  error: There is no plugin for {step} step!')
-                    sys.exit(-1)
-                plugin_class = list(Cmd.plugin_list[step].values())[0]  #TODO: needs to be fixed for cases of multiiple classes of stages
-                skip = (self.args[plugin_class.stage]==0)
-                plugin = plugin_class(self.args.get(plugin_class.name, {}), skip=skip)
-                G.add_node(plugin)
-                if prev_step: 
-                    G.add_edge(prev_step, plugin)
-                prev_step = plugin
-                logger.debug(f'  done')
-                pbar.update(1)
+        pipeline = []
+        for step in required_flow_steps:
+            logger.debug(f'Setting up flow step {step}')
+            if step not in Cmd.plugin_list:
+                logger.debug(f'  error: There is no plugin for {step} step!')
+                sys.exit(-1)
+            plugin_class = self._choose_plugin(step)
+            skip = (self.args[plugin_class.stage]==0)
+            # Only now does the plugin module get imported
+            plugin = plugin_class(self.args.get(plugin_class.name, {}), skip=skip)
+            pipeline.append(plugin)
+            logger.debug(f'  done')
+
+        # Drop the steps whose outputs another step writes as well (e.g. orient, with ocr_orient_tesseract)
+        provided = [stage for plugin in pipeline for stage in plugin.also_provides]
+        pipeline = [plugin for plugin in pipeline if plugin.stage not in provided]
                 
-        # Now, add filters that are specified into the graph
-        with tqdm.tqdm(desc='Setting up OCR filters', total=len(filters.keys())) as pbar:
-            for i, step in enumerate(reversed(list(filters.keys()))):
-                logger.debug(f'Adding {step} to flow')
-                plugin_class = Cmd.plugin_list["filter"][step]
-                logger.debug(f'PLUGIN CLASS {plugin}')
-                plugin = plugin_class(self.args.get(plugin_class.name, {}))
-                G.add_node(plugin)
-                # Set the original pdf file pointer (really only needed in the filing step)
-                plugin.original_pdf_filename = self.args['PDFFILE']
-                if len(plugin.filter_on_output) > 0:
-                    logger.debug(f'Going to add {step} after a stage')
-                    for stage in plugin.filter_on_output:
-                        logger.debug(f'Checking stage {stage}')
-                        node = self._find_stage(G, stage)
-                        if node:
-                            # Add new plugin node after this node
-                            logger.debug(f'Adding {step} after {stage}')
-                            self.insert_node_after(G, node, plugin, i)
-                            break   # not sure how to handle more than one possible place for this filter
-                    else:
-                        print("Could not find a step to insert into")
-                        sys.exit(-1)
-
+        # Now, add filters that are specified into the pipeline
+        for i, step in enumerate(reversed(list(filters.keys()))):
+            logger.debug(f'Adding {step} to flow')
+            plugin_class = Cmd.plugin_list["filter"][step]
+            logger.debug(f'PLUGIN CLASS {plugin_class}')
+            plugin = plugin_class(self.args.get(plugin_class.name, {}))
+            # Set the original pdf file pointer (really only needed in the filing step)
+            plugin.original_pdf_filename = pdf_filename
+            if len(plugin.filter_on_output) > 0:
+                logger.debug(f'Going to add {step} after a stage')
+                for stage in plugin.filter_on_output:
+                    logger.debug(f'Checking stage {stage}')
+                    node = self._find_stage(pipeline, stage)
+                    if node:
+                        # Add new plugin node after this node
+                        logger.debug(f'Adding {step} after {stage}')
+                        self.insert_node_after(pipeline, node, plugin, i)
+                        break   # not sure how to handle more than one possible place for this filter
                 else:
-                    print("ERROR: could not find a place for the filter")
+                    print("Could not find a step to insert into")
                     sys.exit(-1)
-                pbar.update(1)
+
+            else:
+                print("ERROR: could not find a place for the filter")
+                sys.exit(-1)
 
         if self.args['--graph_plugins']:
-            nx.draw(G, with_labels=True, labels={ n: f'{n.name}[{n.stage}]' for n in G.nodes()})
+            import networkx as nx
             import matplotlib.pyplot as plt
+            G = nx.DiGraph()
+            nx.add_path(G, pipeline)
+            nx.draw(G, with_labels=True, labels={ n: f'{n.name}[{n.stage}]' for n in G.nodes()})
             plt.show()
+        return pipeline
+
+    async def process_pdf(self, pdf_filename):
+        """ Build the pipeline for one PDF file and run every step on it
+        """
+        pipeline = self.build_pipeline(pdf_filename)
+        analyze_node = self._find_stage(pipeline, 'analyze')
+        reserved = 0
 
         results = {}
         # Find starting setup step
-        node = self._find_stage(G, 'setup')
+        node = self._find_stage(pipeline, 'setup')
         logger.info(f'Processing setup step')
-        results[node.stage] = await node.run(self.args['PDFFILE'])
-
-        for next_nodes in nx.dfs_successors(G, node).values():
-            try:
-                for next_node in next_nodes:
-                    logger.info(f'Processing step {next_node.name}[{next_node.stage}], with inputs from {next_node.inputs_from}')
-                    results[next_node.stage] = await next_node.run(*[results[r] for r in next_node.inputs_from])
-            except Exception as e:
-                print(str(e))
-                print(traceback.format_exc())
-                next_node.add_message(str(e))
+        results[node.stage] = await self._measured(node.stage, node.run(pdf_filename))
+        work_dir = results[node.stage].common_dir
+        if Cmd.incremental:
+            fingerprints = Fingerprints(work_dir)
+            for n in pipeline:
+                n.fingerprints = fingerprints
+
+        try:
+            for next_nodes in self._group_stages(pipeline[pipeline.index(node)+1:]):
+                try:
+                    if next_nodes[0].per_page and self.args['--stream']:
+                        next_node = next_nodes[-1]
+                        logger.info(f'Streaming pages through steps {", ".join(n.name for n in next_nodes)}')
+                        label = '+'.join(n.stage for n in next_nodes)
+                        await self._measured(label, self.stream_pages(next_nodes, results), work_dir)
+                    else:
+                        for next_node in next_nodes:
+                            logger.info(f'Processing step {next_node.name}[{next_node.stage}], with inputs from {next_node.inputs_from}')
+                            inputs = [results[r] for r in next_node.inputs_from]
+                            results[next_node.stage] = await self._measured(next_node.stage, self.run_step(next_node, inputs), work_dir)
+                            for stage in next_node.also_provides:
+                                results[stage] = ItemList([next_node.provided_outputs(f)[stage] for f in results[next_node.stage]])
+                    if analyze_node in next_nodes:
+                        work_dir, reserved = await self._fit_in_scratch(pdf_filename, work_dir, analyze_node.work_size, results)
+                except Exception as e:
+                    print(str(e))
+                    print(traceback.format_exc())
+                    next_node.add_message(str(e))
+        finally:
+            # Give the scratch space back even if the document is cancelled
+            self.scratch_reserved -= reserved
         #self.send_status_to_email()
         print(f'Successfully generated OCR file: {results[next_node.stage]}')
         return
 
-    def _find_stage(self, G, stage):
-        for  n in G.nodes():
+    async def _fit_in_scratch(self, pdf_filename, work_dir, work_size, results):
+        """ Check that the work directory has room in --scratch for all the files analyze expects
+            (on top of what the other documents in there expect), and if not, move it out to
+            --scratch_spill, or next to the PDF file.  Returns the work directory and the bytes
+            of scratch reserved for it.
+        """
+        if not Cmd.scratch_dir or work_size is None or os.path.dirname(work_dir) != Cmd.scratch_dir:
+            return work_dir, 0
+        free = shutil.disk_usage(Cmd.scratch_dir).free - self.scratch_reserved
+        if work_size <= free:
+            self.scratch_reserved += work_size
+            return work_dir, work_size
+        if Cmd.incremental:
+            # The fingerprints of the last run are for files in this directory
+            logger.warning(f'{pdf_filename} may not fit in {Cmd.scratch_dir}, but is reusing its work directory there')
+            return work_dir, 0
+
+        spill_dir = self.args['--scratch_spill'] or os.path.dirname(os.path.abspath(pdf_filename))
+        new_work_dir = os.path.join(spill_dir, os.path.basename(work_dir))
+        inc = 0
+        while os.path.exists(new_work_dir):
+            new_work_dir = os.path.join(spill_dir, f'{os.path.basename(work_dir)}_{inc}')
+            inc += 1
+        logger.info(f'{pdf_filename} needs about {work_size/2**20:.0f}MB but only {free/2**20:.0f}MB is free in '
+                    f'{Cmd.scratch_dir}, so moving its work directory to {new_work_dir}')
+        await curio.run_in_thread(shutil.move, work_dir, new_work_dir)
+        for stage, item_list in results.items():
+            results[stage] = ItemList([os.path.join(new_work_dir, os.path.relpath(f, work_dir)) for f in item_list])
+        return new_work_dir, 0
+
+    async def _measured(self, label, coro, work_dir=None):
+        """ Run coro, recording what it used under label when benchmarking or tracing
+        """
+        if Cmd.tracer:
+            coro = self._traced_step(label, coro)
+        if self.stats is None:
+            return await coro
+        return await self.stats.measure(label, coro, work_dir)
+
+    async def _traced_step(self, label, coro):
+        tracer = Cmd.tracer
+        lane = tracer.take_lane()
+        start = tracer.now()
+        try:
+            return await coro
+        finally:
+            tracer.free_lane(lane)
+            tracer.add_span(label, 'step', start, tracer.now(), lane, stage=label)
+
+    async def run_step(self, node, inputs):
+        """ Run a step over the whole document.
+
+            When running incrementally, a step whose inputs, options and tool version
+            all match the last run is switched to skip mode, so it just returns its
+            existing outputs.
+        """
+        if not node.in_memory:
+            await node.materialise(*inputs)
+        if not node.fingerprints or node.always_run or node.skip:
+            return await node.run(*inputs)
+
+        key = f'step:{node.name}'
+        fingerprint = await node.fingerprint(*inputs)
+        if node.fingerprints.is_current(key, fingerprint):
+            logger.info(f'{node.name} is up to date')
+            node.skip = True
+            return await node.run(*inputs)
+        outputs = await node.run(*inputs)
+        node.fingerprints.record(key, fingerprint, self._with_provided_outputs(node, outputs))
+        return outputs
+
+    async def run_page(self, node, page, inputs):
+        """ Run a step on one page, skipping it when running incrementally and the page is up to date
+        """
+        if not node.in_memory:
+            await node.materialise(*inputs)
+        if not node.fingerprints or node.always_run or node.skip:
+            return await node.run_in_slot(node.run_page, page, *inputs, page=page)
+
+        key = f'page:{node.name}:{page}'
+        fingerprint = await node.fingerprint(page, *inputs, pages=[page])
+        if node.fingerprints.is_current(key, fingerprint):
+            return node.fingerprints.outputs(key)[0]
+        output = await node.run_in_slot(node.run_page, page, *inputs, page=page)
+        node.fingerprints.record(key, fingerprint, self._with_provided_outputs(node, [output]))
+        return output
+
+    def _with_provided_outputs(self, node, outputs):
+        return list(outputs) + [f for output in outputs for f in node.provided_outputs(output).values()]
+
+    def _group_stages(self, nodes):
+        """ Split the steps into groups to run together.
+
+            When streaming, each run of consecutive per-page steps becomes a single group;
+            every other step is a group of its own.
+        """
+        groups = []
+        for next_node in nodes:
+            if groups and next_node.per_page and groups[-1][-1].per_page and self.args['--stream']:
+                groups[-1].append(next_node)
+            else:
+                groups.append([next_node])
+        return groups
+
+    async def stream_pages(self, nodes, results):
+        """ Run a group of per-page steps as a pipeline over pages.
+
+            Each step gets its own workers, connected to the next step by a bounded
+            queue, so a page moves on to the next step as soon as it is done instead
+            of waiting for the rest of the document.  Once every page has drained
+            through, each step's outputs are collected into an ItemList (in page order)
+            for the document-level steps that follow (e.g. merge_overlay and clean).
+        """
+        first = nodes[0]
+        pages = await first.get_pages(*[results[r] for r in first.inputs_from])
+        page_results = {page: {} for page in pages}
+        queues = [Queue(maxsize=2*Cmd.N_THREADS) for _ in range(len(nodes)+1)]
+
+        async def feed_pages():
+            for page in pages:
+                await queues[0].put(page)
+            await queues[0].put(None)
+
+        async def drain_pages():
+            while await queues[-1].get() is not None:
+                pass
+
+        async with TaskGroup() as g:
+            await g.spawn(feed_pages)
+            for i, node in enumerate(nodes):
+                await g.spawn(self._stream_step, node, queues[i], queues[i+1], pages, page_results, results, i)
+            await g.spawn(drain_pages)
+        self._raise_task_errors(g)
+
+        for node in nodes:
+            for stage in [node.stage, *node.also_provides]:
+                results[stage] = ItemList([os.path.abspath(page_results[page][stage]) for page in pages])
+
+    async def _stream_step(self, node, in_queue, out_queue, pages, page_results, results, position):
+        """ Run a per-page step with N_THREADS workers, pulling pages from in_queue and
+            passing them on to out_queue.  A None in the queue marks the end of the pages.
+        """
+        desc = f'{node.name} [skipped]' if node.skip else node.name
+
+        def get_input(page, stage):
+            # Take this page's output if the stage is per-page, otherwise the whole ItemList
+            if stage in page_results[page]:
+                return page_results[page][stage]
+            return results[stage]
+
+        async def worker(pbar):
+            while True:
+                page = await in_queue.get()
+                if page is None:
+                    await in_queue.put(None)  # Let the other workers see it too
+                    break
+                inputs = [get_input(page, r) for r in node.inputs_from]
+                output = await self.run_page(node, page, inputs)
+                page_results[page][node.stage] = output
+                page_results[page].update(node.provided_outputs(output))
+                pbar.update(1)
+                await out_queue.put(page)
+
+        with tqdm.tqdm(total=len(pages), desc=desc, position=position) as pbar:
+            async with TaskGroup() as g:
+                for _ in range(Cmd.N_THREADS):
+                    await g.spawn(worker, pbar)
+        self._raise_task_errors(g)
+        await out_queue.put(None)
+
+    def _raise_task_errors(self, task_group):
+        # A failed task cancels the rest of the group, so re-raise the original error
+        for task in task_group.tasks:
+            if task.exception and not isinstance(task.exception, CancelledError):
+                raise task.exception
+
+    def _find_stage(self, pipeline, stage):
+        for  n in pipeline:
             if n.stage == stage:
                 return n
         return None
 
-    def insert_node_after(self, G, node, new_node, rename_index):
-        G.add_node(new_node)
-        # For every successor of stage, make the new_stage point to it
-        next_nodes = list(G.successors(node))
-        for next_node in next_nodes:
-            logger.debug(f'Removing edge from {node.name} to {next_node.name}')
-            G.remove_edge(node, next_node)
-            logger.debug(f'Adding edge from {new_node.name} to {next_node.name}')
-            G.add_edge(new_node, next_node)
-        logger.debug(f'Adding edge from {node.name} to {new_node.name}')
-        G.add_edge(node, new_node)
+    def insert_node_after(self, pipeline, node, new_node, rename_index):
+        logger.debug(f'Inserting {new_node.name} after {node.name}')
+        pipeline.insert(pipeline.index(node)+1, new_node)
 
         # Now, rename the .stage to be the original node's stage
         new_node.stage = node.stage
         node.stage = f'_{node.stage}_{rename_index}'
 
         # Now, update where new_node gets its inputs from to the renamed previous node
+        # (on a copy, since inputs_from is shared by every instance of the plugin class)
+        new_node.inputs_from = list(new_node.inputs_from)
         for i, input_from in enumerate(new_node.inputs_from):
             if input_from == new_node.stage:
                 new_node.inputs_from[i] = node.stage
 
 
 
+STARTUP_PROFILE_SCRIPT = """
+import sys
+from lexic.lexic import Lexic
+from lexic.command import Cmd
+script = Lexic()
+script.load_plugins()
+for stage in script.required_flow_steps:
+    [plugin for plugin in Cmd.plugin_list[stage].values() if plugin.default][0].load()
+for name in sys.argv[1:]:
+    if name in Cmd.plugin_list['filter']:
+        Cmd.plugin_list['filter'][name].load()
+"""
+
+def print_startup_profile(argv, top=30):
+    """ Import lexic and the plugins this command line would use in a fresh interpreter
+        with -X importtime, and print the slowest imports
+    """
+    import subprocess as sync_subprocess
+    cmd = [sys.executable, '-X', 'importtime', '-c', STARTUP_PROFILE_SCRIPT] + argv
+    output = sync_subprocess.run(cmd, stderr=sync_subprocess.PIPE).stderr.decode('utf-8')
+    times = []
+    for line in output.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        times.append((int(cumulative_us), int(self_us), module.strip()))
+    total = sum(self_us for _, self_us, _ in times)
+    print(f'Imported {len(times)} modules in {total/1e6:.3f}s')
+    print(f'{"cumulative":>12} {"self":>10}  module')
+    for cumulative_us, self_us, module in sorted(times, reverse=True)[:top]:
+        print(f'{cumulative_us/1e3:10.1f}ms {self_us/1e3:8.1f}ms  {module}')
+
 def main():
+    if sys.argv[1:2] == ['bench']:
+        from .bench import main as bench_main
+        bench_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['worker']:
+        from .worker import main as worker_main
+        worker_main(sys.argv[2:])
+        return
+    if '--startup_profile' in sys.argv[1:]:
+        print_startup_profile(sys.argv[1:])
+        return
     script = Lexic()
     script.go(sys.argv[1:])
 
@@ -0,0 +1,219 @@
+import logging, ctypes, ctypes.util, queue, threading
+from ctypes import c_int, c_float, c_char_p, c_void_p, c_bool, POINTER, byref
+
+logger = logging.getLogger(__name__)
+
+"""
+    Run tesseract in-process through the libtesseract C API, keeping the engines loaded between pages
+"""
+
+# From tesseract/publictypes.h
+PSM_OSD_ONLY = 0
+PSM_AUTO_OSD = 1
+RIL_BLOCK, RIL_PARA, RIL_TEXTLINE, RIL_WORD = 0, 1, 2, 3
+
+DEFAULT_DPI = 300
+
+_lib = None
+_lib_lock = threading.Lock()
+
+
+def load_library(path=None):
+    """ Load libtesseract (found on the library path unless path is given) and declare the
+        functions we use
+    """
+    global _lib
+    with _lib_lock:
+        if _lib is not None:
+            return _lib
+        path = path or ctypes.util.find_library('tesseract')
+        if not path:
+            raise OSError('Could not find libtesseract; install it or give its path')
+        lib = ctypes.CDLL(path)
+        signatures = {
+            'TessVersion': ([], c_char_p),
+            'TessBaseAPICreate': ([], c_void_p),
+            'TessBaseAPIDelete': ([c_void_p], None),
+            'TessBaseAPIEnd': ([c_void_p], None),
+            'TessBaseAPIInit3': ([c_void_p, c_char_p, c_char_p], c_int),
+            'TessBaseAPISetPageSegMode': ([c_void_p, c_int], None),
+            'TessBaseAPISetImage': ([c_void_p, c_void_p, c_int, c_int, c_int, c_int], None),
+            'TessBaseAPISetSourceResolution': ([c_void_p, c_int], None),
+            'TessBaseAPIRecognize': ([c_void_p, c_void_p], c_int),
+            'TessBaseAPIClear': ([c_void_p], None),
+            'TessBaseAPIDetectOrientationScript': ([c_void_p, POINTER(c_int), POINTER(c_float), POINTER(c_char_p), POINTER(c_float)], c_bool),
+            'TessBaseAPIGetIterator': ([c_void_p], c_void_p),
+            'TessResultIteratorDelete': ([c_void_p], None),
+            'TessResultIteratorNext': ([c_void_p, c_int], c_bool),
+            'TessResultIteratorGetPageIterator': ([c_void_p], c_void_p),
+            'TessResultIteratorGetUTF8Text': ([c_void_p, c_int], c_void_p),
+            'TessResultIteratorConfidence': ([c_void_p, c_int], c_float),
+            'TessPageIteratorIsAtBeginningOf': ([c_void_p, c_int], c_bool),
+            'TessPageIteratorBoundingBox': ([c_void_p, c_int, POINTER(c_int), POINTER(c_int), POINTER(c_int), POINTER(c_int)], c_bool),
+            'TessDeleteText': ([c_void_p], None),
+        }
+        for name, (argtypes, restype) in signatures.items():
+            func = getattr(lib, name)
+            func.argtypes = argtypes
+            func.restype = restype
+        _lib = lib
+        logger.debug(f'Loaded libtesseract {lib.TessVersion().decode()} from {path}')
+        return _lib
+
+
+def load_image(filename):
+    """ Decode an image file into what TessBaseAPISetImage takes: raw pixels, width, height,
+        bytes per pixel and the resolution
+    """
+    from PIL import Image
+    with Image.open(filename) as image:
+        dpi = int(image.info.get('dpi', (DEFAULT_DPI,))[0]) or DEFAULT_DPI
+        if image.mode not in ('L', 'RGB'):
+            image = image.convert('L' if image.mode in ('1', 'LA', 'I;16') else 'RGB')
+        bytes_per_pixel = 1 if image.mode == 'L' else 3
+        return image.tobytes(), image.width, image.height, bytes_per_pixel, dpi
+
+
+class Engine:
+    """
+        One loaded tesseract engine.  Not thread safe, so it's only ever used by one
+        thread at a time (see EnginePool).
+    """
+
+    def __init__(self, lib, lang, datapath=None, psm=PSM_AUTO_OSD):
+        self.lib = lib
+        self.api = lib.TessBaseAPICreate()
+        datapath = datapath.encode() if datapath else None
+        if lib.TessBaseAPIInit3(self.api, datapath, lang.encode()) != 0:
+            lib.TessBaseAPIDelete(self.api)
+            raise RuntimeError(f'Could not initialize tesseract with language {lang}')
+        lib.TessBaseAPISetPageSegMode(self.api, psm)
+
+    def _set_image(self, filename):
+        pixels, width, height, bytes_per_pixel, dpi = load_image(filename)
+        self.lib.TessBaseAPISetImage(self.api, pixels, width, height, bytes_per_pixel, width * bytes_per_pixel)
+        self.lib.TessBaseAPISetSourceResolution(self.api, dpi)
+
+    def orientation(self, filename):
+        """ Return the page's orientation in degrees (like 'Orientation in degrees' in tesseract's
+            OSD output), or None if it couldn't be detected
+        """
+        self._set_image(filename)
+        try:
+            degrees, confidence, script, script_confidence = c_int(), c_float(), c_char_p(), c_float()
+            if not self.lib.TessBaseAPIDetectOrientationScript(self.api, byref(degrees), byref(confidence),
+                                                               byref(script), byref(script_confidence)):
+                return None
+            return degrees.value
+        finally:
+            self.lib.TessBaseAPIClear(self.api)
+
+    def words(self, filename):
+        """ OCR the image and return its words in the same form as text_process_tsv:
+            (block, par, line, word, left, top, width, height) => text
+        """
+        lib = self.lib
+        self._set_image(filename)
+        text_locations = {}
+        try:
+            if lib.TessBaseAPIRecognize(self.api, None) != 0:
+                raise RuntimeError(f'Tesseract could not recognize {filename}')
+            iterator = lib.TessBaseAPIGetIterator(self.api)
+            if not iterator:
+                return text_locations   # Nothing on the page
+            try:
+                page_iterator = lib.TessResultIteratorGetPageIterator(iterator)
+                block = par = line = word = 0
+                left, top, right, bottom = c_int(), c_int(), c_int(), c_int()
+                while True:
+                    if lib.TessPageIteratorIsAtBeginningOf(page_iterator, RIL_BLOCK):
+                        block, par, line, word = block + 1, 0, 0, 0
+                    if lib.TessPageIteratorIsAtBeginningOf(page_iterator, RIL_PARA):
+                        par, line, word = par + 1, 0, 0
+                    if lib.TessPageIteratorIsAtBeginningOf(page_iterator, RIL_TEXTLINE):
+                        line, word = line + 1, 0
+                    word += 1
+                    text_ptr = lib.TessResultIteratorGetUTF8Text(iterator, RIL_WORD)
+                    if text_ptr:
+                        text = ctypes.string_at(text_ptr).decode('utf-8', 'replace')
+                        lib.TessDeleteText(text_ptr)
+                        confidence = lib.TessResultIteratorConfidence(iterator, RIL_WORD)
+                        lib.TessPageIteratorBoundingBox(page_iterator, RIL_WORD, byref(left), byref(top), byref(right), byref(bottom))
+                        # Same cutoff as for the integer confidences in tesseract's tsv output
+                        if int(confidence) > 0:
+                            key = (block, par, line, word, left.value, top.value, right.value - left.value, bottom.value - top.value)
+                            text_locations[key] = text
+                    if not lib.TessResultIteratorNext(iterator, RIL_WORD):
+                        break
+            finally:
+                lib.TessResultIteratorDelete(iterator)
+        finally:
+            lib.TessBaseAPIClear(self.api)
+        return text_locations
+
+    def close(self):
+        self.lib.TessBaseAPIEnd(self.api)
+        self.lib.TessBaseAPIDelete(self.api)
+
+
+class EnginePool:
+    """
+        Engines with the same settings, loaded on demand up to size and then reused,
+        so the traineddata is only loaded once per engine rather than once per page.
+    """
+
+    def __init__(self, lib, size, lang, datapath=None, psm=PSM_AUTO_OSD):
+        self.lib = lib
+        self.size = size
+        self.settings = (lang, datapath, psm)
+        self.free = queue.LifoQueue()
+        self.n_engines = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        """ Take an engine, waiting for one to be returned if size are already in use (call from a thread)
+        """
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            create = self.n_engines < self.size
+            if create:
+                self.n_engines += 1
+        if not create:
+            return self.free.get()
+        logger.debug(f'Loading tesseract engine {self.n_engines} of {self.size} for {self.settings}')
+        try:
+            return Engine(self.lib, *self.settings)
+        except Exception:
+            with self.lock:
+                self.n_engines -= 1
+            raise
+
+    def put(self, engine):
+        self.free.put(engine)
+
+    def run(self, method, filename):
+        """ Call an Engine method on filename with an engine from the pool (call from a thread)
+        """
+        engine = self.get()
+        try:
+            return getattr(engine, method)(filename)
+        finally:
+            self.put(engine)
+
+
+_pools = {}
+
+def get_pool(library, size, lang, datapath=None, psm=PSM_AUTO_OSD):
+    """ Return the engine pool for these settings, shared by every document in this run
+    """
+    key = (library, lang, datapath, psm)
+    with _lib_lock:
+        pool = _pools.get(key)
+    if pool is None:
+        pool = EnginePool(load_library(library), size, lang, datapath, psm)
+        with _lib_lock:
+            pool = _pools.setdefault(key, pool)
+    return pool
@@ -0,0 +1,53 @@
+import logging, os, threading
+
+logger = logging.getLogger(__name__)
+
+"""
+    Keep the per-page files handed from one stage to the next in memory instead of the work directory
+"""
+
+class PageStore:
+    """
+        Contents of files that only exist in memory, by absolute filename.
+
+        The files keep the names they would have in the work directory, so the steps
+        still pass filenames around (and ItemList, page numbers and page markers work
+        the same); only where the bytes live changes.  A file is written out to disk
+        (and dropped from memory) when a step that needs a real file gets it.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()    # The steps also read and write files from threads
+
+    def __contains__(self, filename):
+        return os.path.abspath(filename) in self.files
+
+    def put(self, filename, data):
+        with self.lock:
+            self.files[os.path.abspath(filename)] = bytes(data)
+
+    def get(self, filename):
+        return self.files[os.path.abspath(filename)]
+
+    def discard(self, filename):
+        with self.lock:
+            self.files.pop(os.path.abspath(filename), None)
+
+    def save(self, filename):
+        """ Write the file out to disk, if it's only in memory
+        """
+        filename = os.path.abspath(filename)
+        with self.lock:
+            data = self.files.pop(filename, None)
+        if data is None:
+            return
+        logger.debug(f'Writing {filename} out of memory to disk')
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    @property
+    def size(self):
+        """ Bytes held in memory
+        """
+        return sum(len(data) for data in list(self.files.values()))
@@ -0,0 +1,72 @@
+"""
+    Static list of the plugins in lexic/plugins (kept in plugin_manifest_data.py), so the
+    command line and the pipeline can be set up without importing every plugin and all
+    of their dependencies.
+
+    Regenerate after adding or changing a plugin's attributes with:
+
+        python -m lexic.plugin_manifest > lexic/plugin_manifest_data.py
+"""
+import ast, importlib, logging, pprint
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_ATTRIBUTES = ['name', 'desc', 'stage', 'inputs_from', 'filter_on_output', 'options', 'default']
+
+
+class LazyPlugin:
+    """
+        Stands in for a plugin's class until the plugin is actually needed.
+
+        Has the manifest attributes (name, stage, options, ...) so it can be registered
+        and used to build the pipeline, and only imports the plugin module when it is
+        called to create the plugin object.
+    """
+
+    def __init__(self, entry):
+        self.module = entry['module']
+        self.name = entry['name']
+        self.desc = entry['desc']
+        self.stage = entry['stage']
+        self.inputs_from = list(entry['inputs_from'])
+        self.filter_on_output = list(entry.get('filter_on_output', []))
+        self.options = list(entry['options'])
+        self.default = entry.get('default', True)
+
+    def load(self):
+        """ Import the plugin module and return its Plugin class
+        """
+        logger.debug(f'Importing plugin {self.module}')
+        return importlib.import_module(f'.plugins.{self.module}', 'lexic').Plugin
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __repr__(self):
+        return f'<LazyPlugin {self.module}>'
+
+
+def build_manifest(plugin_dir=None):
+    """ Read the class attributes of every plugin straight from the source code,
+        without importing any of them
+    """
+    plugin_dir = Path(plugin_dir or Path(__file__).parent / 'plugins')
+    manifest = []
+    for plugin_file in sorted(plugin_dir.glob('*.py')):
+        tree = ast.parse(plugin_file.read_text())
+        for node in tree.body:
+            if isinstance(node, ast.ClassDef) and node.name == 'Plugin':
+                entry = {'module': plugin_file.stem}
+                for stmt in node.body:
+                    if isinstance(stmt, ast.Assign) and isinstance(stmt.targets[0], ast.Name):
+                        attribute = stmt.targets[0].id
+                        if attribute in MANIFEST_ATTRIBUTES:
+                            entry[attribute] = ast.literal_eval(stmt.value)
+                manifest.append(entry)
+    return manifest
+
+
+if __name__ == '__main__':
+    print('"""\n    Generated by python -m lexic.plugin_manifest, do not edit\n"""\n')
+    print(f'PLUGINS = {pprint.pformat(build_manifest(), width=120)}')
@@ -0,0 +1,161 @@
+"""
+    Generated by python -m lexic.plugin_manifest, do not edit
+"""
+
+PLUGINS = [{'desc': 'Analyze images to find DPI and dimensions using pdfimages',
+  'inputs_from': ['setup'],
+  'module': 'analyze_pdfimages',
+  'name': 'pdfimages',
+  'options': ['--pdfimages-program=PROGRAM           path to the PdfImages program [default: pdfimages]',
+              '--pdfimages-force_ocr                 ocr every page, even the ones that already have text'],
+  'stage': 'analyze'},
+ {'desc': 'Clean up temporary files',
+  'inputs_from': ['merge_overlay', 'setup', 'analyze', 'image', 'orient', 'ocr', 'text_process', 'create_overlay'],
+  'module': 'clean',
+  'name': 'cleanup',
+  'options': ['--cleanup-preserve          do not delete temporary files'],
+  'stage': 'clean'},
+ {'desc': 'Create pdf overlay using text locations',
+  'inputs_from': ['text_process', 'analyze', 'orient'],
+  'module': 'create_overlay_reportlab',
+  'name': 'pdfoverlay',
+  'options': ["--pdfoverlay-visible           whether the OCR'ed text is overlayed visibily [default: False]"],
+  'stage': 'create_overlay'},
+ {'desc': 'Skip orientation, ocr and the text overlay on blank pages',
+  'filter_on_output': ['image'],
+  'inputs_from': ['image'],
+  'module': 'filter_blank',
+  'name': 'blank',
+  'options': ['--blank-coverage=PERCENT   pages with less ink than this are blank [default: 0.05]',
+              '--blank-drop               leave blank pages out of the output pdf'],
+  'stage': 'filter'},
+ {'desc': 'File PDFs into directories',
+  'filter_on_output': ['clean'],
+  'inputs_from': ['clean', 'setup'],
+  'module': 'filter_filer_dirs',
+  'name': 'filedirs',
+  'options': ['--filedirs-root=NAME       Root directory',
+              '--filedirs-default=NAME    Default directory to file in if no match',
+              '--filedirs-originals=NAME  Where to file original pdf'],
+  'stage': 'filter'},
+ {'desc': 'File PDFs into evernote',
+  'filter_on_output': ['clean'],
+  'inputs_from': ['clean', 'setup'],
+  'module': 'filter_filer_evernote',
+  'name': 'evernote',
+  'options': ['--evernote-root=NAME      Root notebook stack',
+              '--evernote-default=NAME   Default notebook name',
+              '--evernote-token          Evernote developer token'],
+  'stage': 'filter'},
+ {'desc': 'Clean up input using manual imagemagick (convert) run',
+  'filter_on_output': ['image'],
+  'inputs_from': ['image'],
+  'module': 'filter_imagemagick',
+  'name': 'imagemagick',
+  'options': ['--imagemagick-program=PROGRAM   path to ImageMagick preprocessor [default: convert]'],
+  'stage': 'filter'},
+ {'desc': 'Notify with status message via email',
+  'filter_on_output': ['clean'],
+  'inputs_from': ['clean', 'setup'],
+  'module': 'filter_notify_email',
+  'name': 'email',
+  'options': ['--email-smtp_login=USERNAME      Username for email server',
+              '--email-smtp_password=PASSWORD   Password for email server',
+              '--email-smtp_dest=TARGET_EMAIL   Where to send notificdation email'],
+  'stage': 'filter'},
+ {'desc': 'Clean up input using unpaper',
+  'filter_on_output': ['image'],
+  'inputs_from': ['image'],
+  'module': 'filter_unpaper',
+  'name': 'unpaper',
+  'options': ['--unpaper-program=PROGRAM   path to unpaper preprocessor [default: unpaper]'],
+  'stage': 'filter'},
+ {'default': False,
+  'desc': 'Extract the scanned image of each page that is just one scan, and render the others using ghostscript',
+  'inputs_from': ['setup', 'analyze'],
+  'module': 'image_embedded',
+  'name': 'embedded_images',
+  'options': ["--embedded_images-program=PROGRAM     path to Ghostscript program, for the pages that aren't one scan "
+              '[default: gs]',
+              '--embedded_images-pdfimages=PROGRAM   path to the pdfimages program [default: pdfimages]',
+              "--embedded_images-device=DEVICE       gs png device for the pages that aren't one scan, instead of "
+              'png16m, pnggray or pngmono to suit its colours [default: auto]'],
+  'stage': 'image'},
+ {'desc': 'Convert each pdf page into an image file using ghostscript',
+  'inputs_from': ['setup', 'analyze'],
+  'module': 'image_ghostscript',
+  'name': 'ghostscript',
+  'options': ['--ghostscript-program=PROGRAM    path to Ghostscript program [default: gs]',
+              '--ghostscript-device=DEVICE      gs png device for every page, instead of png16m, pnggray or pngmono to '
+              'suit its colours [default: auto]'],
+  'stage': 'image'},
+ {'desc': 'Merge text overlays with original pdf to generate final pdf',
+  'inputs_from': ['create_overlay', 'setup'],
+  'module': 'merge_overlay_pypdf2',
+  'name': 'pdf_merge',
+  'options': [],
+  'stage': 'merge_overlay'},
+ {'default': False,
+  'desc': 'Run ocr using libtesseract engines kept loaded between pages',
+  'inputs_from': ['image'],
+  'module': 'ocr_libtesseract',
+  'name': 'ocr_libtesseract',
+  'options': ['--ocr_libtesseract-lang=LANG         language(s) to recognize [default: eng]',
+              "--ocr_libtesseract-library=PATH      path to libtesseract, if it isn't on the library path",
+              '--ocr_libtesseract-datapath=DIR      directory with the traineddata files'],
+  'stage': 'ocr'},
+ {'default': False,
+  'desc': 'Find page orientation and run ocr in a single tesseract pass',
+  'inputs_from': ['image'],
+  'module': 'ocr_orient_tesseract',
+  'name': 'ocr_orient_tesseract',
+  'options': ['--ocr_orient_tesseract-program=PROGRAM  path to Tesseract program [default: tesseract]',
+              '--ocr_orient_tesseract-upright          pages are known to be upright, so skip orientation detection'],
+  'stage': 'ocr'},
+ {'desc': 'Run ocr using tesseract',
+  'inputs_from': ['image'],
+  'module': 'ocr_tesseract',
+  'name': 'ocr_tesseract',
+  'options': ['--ocr_tesseract-program=PROGRAM    path to Tesseract program [default: tesseract]',
+              '--ocr_tesseract-aws                run in cloud',
+              '--ocr_tesseract-awsurl=URL         endpoint to use for aws (or lexic workers, with a comma-separated '
+              'list of urls)',
+              '--ocr_tesseract-batch              run tesseract once per batch of pages instead of once per page (not '
+              'with --stream)',
+              '--ocr_tesseract-recompress         upload pages to aws as losslessly recompressed grayscale or black '
+              'and white images when they are',
+              '--ocr_tesseract-cascade            ocr each page with a fast pass first, and only redo the pages it '
+              "isn't confident about (not with -batch or -aws)",
+              "--ocr_tesseract-fast_scale=FRACTION  resolution of the fast pass, as a fraction of the page's [default: "
+              '0.5]',
+              "--ocr_tesseract-fast_args=ARGS     extra tesseract options for the fast pass, e.g. '--tessdata-dir "
+              "/usr/share/tessdata_fast'",
+              '--ocr_tesseract-min_conf=CONF      redo pages whose words have a lower average confidence than this in '
+              'the fast pass [default: 85]'],
+  'stage': 'ocr'},
+ {'default': False,
+  'desc': 'Find page orientation using libtesseract engines kept loaded between pages',
+  'inputs_from': ['image'],
+  'module': 'orient_libtesseract',
+  'name': 'orientation_libtesseract',
+  'options': ["--orientation_libtesseract-library=PATH   path to libtesseract, if it isn't on the library path",
+              '--orientation_libtesseract-datapath=DIR   directory with the osd traineddata file'],
+  'stage': 'orient'},
+ {'desc': 'Find page orientation using tesseract',
+  'inputs_from': ['image'],
+  'module': 'orient_tesseract',
+  'name': 'orientation',
+  'options': ['--orientation-program=PROGRAM  path to Orientation detect program [default: tesseract]'],
+  'stage': 'orient'},
+ {'desc': 'Setup work directories and copy files',
+  'inputs_from': [],
+  'module': 'setup_ocr',
+  'name': 'setup_ocr',
+  'options': [],
+  'stage': 'setup'},
+ {'desc': 'Process output of tesseract tsv file into text',
+  'inputs_from': ['ocr'],
+  'module': 'text_process_tsv',
+  'name': 'ocr_tsv_parse',
+  'options': [],
+  'stage': 'text_process'}]
@@ -9,6 +9,39 @@ logger = logging.getLogger(__name__)
 """
     Convert each pdf page into an image file, using ghostrscript calls
 """
+
+# Resolution to render pages at when they have no images to take it from
+DEFAULT_DPI = 300
+# A page with at least this many characters of text has a text layer already
+MIN_TEXT_CHARS = 20
+# ... unless an image covers at least this fraction of it (e.g. a scan with a few words of text
+# added on top), in which case it's mixed and gets ocr'ed as well
+MIN_IMAGE_FRACTION = 0.5
+# pdfimages color spaces that only have shades of gray
+GRAY_COLORS = ['gray', 'sep']
+# Bytes per pixel of a page rendered in each of the colours picked for it
+BYTES_PER_PIXEL = {'color': 3, 'gray': 1, 'mono': 1/8}
+# Copies of each page image the later steps can write (rendered, then preprocessed), counted
+# at their raw size since scans hardly compress
+IMAGE_COPIES = 2
+
+
+def count_text_chars(pdf_filename):
+    """ Return the number of (non-whitespace) characters of text on each page of the pdf
+        (run it in a worker process with Cmd.run_cpu_bound)
+    """
+    reader = PdfFileReader(pdf_filename)
+    counts = []
+    for page_num in range(reader.getNumPages()):
+        try:
+            text = reader.getPage(page_num).extractText()
+        except Exception as e:
+            logger.debug(f'Could not extract the text of page {page_num+1}: {e}')
+            text = ''
+        counts.append(len(''.join(text.split())))
+    return counts
+
+
 class Plugin(Cmd):
 
     name = 'pdfimages'
@@ -16,7 +49,15 @@ class Plugin(Cmd):
     stage = 'analyze'
     inputs_from = ["setup"]
     
-    options = ["--pdfimages-program=PROGRAM           path to the PdfImages program [default: pdfimages]"]
+    options = ["--pdfimages-program=PROGRAM           path to the PdfImages program [default: pdfimages]",
+               "--pdfimages-force_ocr                 ocr every page, even the ones that already have text",
+    ]
+
+    reads_markers = []  # It writes the text markers
+
+    async def fingerprint(self, *inputs, pages=None):
+        # The resolutions written depend on --max_dpi and --target_dpi too
+        return await super().fingerprint(*inputs, Cmd.max_dpi, Cmd.target_dpi, pages=pages)
 
     async def run(self, item_list):
         assert len(item_list) == 1
@@ -27,27 +68,119 @@ class Plugin(Cmd):
             cmd = f'pdfimages -list {item}'
             # Now store each resolution to file
             resolutions_filename = self._change_ext(item, 'res')
+            # And what colours each page needs to be rendered in, for the image step
+            colors_filename = self._change_ext(item, 'colors')
 
             if not self.skip:
                 out = await self._run_command(cmd)
                 resolutions = self._get_resolutions(out)
+                image_colors = self._get_image_colors(out)
                 dims = self._get_page_sizes(item)  # Get the actual page sizes using pypdf2
                 logger.debug(f'Page dimensions: {dims}')
+                text_chars = await self.run_cpu_bound(count_text_chars, item)
 
                 page_values = {}
-                for page_num in resolutions:
+                kinds = {}
+                colors = {}
+                for page_num in dims:
+                    # Every page gets an entry, even if it has no images to take the resolution from
+                    if page_num in resolutions:
+                        scan_xdpi, scan_ydpi, _, _ = resolutions[page_num]
+                    else:
+                        scan_xdpi, scan_ydpi = DEFAULT_DPI, DEFAULT_DPI
+                    # The page gets rendered (and so ocr'ed) at this resolution, and the overlay
+                    # maps the word boxes back onto the page with the same one
+                    xdpi, ydpi = self.render_dpi(scan_xdpi, scan_ydpi)
+                    if (xdpi, ydpi) != (scan_xdpi, scan_ydpi):
+                        logger.debug(f'Page {page_num}: rendering at {xdpi}x{ydpi} instead of {scan_xdpi}x{scan_ydpi} (scale {xdpi/scan_xdpi:.3f})')
                     # Replace the page h, w in the resolutions
-                    xdpi, ydpi, _, _ = resolutions[page_num]
                     new_w = int(dims[page_num][0]*xdpi/72.0)
                     new_h = int(dims[page_num][1]*ydpi/72.0)
                     page_values[page_num] = (xdpi, ydpi, new_w, new_h)
+                    kinds[page_num] = self._classify_page(dims[page_num], resolutions.get(page_num), text_chars[page_num-1])
+                    colors[page_num] = self._page_colors(image_colors.get(page_num, []), kinds[page_num])
+                logger.debug(f'Page kinds: {kinds}')
+                logger.debug(f'Page colors: {colors}')
 
                 await self.write_yaml_to_file(resolutions_filename, page_values)
-                await self.add_message(f'{len(page_values)} pages in pdf')
+                await self.write_yaml_to_file(colors_filename, colors)
+                n_text = await self._mark_text_pages(item, kinds)
+                self.work_size = self._estimate_work_size(item, page_values, colors, kinds)
+                logger.debug(f'Expecting the work directory to need {self.work_size/2**20:.0f}MB')
+                await self.add_message(f'{len(page_values)} pages in pdf, {n_text} with text already')
             next_items.append(resolutions_filename)
         
         return next_items
 
+    def _classify_page(self, dims, resolution, n_chars):
+        """ Return 'text' for a page with a text layer (born digital, maybe with a few small
+            images), 'mixed' for one with text and a large image, or 'image' for one with no text
+        """
+        if n_chars < MIN_TEXT_CHARS:
+            return 'image'
+        if resolution is None:
+            return 'text'
+        xdpi, ydpi, width, height = resolution
+        image_fraction = (width / xdpi * height / ydpi) / (dims[0] / 72.0 * dims[1] / 72.0)
+        return 'mixed' if image_fraction >= MIN_IMAGE_FRACTION else 'text'
+
+    def _page_colors(self, images, kind):
+        """ Return the fewest colours the page can be rendered in without losing any of its
+            images' ('mono' for 1 bit gray, 'gray' or 'color'), from the (color, bpc) of each.
+            Pages with any text or drawing besides the scans get at least gray, for smooth text.
+        """
+        if not images:
+            return 'gray'
+        if any(color not in GRAY_COLORS for color, bpc in images):
+            return 'color'
+        if kind == 'image' and all(bpc == '1' for color, bpc in images):
+            return 'mono'
+        return 'gray'
+
+    def _get_image_colors(self, pdfimage_output):
+        """ Return the (color, bpc) of each image on each page, by page number
+        """
+        lines = [l.decode('utf-8') for l in pdfimage_output.splitlines()]
+        image_colors = {}
+        if len(lines) < 3:
+            return image_colors
+        indices = {k: i for i, k in enumerate(lines[0].split())}
+        for image_line in lines[2:]:
+            image = image_line.split()
+            try:
+                if image[indices['type']] in ('image', 'stencil'):
+                    # A stencil mask is painted in a fill colour we can't see here, so count it as gray
+                    color = image[indices['color']] if image[indices['type']] == 'image' else 'gray'
+                    image_colors.setdefault(int(image[indices['page']]), []).append((color, image[indices['bpc']]))
+            except (ValueError, IndexError):
+                logger.debug(f'Error Processing |{image}|')
+        return image_colors
+
+    def _estimate_work_size(self, pdf_filename, page_values, colors, kinds):
+        """ Return about the most space the document's work directory will take: the pdf, and
+            the images of the pages that get ocr'ed (the text, overlays and the rest are small
+            next to them)
+        """
+        size = os.path.getsize(pdf_filename)
+        for page_num, (xdpi, ydpi, w, h) in page_values.items():
+            if kinds[page_num] == 'text' and not self.config['force_ocr']:
+                continue
+            size += w * h * BYTES_PER_PIXEL[colors[page_num]] * IMAGE_COPIES
+        return int(size)
+
+    async def _mark_text_pages(self, pdf_filename, kinds):
+        """ Mark the pages that already have text, so the later steps leave them as they are.
+            Every page gets a marker (empty if it needs ocr), replacing any from an earlier run.
+        """
+        work_dir = os.path.dirname(os.path.abspath(pdf_filename))
+        n_text = 0
+        for page_num, kind in kinds.items():
+            skip = kind == 'text' and not self.config['force_ocr']
+            n_text += skip
+            with open(self.page_marker(work_dir, page_num, 'text'), 'w') as f:
+                f.write('keep' if skip else '')
+        return n_text
+
     def _get_page_sizes(self, pdf_filename):
         # Use PyPDF2 to get actual page size, since relying on pdfimages only
         # returns an image, which could be placed on a larger page
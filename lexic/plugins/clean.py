@@ -1,4 +1,4 @@
-import logging, os, shutil
+import logging, os, shutil, glob
 
 from ..command import Cmd
 from ..item import ItemList
@@ -15,6 +15,8 @@ class Plugin(Cmd):
     desc = 'Clean up temporary files'
     stage = 'clean'
     inputs_from = ['merge_overlay', 'setup', 'analyze', 'image', 'orient', 'ocr', 'text_process', 'create_overlay']
+    always_run = True
+    in_memory = True    # Drops the files kept in memory itself (or writes them out, to preserve them)
     
     options = ['--cleanup-preserve          do not delete temporary files']
 
@@ -24,7 +26,9 @@ class Plugin(Cmd):
     async def run(self, final_pdf_list, *item_lists):
 
         # Move the ocr file back to the original directory
-        cwd = os.getcwd()
+        cwd = self.output_dir or os.getcwd()
+        # Incremental runs need the intermediate files for the next run
+        preserve = self.config['preserve'] or self.incremental
 
         try:
             with final_pdf_list as final_items:
@@ -34,17 +38,28 @@ class Plugin(Cmd):
                 pdf_base = self._get_filename_base(final_pdf_filename)
                 pdf_ext = self._get_filename_ext(final_pdf_filename)
                 output_filename = os.path.join(cwd, f'{pdf_base}{pdf_ext}')
-                if not self.config['preserve']:
+                if not preserve:
                     os.remove(final_pdf_filename)
 
+            removed = set()   # A step can pass its input straight through as its output
             for item_list in self.iterate_with_progress(item_lists):
                 with item_list as items:
                     for item in items:
                         logging.debug(f'Cleanup - {item}')
-                        if not self.config['preserve']:
+                        if self.page_store is not None and item in self.page_store:
+                            if preserve:
+                                self.page_store.save(item)
+                            else:
+                                self.page_store.discard(item)
+                        elif not preserve and item not in removed:
                             os.remove(item)
-            if not self.config['preserve']:
-                os.removedirs(item_lists[0].common_dir)
+                            removed.add(item)
+            if not preserve:
+                # Left by analyze (with the page colours) and the blank page filter
+                for pattern in [f'page_*.{reason}' for reason in self.page_markers] + ['*.colors']:
+                    for marker in glob.glob(os.path.join(item_lists[0].common_dir, pattern)):
+                        os.remove(marker)
+                os.rmdir(item_lists[0].common_dir)   # Not removedirs, which would take an empty --scratch with it
         except OSError as e:
             self.error(f'Could not do cleanup step - {e}')
         
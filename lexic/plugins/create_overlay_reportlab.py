@@ -1,11 +1,10 @@
-import logging, os, platform, yaml, math
+import logging, os, platform, yaml, math, io
 from html import escape
 from reportlab.pdfgen.canvas import Canvas
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.enums import TA_LEFT
 from reportlab.platypus.paragraph import Paragraph
 from PyPDF2 import PdfFileMerger, PdfFileReader, PdfFileWriter, utils
-import curio
 
 from ..command import Cmd
 from ..item import ItemList
@@ -68,6 +67,8 @@ class Plugin(Cmd):
     desc = 'Create pdf overlay using text locations'
     stage = 'create_overlay'
     inputs_from = ['text_process', 'analyze', 'orient']
+    per_page = True
+    in_memory = True
     
     options = ["--pdfoverlay-visible           whether the OCR'ed text is overlayed visibily [default: False]"]
 
@@ -98,74 +99,102 @@ class Plugin(Cmd):
                 await self.add_to_queue(next_item, self.create_pdf_with_text, loc_filename, next_item, page_res_and_dims[i+1], rotation_angles[i])
                         #await self.create_pdf_with_text(text_locations, next_item, page_res_and_dims[i+1], rotation_angles[i])
             return await self.run_queue()
+
+    async def run_page(self, page, loc_filename, analysis_item_list, angle_filename):
+        if not hasattr(self, 'page_res_and_dims'):
+            self.is_visible = self.config['visible']
+            with analysis_item_list as items:
+                assert len(items) == 1
+                self.page_res_and_dims = await self.read_yaml_from_file(items[0])
+
+        next_item = self._change_ext(loc_filename, 'ov.pdf')
+        if not self.skip:
+            rotation_angle = await self.read_yaml_from_file(angle_filename)
+            await self.create_pdf_with_text(loc_filename, next_item, self.page_res_and_dims[page], rotation_angle)
+        return next_item
                 
     async def create_pdf_with_text(self, loc_filename, pdf_filename, page_res_and_dims, rotation_angle):
+        if self.skipped_page(loc_filename):
+            # Nothing to lay out, and merge_overlay leaves the page alone, so just leave a placeholder
+            await self.write_page_file(pdf_filename, b'')
+            return
+        # Laying out every word is cpu-intensive, so do the whole page in a worker process
+        loc = await self.read_page_file(loc_filename)
+        text_pdf = await self.run_cpu_bound(render_text_overlay, loc, os.path.basename(pdf_filename),
+                                            page_res_and_dims, rotation_angle, self.is_visible)
+        await self.write_page_file(pdf_filename, text_pdf)
+
+
+def render_text_overlay(loc, title, page_res_and_dims, rotation_angle, visible):
+    """ Return a one page pdf with the text from loc (the page's text locations, as yaml)
+        at its locations on the page.
+
+        Runs in a worker process, so it only gets the page's (small) text and values passed
+        in; the files themselves are read and written by the caller, in case they're in memory.
+    """
+    text_locations = yaml.load(loc)
 
-        with open(loc_filename) as loc_file:
-            text_locations = yaml.load(loc_file)
-
-        with open(pdf_filename, 'wb') as f:
+    with io.BytesIO() as f:
 
-            logger.debug(f'Creating overlay pdf {pdf_filename}')
-            pdf = Canvas(f, pageCompression=1)
-            pdf.setCreator('lexic')
-            pdf.setTitle(os.path.basename(pdf_filename))
-            pdf.setPageCompression(1)
+        logger.debug(f'Creating overlay pdf {title}')
+        pdf = Canvas(f, pageCompression=1)
+        pdf.setCreator('lexic')
+        pdf.setTitle(title)
+        pdf.setPageCompression(1)
 
-            #width, height, dpi_jpg = self._get_img_dims(img_basename)
-            xdpi, ydpi, w, h = page_res_and_dims
-            width = w * 72.0 / xdpi
-            height = h * 72.0 / ydpi
-            logger.debug("Prerotation: Page width=%f, height=%f" % (width, height))
+        #width, height, dpi_jpg = self._get_img_dims(img_basename)
+        xdpi, ydpi, w, h = page_res_and_dims
+        width = w * 72.0 / xdpi
+        height = h * 72.0 / ydpi
+        logger.debug("Prerotation: Page width=%f, height=%f" % (width, height))
 
-            pdf.setPageSize((width,height))
-            logger.debug("Page width=%f, height=%f" % (width, height))
+        pdf.setPageSize((width,height))
+        logger.debug("Page width=%f, height=%f" % (width, height))
 
-            logger.debug("Adding text to page %s" % pdf_filename)
-            #self.add_text_layer(text_locations, pdf, xdpi, ydpi, height, rotation_angle)
+        logger.debug("Adding text to page %s" % title)
+        add_text_layer(text_locations, pdf, xdpi, ydpi, height, rotation_angle, visible)
+        pdf.showPage()
+        pdf.save()
+        return f.getvalue()
 
-            # Run this cpu-intensive section in a thread so we don't block curio
-            await curio.run_in_thread(self.add_text_layer, text_locations, pdf, xdpi, ydpi, height, rotation_angle)
-            pdf.showPage()
-            pdf.save()
 
-    def add_text_layer(self, text_locations, pdf, xdpi, ydpi, page_height, rotation_angle):
+def add_text_layer(text_locations, pdf, xdpi, ydpi, page_height, rotation_angle, visible):
 
-        assert rotation_angle in [0,90,180,270], f'Rotation angle {rotation_angle} is not supported (only 0, 90, 180, 270 work)'
+    assert rotation_angle in [0,90,180,270], f'Rotation angle {rotation_angle} is not supported (only 0, 90, 180, 270 work)'
 
-        prev_font_size = -10
-        font_size_change_threshold = 5 
+    prev_font_size = -10
+    font_size_change_threshold = 5 
 
-        #for loc, text in text_locations.items():
-        logger.debug(f'Adding text_layer: xdpi: {xdpi} ydpi: {ydpi} page_height: {page_height}')
-        # Get stylesheet to set font properties
-        style = getSampleStyleSheet()
-        normal = style['BodyText']
-        normal.alignment = TA_LEFT
-        normal.leading = 0
-        normal.fontName = 'Helvetica'
+    #for loc, text in text_locations.items():
+    logger.debug(f'Adding text_layer: xdpi: {xdpi} ydpi: {ydpi} page_height: {page_height}')
+    # Get stylesheet to set font properties
+    style = getSampleStyleSheet()
+    normal = style['BodyText']
+    normal.alignment = TA_LEFT
+    normal.leading = 0
+    normal.fontName = 'Helvetica'
 
-        dpi_factor = 72.0*72.0/xdpi/ydpi
+    dpi_factor = 72.0*72.0/xdpi/ydpi
 
-        for loc, text in sorted(text_locations.items(), key=lambda kv: kv[0]):
-            block, par, line, word, x, y, w, h = loc
-            logger.debug(f'Text "{text}" at ({x}, {y}) : w {w} h {h}')
+    for loc, text in sorted(text_locations.items(), key=lambda kv: kv[0]):
+        block, par, line, word, x, y, w, h = loc
+        logger.debug(f'Text "{text}" at ({x}, {y}) : w {w} h {h}')
 
-            length = len(text)
-            # Hack to figure out what approximate font size to use for overlay text
-            area = w * h * dpi_factor
-            new_font_size = math.sqrt(area/length*2.5)
-            if new_font_size < 1: 
-                new_font_size = 1
-            normal.fontSize = new_font_size
+        length = len(text)
+        # Hack to figure out what approximate font size to use for overlay text
+        area = w * h * dpi_factor
+        new_font_size = math.sqrt(area/length*2.5)
+        if new_font_size < 1: 
+            new_font_size = 1
+        normal.fontSize = new_font_size
 
-            assert normal.fontSize >= 1
+        assert normal.fontSize >= 1
 
-            # Set up paragraph with text
-            text_angle = rotation_angle
-            para = RotatedPara(escape(text), normal, text_angle, w*72.0/xdpi, h*72.0/ydpi, self.is_visible)
-            para.wrapOn(pdf, para.minWidth(), 100)
+        # Set up paragraph with text
+        text_angle = rotation_angle
+        para = RotatedPara(escape(text), normal, text_angle, w*72.0/xdpi, h*72.0/ydpi, visible)
+        para.wrapOn(pdf, para.minWidth(), 100)
 
-            px = int(x*72.0/xdpi)
-            py = int(page_height - ((y)*72.0/ydpi))
-            para.drawOn(pdf, px, py)
+        px = int(x*72.0/xdpi)
+        py = int(page_height - ((y)*72.0/ydpi))
+        para.drawOn(pdf, px, py)
@@ -0,0 +1,94 @@
+import logging, os
+
+from ..command import Cmd
+from ..item import ItemList
+
+logger = logging.getLogger(__name__)
+
+"""
+    Find blank pages (e.g. the backs of duplex scans), so they aren't oriented or ocr'ed
+"""
+
+class Plugin(Cmd):
+
+    name = 'blank'
+    desc = 'Skip orientation, ocr and the text overlay on blank pages'
+    stage = 'filter'
+    filter_on_output = ['image']
+
+    inputs_from = ['image']
+    per_page = True
+    reads_markers = ['text']    # It writes the blank markers
+
+    options = ["--blank-coverage=PERCENT   pages with less ink than this are blank [default: 0.05]",
+               "--blank-drop               leave blank pages out of the output pdf",
+    ]
+
+    def _find_executable(self):
+        return
+
+    async def run(self, item_list):
+        with item_list as items:
+            for item in items:
+                await self.add_to_queue(self._marker(item), self.check_page, item)
+            await self.run_queue()
+            # The images go on unchanged; the markers are picked up by the later steps
+            return ItemList(items)
+
+    async def run_page(self, page, item):
+        if not self.skip:
+            await self.check_page(item)
+        return item
+
+    def _marker(self, item):
+        return self.page_marker(os.path.dirname(os.path.abspath(item)), self._page_of(item), 'blank')
+
+    async def check_page(self, item):
+        """ Mark the page as blank if it has (almost) no ink on it; the image itself is passed on as is
+        """
+        if self.read_page_marker(item, 'text'):
+            blank = False   # Not rendered, since the page already has text
+        else:
+            coverage = await self.run_cpu_bound(ink_coverage, item)
+            blank = coverage < float(self.config['coverage'])
+        if blank:
+            logger.debug(f'{item} is blank ({coverage:.3f}% ink)')
+            await self.add_message(f'page {self._page_of(item)} is blank')
+        # Written for every page (empty if it isn't blank), so incremental runs can tell it's up to date
+        with open(self._marker(item), 'w') as f:
+            f.write(('drop' if self.config['drop'] else 'keep') if blank else '')
+
+
+# Size to shrink the page image down to (longest side) before looking for ink.
+# Averaging the pixels together also washes out scanner noise and dust specks.
+SAMPLE_SIZE = 1000
+# How much darker than the paper a pixel has to be to count as ink
+INK_CONTRAST = 64
+# Ignore this fraction of the page at each edge, where scans often have dark borders
+MARGIN = 0.05
+
+
+def ink_coverage(image_filename):
+    """ Return the percentage of the page (inside the margins) covered by ink
+    """
+    from PIL import Image
+
+    with Image.open(image_filename) as image:
+        image = image.convert('L')
+        factor = max(1, max(image.size) // SAMPLE_SIZE)
+        if factor > 1:
+            image = image.reduce(factor)
+        width, height = image.size
+        dx, dy = int(width * MARGIN), int(height * MARGIN)
+        histogram = image.crop((dx, dy, width-dx, height-dy)).histogram()
+    n_pixels = sum(histogram)
+    if n_pixels == 0:
+        return 0.0
+    # The paper is whatever shade most of the page is
+    count = 0
+    for paper, n in enumerate(histogram):
+        count += n
+        if count * 2 >= n_pixels:
+            break
+    ink = sum(histogram[:max(0, paper - INK_CONTRAST)])
+    return ink * 100.0 / n_pixels
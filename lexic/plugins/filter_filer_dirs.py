@@ -4,7 +4,7 @@ from pathlib import Path
 
 from ..command import Cmd
 from ..item import ItemList
-from ..keyword_filer import KeywordFiler
+from ..keyword_filer import KeywordFiler, extract_page_texts
 
 logger = logging.getLogger(__name__)
 
@@ -14,8 +14,8 @@ logger = logging.getLogger(__name__)
 class DirFiler(KeywordFiler):
     # Need to augment the validator to create directories,
     # as well as store originals
-    def __init__(self, config, pdf_filename):
-        super().__init__(config, pdf_filename)
+    def __init__(self, config, pdf_filename, page_texts=None):
+        super().__init__(config, pdf_filename, page_texts)
         # If the originals is specified, then create an variable to use later
         if 'originals' in config:
             self.originals_path = Path(config['originals'])
@@ -58,6 +58,7 @@ class Plugin(Cmd):
     stage = 'filter'
     filter_on_output = ['clean']
     inputs_from = ['clean','setup']
+    always_run = True
     
     #options = ['--filedirs-keywords=FILE     Keyword files']
     options = ['--filedirs-root=NAME       Root directory', 
@@ -83,7 +84,8 @@ class Plugin(Cmd):
         # Read in the keyword files
         with item_list as items:
             item = items[0]
-            filer = DirFiler(self.config, item)
+            page_texts = await self.run_cpu_bound(extract_page_texts, item)
+            filer = DirFiler(self.config, item, page_texts)
             folder = filer.find_matching_folder()
             folder = Path(filer.root_path) / Path(folder)
             logger.debug(f'Filing to folder {folder}')
@@ -13,7 +13,7 @@ from evernote.edam.error.ttypes import EDAMErrorCode
 
 from ..command import Cmd
 from ..item import ItemList
-from ..keyword_filer import KeywordFiler
+from ..keyword_filer import KeywordFiler, extract_page_texts
 
 logger = logging.getLogger(__name__)
 
@@ -212,6 +212,7 @@ class Plugin(Cmd):
     stage = 'filter'
     filter_on_output = ['clean']
     inputs_from = ['clean','setup']
+    always_run = True
     
     #options = ['--evernote-keywords=FILE     Keyword files']
     options = ['--evernote-root=NAME      Root notebook stack', 
@@ -240,7 +241,8 @@ class Plugin(Cmd):
         # Read in the keyword files
         with item_list as items:
             item = items[0]
-            filer = EvernoteFiler(self.config, item)
+            page_texts = await self.run_cpu_bound(extract_page_texts, item)
+            filer = EvernoteFiler(self.config, item, page_texts)
             folder = filer.find_matching_folder()
             logger.debug(f'Filing to Evernote folder {folder}')
 
@@ -15,6 +15,7 @@ class Plugin(Cmd):
     stage = 'filter'
     filter_on_output = ['image']
     inputs_from = ["image"]
+    per_page = True
 
     options = ["--imagemagick-program=PROGRAM   path to ImageMagick preprocessor [default: convert]"]
 
@@ -27,6 +28,9 @@ class Plugin(Cmd):
                 next_items.append(next_item)
         return next_items
 
+    async def run_page(self, page, item):
+        return await self.run_image_magick(item)
+
     async def run_image_magick(self, item):
         current_extension = self._get_filename_ext(item)
         out_filename = self._change_ext(item, f'pre{current_extension}')
@@ -50,5 +54,10 @@ class Plugin(Cmd):
                 '-negate -define morphology:compose=darken -morphology Thinning Rectangle:1x30+0+0 -negate ',  # Removes vertical lines >=60 pixes, reduces widht of >30 (oherwise tesseract < 3.03 completely ignores text close to vertical lines in a table)
                 '"%s"' % (out_filename)
                 ]
-        await self._run_command(' '.join(c))
+        if self.skip:
+            pass
+        elif self.skipped_page(item):
+            open(out_filename, 'wb').close()   # Not rendered, so there's nothing to clean up
+        else:
+            await self._run_command(' '.join(c))
         return out_filename
\ No newline at end of file
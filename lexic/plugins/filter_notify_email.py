@@ -15,6 +15,7 @@ class Plugin(Cmd):
     stage = 'filter'
     filter_on_output = ['clean']
     inputs_from = ['clean','setup']
+    always_run = True
     MAX_MSGS_PER_SENDER = 3
     
     options = ['--email-smtp_login=USERNAME      Username for email server',
@@ -16,6 +16,7 @@ class Plugin(Cmd):
     filter_on_output = ['image']
 
     inputs_from = ['image']
+    per_page = True
 
     options = ["--unpaper-program=PROGRAM   path to unpaper preprocessor [default: unpaper]"]
 
@@ -28,5 +29,15 @@ class Plugin(Cmd):
                 await self.add_to_queue(out_filename, self.run_unpaper, item, out_filename)
             return await self.run_queue()
 
+    async def run_page(self, page, item):
+        current_extension = self._get_filename_ext(item)
+        out_filename = self._change_ext(item, f'pre{current_extension}')
+        if not self.skip:
+            await self.run_unpaper(item, out_filename)
+        return out_filename
+
     async def run_unpaper(self, item, out_filename):
+        if self.skipped_page(item):
+            open(out_filename, 'wb').close()   # Not rendered, so there's nothing to clean up
+            return
         await self._run_command(f'{self.executable} --no-mask-center --no-border-align {item} {out_filename}')
\ No newline at end of file
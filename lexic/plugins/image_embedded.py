@@ -0,0 +1,123 @@
+import logging, os, struct, zlib
+from collections import defaultdict
+
+import curio
+from PyPDF2 import PdfFileReader
+
+from .image_ghostscript import Plugin as GhostscriptPlugin
+
+logger = logging.getLogger(__name__)
+
+"""
+    Take the scanned image straight out of each page that is just one scan, and render the rest with ghostscript
+"""
+
+# Image color spaces pdfimages can write out as png
+PNG_COLORS = ['gray', 'rgb', 'index', 'icc']
+# How far (as a fraction) the image's size can be from the page's at the resolution analyze found
+SIZE_TOLERANCE = 0.01
+
+
+def page_rotations(pdf_filename):
+    """ Return the /Rotate of every page, by page number
+    """
+    reader = PdfFileReader(pdf_filename)
+    return {page_num+1: int(reader.getPage(page_num).get('/Rotate', 0)) % 360 for page_num in range(reader.getNumPages())}
+
+
+def set_png_dpi(png_filename, xdpi, ydpi):
+    """ Add the resolution to a png (as a pHYs chunk right after the header) without decoding it,
+        since pdfimages leaves it out and tesseract needs it
+    """
+    with open(png_filename, 'rb') as f:
+        png = f.read()
+    header_end = 8 + 8 + 13 + 4     # Signature, then the IHDR chunk: length, type, data, crc
+    data = struct.pack('>IIB', round(xdpi / 0.0254), round(ydpi / 0.0254), 1)   # Pixels per meter
+    chunk = struct.pack('>I', len(data)) + b'pHYs' + data + struct.pack('>I', zlib.crc32(b'pHYs' + data))
+    with open(png_filename, 'wb') as f:
+        f.write(png[:header_end] + chunk + png[header_end:])
+
+
+class Plugin(GhostscriptPlugin):
+
+    name = 'embedded_images'
+    desc = 'Extract the scanned image of each page that is just one scan, and render the others using ghostscript'
+    stage = 'image'
+    inputs_from = ["setup", "analyze"]
+    per_page = True
+    default = False     # Use with --plugins=embedded_images
+
+    options = ['--embedded_images-program=PROGRAM     path to Ghostscript program, for the pages that aren\'t one scan [default: gs]',
+               '--embedded_images-pdfimages=PROGRAM   path to the pdfimages program [default: pdfimages]',
+               '--embedded_images-device=DEVICE       gs png device for the pages that aren\'t one scan, instead of png16m, pnggray or pngmono to suit its colours [default: auto]',
+    ]
+
+    async def _queue_pages(self, item, filename, page_list, resolutions):
+        self.extractable = set() if self.skip else await self._find_extractable_pages(item, resolutions)
+        extract = [page for page in page_list if page in self.extractable]
+        if extract:
+            await self.add_message(f'extracting {len(extract)} of {len(page_list)} pages without rendering them')
+        # The image of each page is numbered in order, so a run of pages can be extracted in one go
+        for first, last, _, _ in self._page_ranges(filename, extract, resolutions):
+            await self.add_to_queue(self._range_key(filename, first, last), self.call_pdfimages_range,
+                                    item, first, last, filename, resolutions)
+        await super()._queue_pages(item, filename, [page for page in page_list if page not in self.extractable], resolutions)
+
+    async def get_pages(self, item_list, analysis_item_list):
+        pages = await super().get_pages(item_list, analysis_item_list)
+        self.extractable = set() if self.skip else await self._find_extractable_pages(item_list[0], self.resolutions)
+        return pages
+
+    async def run_page(self, page, item_list, analysis_item_list):
+        if page not in self.extractable:
+            return await super().run_page(page, item_list, analysis_item_list)
+        item = item_list[0]
+        filename, filext = os.path.splitext(item)
+        if not self.skip:
+            await self.call_pdfimages_range(item, page, page, filename, self.resolutions)
+        return f'{filename}_{page}.png'
+
+    async def _find_extractable_pages(self, item, resolutions):
+        """ Return the pages that are exactly one image, filling the page at the resolution
+            analyze found (so not scaled down by --max_dpi), not rotated, and that need ocr
+        """
+        filename, filext = os.path.splitext(item)
+        out = await self._run_command(f'{self.config["pdfimages"]} -list "{item}"')
+        lines = [l.decode('utf-8') for l in out.splitlines()]
+        if len(lines) < 3:
+            return set()
+        indices = {k: i for i, k in enumerate(lines[0].split())}
+        images = defaultdict(list)
+        for line in lines[2:]:
+            fields = line.split()
+            try:
+                images[int(fields[indices['page']])].append(fields)
+            except (ValueError, IndexError):
+                logger.debug(f'Cannot parse pdfimages line |{line}|')
+        rotations = await self.run_cpu_bound(page_rotations, item)
+
+        extractable = set()
+        for page, (xdpi, ydpi, width, height) in resolutions.items():
+            if len(images[page]) != 1 or rotations.get(page, 0) != 0 or self.skipped_page(f'{filename}_{page}.png'):
+                continue
+            image = images[page][0]
+            if image[indices['type']] != 'image' or image[indices['color']] not in PNG_COLORS:
+                continue
+            image_width, image_height = int(image[indices['width']]), int(image[indices['height']])
+            if abs(image_width - width) <= width * SIZE_TOLERANCE and abs(image_height - height) <= height * SIZE_TOLERANCE:
+                extractable.add(page)
+        logger.debug(f'Pages that are one image: {sorted(extractable)}')
+        return extractable
+
+    async def call_pdfimages_range(self, item, first, last, filename, resolutions):
+        """ Extract the image on each of pages first to last, losslessly, into the usual
+            {filename}_{page}.png files
+        """
+        prefix = f'{filename}_images{first}'
+        await self._run_command(f'{self.config["pdfimages"]} -png -f {first} -l {last} "{item}" "{prefix}"')
+        # pdfimages numbers the images it writes from 0
+        for i, page in enumerate(range(first, last + 1)):
+            image_filename = f'{prefix}-{i:03d}.png'
+            xdpi, ydpi = resolutions[page][0:2]
+            await curio.run_in_thread(set_png_dpi, image_filename, xdpi, ydpi)
+            os.replace(image_filename, f'{filename}_{page}.png')
@@ -1,4 +1,4 @@
-import logging, os, platform
+import logging, os, platform, math, struct
 from tqdm import tqdm
 
 from ..command import Cmd
@@ -9,23 +9,41 @@ logger = logging.getLogger(__name__)
 """
     Convert each pdf page into an image file, using ghostrscript calls
 """
+
+# The gs device for the colours analyze found a page needs.  Gray and black and white pages
+# come out 3 and 24 times smaller than in colour, to write, read and decode.
+DEVICES = {'color': 'png16m', 'gray': 'pnggray', 'mono': 'pngmono'}
+# The pages are written to .png files (and split apart as pngs with --in_memory), so only gs's png devices will do
+PNG_DEVICES = ['png16m', 'png48', 'pngalpha', 'png256', 'png16', 'pnggray', 'pngmono', 'pngmonod']
+
 class Plugin(Cmd):
 
     name = 'ghostscript'
     desc = 'Convert each pdf page into an image file using ghostscript'
     stage = 'image'
     inputs_from = ["setup", "analyze"]
+    per_page = True
+    in_memory = True
+    # Only the pages analyze found text on are left unrendered; any blank markers are from the
+    # last run, since the blank filter looks at the images this step makes
+    reads_markers = ['text']
     
-    options = ['--ghostscript-program=PROGRAM    path to Ghostscript program [default: gs]']
+    options = ['--ghostscript-program=PROGRAM    path to Ghostscript program [default: gs]',
+               '--ghostscript-device=DEVICE      gs png device for every page, instead of png16m, pnggray or pngmono to suit its colours [default: auto]',
+    ]
+
+    def __init__(self, config, skip=False):
+        super().__init__(config, skip)
+        self.range_pngs = {}    # First png of a run of pages => the pngs of all its pages
 
     async def run(self, item_list, analysis_item_list):
         assert len(item_list) == 1
         logger.debug('Inside imaging')
 
+        self._check_device()
         # Load the resolutions
-        with analysis_item_list as items:
-            for item in items:
-                resolutions = await self.read_yaml_from_file(item)
+        resolutions = await self._read_resolutions(analysis_item_list)
+        self.colors = await self._read_colors(analysis_item_list)
         page_list = sorted(resolutions.keys())
             
         logger.debug(f'resolutions: {resolutions}')
@@ -35,14 +53,134 @@ class Plugin(Cmd):
             filename, filext = os.path.splitext(item)
             for page in page_list:
                 res_x, res_y = resolutions[page][0:2]
-                output_filename = f'{filename}_{page}.png'
-                await self.add_to_queue(output_filename, self.call_ghostscript, 
-                                            item, page, output_filename, res_x, res_y)
                 await self.add_message(f'page {page} at {res_x}x{res_y}')
- 
-            return await self.run_queue()
+            await self._queue_pages(item, filename, page_list, resolutions)
+            await self.run_queue()
+            return ItemList([os.path.abspath(f'{filename}_{page}.png') for page in page_list])
+
+    async def _queue_pages(self, item, filename, page_list, resolutions):
+        # Render runs of pages in one gs each, so the pdf is only opened and parsed once per run
+        for first, last, res_x, res_y in self._page_ranges(filename, page_list, resolutions):
+            await self.add_to_queue(self._range_key(filename, first, last), self.call_ghostscript_range,
+                                        item, first, last, filename, res_x, res_y)
+
+    def _range_key(self, filename, first, last):
+        """ The png a run of pages is queued under (its first), noting the others it writes
+        """
+        pngs = [f'{filename}_{page}.png' for page in range(first, last + 1)]
+        self.range_pngs[os.path.abspath(pngs[0])] = pngs
+        return pngs[0]
+
+    def task_outputs(self, output_filename):
+        # A run of pages is queued under its first png, but writes them all
+        return self.range_pngs.get(os.path.abspath(output_filename)) or super().task_outputs(output_filename)
+
+    def _page_ranges(self, filename, page_list, resolutions):
+        """ Split the pages into runs of consecutive pages at the same resolution, no longer
+            than it takes to give every worker a share of the pages.  Pages that aren't going
+            to be ocr'ed are left out, each on its own.
+        """
+        max_pages = max(1, math.ceil(len(page_list) / max(1, Cmd.N_THREADS)))
+        ranges = []
+        for page in page_list:
+            res_x, res_y = resolutions[page][0:2]
+            device = self.page_device(page)
+            skipped = self.skipped_page(f'{filename}_{page}.png')
+            if (not skipped and ranges and ranges[-1][4] is None and ranges[-1][1] == page - 1
+                    and ranges[-1][2:4] == [res_x, res_y] and ranges[-1][5] == device
+                    and ranges[-1][1] - ranges[-1][0] + 1 < max_pages):
+                ranges[-1][1] = page
+            else:
+                ranges.append([page, page, res_x, res_y, skipped, device])
+        return [(first, last, res_x, res_y) for first, last, res_x, res_y, _, _ in ranges]
+
+    def _check_device(self):
+        if self.config['device'] not in ['auto'] + PNG_DEVICES:
+            self.error(f'--{self.name}-device must be one of gs\'s png devices: {", ".join(PNG_DEVICES)}')
 
+    def page_device(self, page):
+        """ The gs device to render the page with
+        """
+        if self.config['device'] != 'auto':
+            return self.config['device']
+        return DEVICES.get(self.colors.get(page), 'png16m')
+
+    async def get_pages(self, item_list, analysis_item_list):
+        self._check_device()
+        self.resolutions = await self._read_resolutions(analysis_item_list)
+        self.colors = await self._read_colors(analysis_item_list)
+        return sorted(self.resolutions.keys())
+
+    async def run_page(self, page, item_list, analysis_item_list):
+        item = item_list[0]
+        filename, filext = os.path.splitext(item)
+        res_x, res_y = self.resolutions[page][0:2]
+        output_filename = f'{filename}_{page}.png'
+        if not self.skip:
+            await self.call_ghostscript(item, page, output_filename, res_x, res_y)
+            await self.add_message(f'page {page} at {res_x}x{res_y}')
+        return output_filename
+
+    async def _read_resolutions(self, analysis_item_list):
+        with analysis_item_list as items:
+            for item in items:
+                resolutions = await self.read_yaml_from_file(item)
+        return resolutions
+
+    async def _read_colors(self, analysis_item_list):
+        """ The colours each page needs (written by analyze next to the resolutions), by page
+        """
+        with analysis_item_list as items:
+            colors_filename = self._change_ext(items[-1], 'colors')
+        if not os.path.exists(colors_filename):
+            return {}   # From an older run, so render everything in colour as before
+        return await self.read_yaml_from_file(colors_filename)
+
+    async def call_ghostscript_range(self, item, first, last, filename, res_x, res_y):
+        """ Render pages first to last with one gs, into the usual {filename}_{page}.png files
+        """
+        if first == last:
+            return await self.call_ghostscript(item, first, f'{filename}_{first}.png', res_x, res_y)
+        if self.keep_in_memory():
+            # gs writes the pages one after another to stdout
+            cmd = f'{self.executable} -q -sstdout=%stderr -dNOPAUSE -dFirstPage={first} -dLastPage={last} -sOutputFile=- -sDEVICE={self.page_device(first)} -r{res_x}x{res_y} "{item}" -c quit'
+            pngs = split_pngs(await self._run_command(cmd, pipe=True))
+            assert len(pngs) == last - first + 1, f'gs rendered {len(pngs)} pages instead of pages {first} to {last}'
+            for page, png in zip(range(first, last + 1), pngs):
+                await self.write_page_file(f'{filename}_{page}.png', png)
+            return
+        # gs numbers the pages it writes from 1
+        output_pattern = f'{filename}_gs{first}_%d.png'
+        cmd = f'{self.executable} -q -dNOPAUSE -dFirstPage={first} -dLastPage={last} -sOutputFile="{output_pattern}" -sDEVICE={self.page_device(first)} -r{res_x}x{res_y} "{item}" -c quit'
+        await self._run_command(cmd)
+        for i, page in enumerate(range(first, last + 1), start=1):
+            os.replace(output_pattern.replace('%d', str(i)), f'{filename}_{page}.png')
 
     async def call_ghostscript(self, item, page, output_filename, res_x, res_y):
-        cmd = f'{self.executable} -q -dNOPAUSE -dFirstPage={page} -dLastPage={page} -sOutputFile="{output_filename}" -sDEVICE=png16m -r{res_x}x{res_y} "{item}" -c quit'
-        await self._run_command(cmd)
\ No newline at end of file
+        if self.skipped_page(output_filename):
+            # The page already has text, so there's nothing to ocr; leave a placeholder
+            await self.write_page_file(output_filename, b'')
+            return
+        if self.keep_in_memory():
+            cmd = f'{self.executable} -q -sstdout=%stderr -dNOPAUSE -dFirstPage={page} -dLastPage={page} -sOutputFile=- -sDEVICE={self.page_device(page)} -r{res_x}x{res_y} "{item}" -c quit'
+            await self.write_page_file(output_filename, await self._run_command(cmd, pipe=True))
+            return
+        cmd = f'{self.executable} -q -dNOPAUSE -dFirstPage={page} -dLastPage={page} -sOutputFile="{output_filename}" -sDEVICE={self.page_device(page)} -r{res_x}x{res_y} "{item}" -c quit'
+        await self._run_command(cmd)
+
+
+def split_pngs(data):
+    """ Split the pngs gs writes back to back (one per page) on stdout, by walking their chunks
+    """
+    pngs = []
+    start = 0
+    while start < len(data):
+        position = start + 8    # Past the signature
+        while True:
+            length, chunk_type = struct.unpack('>I4s', data[position:position+8])
+            position += 8 + length + 4  # Length and type, data, crc
+            if chunk_type == b'IEND':
+                break
+        pngs.append(data[start:position])
+        start = position
+    return pngs
@@ -1,4 +1,4 @@
-import logging, os, platform, yaml, math
+import logging, os, platform, yaml, math, io, shutil
 from reportlab.pdfgen.canvas import Canvas
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.enums import TA_LEFT
@@ -20,6 +20,7 @@ class Plugin(Cmd):
     desc = 'Merge text overlays with original pdf to generate final pdf'
     stage = 'merge_overlay'
     inputs_from = ['create_overlay', 'setup']
+    in_memory = True
     
     options = []
 
@@ -27,8 +28,9 @@ class Plugin(Cmd):
         return
 
     async def run(self, item_list, orig_pdf_filename_list):
-        # First, create a pdf of merged text pages from items
-        logger.info("Creating a single PDF file containing all pages of just the text")
+        # Merge the text pages onto the original pages in chunks, one per worker process,
+        # then concatenate the chunks into the final pdf
+        logger.info("Merging the text overlays onto the original pages")
         next_items = ItemList()
 
         with orig_pdf_filename_list as items:
@@ -37,138 +39,93 @@ class Plugin(Cmd):
 
 
         output_pdf_filename = self._change_ext(orig_pdf_filename, 'ocr.pdf')
-        if not self.skip:
+        if not self.skip and len(item_list) == 0:
+            # No pages, so nothing to merge (or to split into chunks)
+            await curio.run_in_thread(shutil.copyfile, orig_pdf_filename, output_pdf_filename)
+        elif not self.skip:
             with item_list as items:
-                merged_filename = self._change_ext(orig_pdf_filename, 'text.pdf')
+                text_pdf_filenames = list(items)
+            # What to do with each page: None to merge its text, or 'keep'/'drop' if it wasn't ocr'ed
+            actions = [self.skipped_page(f) for f in text_pdf_filenames]
+            # The overlays kept in memory go to the worker processes as they are
+            text_pdfs = [Cmd.page_store.get(f) if Cmd.page_store is not None and f in Cmd.page_store else f
+                         for f in text_pdf_filenames]
+            n_chunks = max(1, min(len(text_pdf_filenames), Cmd.N_PROCESSES))
+            chunk_size = math.ceil(len(text_pdf_filenames) / n_chunks)
+            for i, first_page in enumerate(range(0, len(text_pdf_filenames), chunk_size)):
+                chunk_filename = self._change_ext(orig_pdf_filename, f'chunk{i}.pdf')
+                await self.add_to_queue(chunk_filename, self.merge_chunk, orig_pdf_filename, first_page,
+                                        text_pdfs[first_page:first_page+chunk_size],
+                                        actions[first_page:first_page+chunk_size], chunk_filename)
+            chunk_filenames = await self.run_queue()
+            await curio.run_in_thread(concatenate_pdfs, chunk_filenames, output_pdf_filename)
+            for chunk_filename in chunk_filenames:
+                os.remove(chunk_filename)
 
-                await self._merge_text_pdfs(items, merged_filename)
-                writer = PdfFileWriter()
-                with open(orig_pdf_filename, 'rb') as orig_pdf, \
-                    open(merged_filename, 'rb') as text_pdf:
-
-                    for orig_page, text_page in   \
-                        self.iterate_with_progress(zip(self.iter_pdf_page(orig_pdf),
-                            self.iter_pdf_page(text_pdf)), total=len(items)):
-
-                        orig_pg = self._get_merged_single_page(orig_page, text_page)
-                        writer.addPage(orig_pg)
-                
-                    with open(output_pdf_filename, 'wb') as f:
-                        writer.write(f)
-                # remove the intermediate .text.pdf file
-                os.remove(merged_filename)
-
-        next_items.append(output_pdf_filename)
-        return next_items
-
-    async def run_new(self, item_list, orig_pdf_filename_list):
-        # First, create a pdf of merged text pages from items
-        logger.info("Creating a single PDF file containing all pages of just the text")
-        next_items = ItemList()
-
-        with orig_pdf_filename_list as items:
-            assert len(items) == 1
-            orig_pdf_filename = items[0]
-
-
-        output_pdf_filename = self._change_ext(orig_pdf_filename, 'ocr.pdf')
-        if not self.skip:
-            orig_page_filenames = self._split_into_pages(orig_pdf_filename)
-            with item_list as items:
-                for i, (text_pdf_page_filename, orig_pdf_page_filename) in enumerate(zip(items, orig_page_filenames)):
-                    merged_page_filename = self._change_ext(text_pdf_page_filename, 'merged.pdf')
-                    await self.add_to_queue(merged_page_filename, self.merge_overlay_page_wrapper, i, text_pdf_page_filename, orig_pdf_page_filename, merged_page_filename)
-
-                merged_filenames = await self.run_queue()
-            await self._merge_text_pdfs(merged_filenames, output_pdf_filename)
-            for fn in merged_filenames+orig_page_filenames:
-                os.remove(fn)
         next_items.append(output_pdf_filename)
         return next_items
 
-    def _split_into_pages(self, pdf_filename):
-        """Take a pdf and make separate PDF files for each page
-        """
-        pdf = PdfFileReader(pdf_filename)
-        output_filenames = []
-        for page_num in range(pdf.getNumPages()):
-            pdf_writer = PdfFileWriter()
-            pdf_writer.addPage(pdf.getPage(page_num))
-
-            output_filename = self._change_ext(pdf_filename, f'_{page_num}.orig.pdf')
-            output_filenames.append(output_filename)
-            with open(output_filename, 'wb') as f:
-                pdf_writer.write(f)
-        return output_filenames
-            
-
-    async def merge_overlay_page_wrapper(self, page_num, text_pdf_page_filename, orig_pdf_filename, merged_page_filename):
-        await curio.run_in_thread(self.merge_overlay_page, page_num, text_pdf_page_filename, orig_pdf_filename, merged_page_filename)
-
-    def merge_overlay_page(self, page_num, text_pdf_page_filename, orig_pdf_page_filename, merged_page_filename):
-
-        with open(text_pdf_page_filename, 'rb') as text_pdf_page_file, \
-             open(orig_pdf_page_filename, 'rb') as orig_pdf_page_file:
-            text_page = self._get_first_page(text_pdf_page_file)
-            orig_page = self._get_first_page(orig_pdf_page_file)
-            # merge the two files
-            self._write_merged_single_page(orig_page, text_page, merged_page_filename)
-            #await curio.run_in_thread(self._write_merged_single_page,orig_page, text_page, merged_page_filename)
-
-    def _get_first_page(self, pdf_file):
-        all_pages = PdfFileReader(pdf_file)
-        first_page = all_pages.getPage(0)
-        return first_page
-
-    def _write_merged_single_page(self, orig_page, text_page, merged_filename):
-        # Call _get_merged_single_page and write it to a file
-        writer = PdfFileWriter()
-        writer.addPage(self._get_merged_single_page(orig_page, text_page))
-        with open(merged_filename, 'wb') as f:
-            writer.write(f)
-
-    async def _merge_text_pdfs(self, items, output_filename):
-        merger = PdfFileMerger()
-        for item in items:
-            logger.debug(f'Concatenating {item}')
-            merger.append(PdfFileReader(item))
-        logger.debug(f'Writing merged pdf {output_filename}')
-        merger.write(output_filename)
-        merger.close()
-        del merger
-
-    def _get_merged_single_page(self, original_page, ocr_text_page):
-        """
-            Take two page objects, rotate the text page if necessary, and return the merged page
-        """
-        orig_rotation_angle = int(original_page.get('/Rotate', 0))
-
-        if orig_rotation_angle != 0:
-            logger.info("Original Rotation: %s" % orig_rotation_angle)
-            logger.debug(f'OCR page dimensions:  Width {ocr_text_page.mediaBox.getWidth()}, Height {ocr_text_page.mediaBox.getHeight()}')
-            logger.debug(f'Org page dimensions:  Width {original_page.mediaBox.getWidth()}, Height {original_page.mediaBox.getHeight()}')
-
-            # Some nasty code to do the translations when rotating
-            w = ocr_text_page.mediaBox.getWidth()/2
-            h = ocr_text_page.mediaBox.getHeight()/2
-            transforms = { 270: (w,w),
-                           180: (w,h),
-                           90:  (h,h),
-                         }
-
-            original_page.mergeRotatedTranslatedPage(ocr_text_page, 
-                         orig_rotation_angle, 
-                         transforms[orig_rotation_angle][0],
-                         transforms[orig_rotation_angle][1],
-                         True)  # Change this to True to expand page (useful for debugging off margin placements)
-
-        else:
-            original_page.mergePage(ocr_text_page)
-        original_page.compressContentStreams()
-        return original_page
-
-    def iter_pdf_page(self, f):
-        reader = PdfFileReader(f)
-        for pgnum in range(reader.getNumPages()):
-            pg = reader.getPage(pgnum)
-            yield pg
+    async def merge_chunk(self, orig_pdf_filename, first_page, text_pdfs, actions, chunk_filename):
+        await self.run_cpu_bound(merge_pages, orig_pdf_filename, first_page, text_pdfs, actions, chunk_filename)
+
+
+def merge_pages(orig_pdf_filename, first_page, text_pdfs, actions, output_filename):
+    """ Merge each text pdf (a filename, or its contents if it was kept in memory) onto its
+        page of the original, starting from first_page, and write just those pages to
+        output_filename.  Pages that weren't ocr'ed are copied as they are ('keep') or left
+        out ('drop').  Runs in a worker process.
+    """
+    orig_pdf = PdfFileReader(orig_pdf_filename)
+    writer = PdfFileWriter()
+    for i, (text_pdf, action) in enumerate(zip(text_pdfs, actions)):
+        original_page = orig_pdf.getPage(first_page + i)
+        if action == 'drop':
+            continue
+        if action == 'keep':
+            writer.addPage(original_page)
+            continue
+        text_page = PdfFileReader(io.BytesIO(text_pdf) if isinstance(text_pdf, bytes) else text_pdf).getPage(0)
+        writer.addPage(merge_page(original_page, text_page))
+    with open(output_filename, 'wb') as f:
+        writer.write(f)
+
+
+def concatenate_pdfs(filenames, output_filename):
+    merger = PdfFileMerger()
+    for filename in filenames:
+        logger.debug(f'Concatenating {filename}')
+        merger.append(PdfFileReader(filename))
+    logger.debug(f'Writing merged pdf {output_filename}')
+    merger.write(output_filename)
+    merger.close()
+
+
+def merge_page(original_page, ocr_text_page):
+    """
+        Take two page objects, rotate the text page if necessary, and return the merged page
+    """
+    orig_rotation_angle = int(original_page.get('/Rotate', 0))
+
+    if orig_rotation_angle != 0:
+        logger.info("Original Rotation: %s" % orig_rotation_angle)
+        logger.debug(f'OCR page dimensions:  Width {ocr_text_page.mediaBox.getWidth()}, Height {ocr_text_page.mediaBox.getHeight()}')
+        logger.debug(f'Org page dimensions:  Width {original_page.mediaBox.getWidth()}, Height {original_page.mediaBox.getHeight()}')
+
+        # Some nasty code to do the translations when rotating
+        w = ocr_text_page.mediaBox.getWidth()/2
+        h = ocr_text_page.mediaBox.getHeight()/2
+        transforms = { 270: (w,w),
+                       180: (w,h),
+                       90:  (h,h),
+                     }
+
+        original_page.mergeRotatedTranslatedPage(ocr_text_page, 
+                     orig_rotation_angle, 
+                     transforms[orig_rotation_angle][0],
+                     transforms[orig_rotation_angle][1],
+                     True)  # Change this to True to expand page (useful for debugging off margin placements)
+
+    else:
+        original_page.mergePage(ocr_text_page)
+    original_page.compressContentStreams()
+    return original_page
@@ -0,0 +1,76 @@
+import logging, os
+
+import yaml
+import curio
+
+from ..command import Cmd
+from ..item import ItemList
+from .. import libtesseract
+
+logger = logging.getLogger(__name__)
+
+"""
+    Run ocr with a pool of tesseract engines loaded in-process
+"""
+
+class Plugin(Cmd):
+
+    name = 'ocr_libtesseract'
+    desc = 'Run ocr using libtesseract engines kept loaded between pages'
+    stage = 'ocr'
+    inputs_from = ['image']
+    per_page = True
+    default = False     # Use with --plugins=ocr_libtesseract
+
+    options = ["--ocr_libtesseract-lang=LANG         language(s) to recognize [default: eng]",
+               "--ocr_libtesseract-library=PATH      path to libtesseract, if it isn't on the library path",
+               "--ocr_libtesseract-datapath=DIR      directory with the traineddata files",
+    ]
+
+    def _find_executable(self):
+        return
+
+    def tool_version(self):
+        return f'libtesseract {self.pool.lib.TessVersion().decode()} {self.config["lang"]}'
+
+    @property
+    def pool(self):
+        # Shared by every document, so the engines stay loaded for the whole run
+        return libtesseract.get_pool(self.config.get('library'), Cmd.N_THREADS, self.config['lang'],
+                                     self.config.get('datapath'), libtesseract.PSM_AUTO_OSD)
+
+    async def run(self, item_list):
+        logger.info(f'About to run libtesseract on {item_list}')
+        with item_list as items:
+            for item in items:
+                loc_filename = self._change_ext(item, 'loc')
+                await self.add_to_queue(loc_filename, self.recognize, item, loc_filename)
+            return await self.run_queue()
+
+    async def run_page(self, page, item):
+        loc_filename = self._change_ext(item, 'loc')
+        if not self.skip:
+            await self.recognize(item, loc_filename)
+        return loc_filename
+
+    async def recognize(self, item, loc_filename):
+        """ Write the words on the page straight out in the text_process format (a .loc file),
+            so there's no tsv to write and parse back
+        """
+        try:
+            if self.skipped_page(item):
+                text_locations = {}
+                with open(loc_filename, 'w') as loc_file:
+                    yaml.dump(text_locations, loc_file)
+                return
+            if self.cache:
+                key = await self.cache_key(item, 'psm 1')
+                if self.cache.get(key, 'loc', loc_filename):
+                    return
+            text_locations = await curio.run_in_thread(self.pool.run, 'words', item)
+            with open(loc_filename, 'w') as loc_file:
+                yaml.dump(text_locations, loc_file)
+            if self.cache:
+                self.cache.put(key, 'loc', loc_filename)
+        except (OSError, RuntimeError) as e:
+            self.error(f'libtesseract OCR could not be run on {item}: {e}')
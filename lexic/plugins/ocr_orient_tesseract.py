@@ -0,0 +1,99 @@
+import logging, os, re, subprocess
+from collections import Counter
+
+from ..command import Cmd
+from ..item import ItemList
+from .ocr_tesseract import TSV_HEADER
+
+logger = logging.getLogger(__name__)
+
+"""
+    Find the orientation and run ocr in the same tesseract run, instead of analyzing each page twice
+"""
+
+class Plugin(Cmd):
+
+    name = 'ocr_orient_tesseract'
+    desc = 'Find page orientation and run ocr in a single tesseract pass'
+    stage = 'ocr'
+    inputs_from = ['image']
+    per_page = True
+    default = False                     # Use with --plugins=ocr_orient_tesseract
+    also_provides = {'orient': 'ang'}   # Replaces the orient step
+
+    # psm 1 does orientation detection anyway, and the hocr output has the angle of each line
+    tesseract_args = '--psm 1 tsv hocr'
+    # When the pages are known to be upright, psm 3 skips orientation detection altogether
+    upright_tesseract_args = '--psm 3 tsv'
+
+    options = ["--ocr_orient_tesseract-program=PROGRAM  path to Tesseract program [default: tesseract]",
+               "--ocr_orient_tesseract-upright          pages are known to be upright, so skip orientation detection",
+    ]
+
+    async def run(self, item_list):
+        logger.info(f'About to run tesseract with orientation detection on {item_list}')
+        with item_list as items:
+            for i, item in enumerate(items):
+                tsv_filename = self._change_ext(item, 'tsv')
+                await self.add_to_queue(tsv_filename, self.call_tesseract, i, item)
+            return await self.run_queue()
+
+    async def run_page(self, page, item):
+        tsv_filename = self._change_ext(item, 'tsv')
+        if not self.skip:
+            await self.call_tesseract(page-1, item)
+        return tsv_filename
+
+    async def call_tesseract(self, i, item):
+        """ Write the page's .tsv and its orientation in degrees (.ang) from one tesseract run
+        """
+        basename = os.path.splitext(self._change_ext(item, 'tsv'))[0]
+        try:
+            if self.skipped_page(item):
+                with open(f'{basename}.tsv', 'w', encoding='utf8') as f:
+                    f.write(TSV_HEADER)
+                angle = 0
+                msg = f'page {i+1} - blank or already has text, skipped ocr'
+            elif self.config['upright']:
+                await self._run_tesseract(item, basename, self.upright_tesseract_args, ['tsv'])
+                angle = 0
+                msg = f'page {i+1} - upright, skipped orientation detection'
+            else:
+                await self._run_tesseract(item, basename, self.tesseract_args, ['tsv', 'hocr'])
+                angle = self._parse_angle(f'{basename}.hocr')
+                msg = f'page {i+1} - parsed orientation as {angle} degrees'
+        except (subprocess.CalledProcessError, IOError):
+            self.error("Tesseract OCR could not be executed")
+        finally:
+            if os.path.exists(f'{basename}.hocr'):
+                os.remove(f'{basename}.hocr')
+        logger.debug(msg)
+        await self.add_message(msg)
+        await self.write_yaml_to_file(f'{basename}.ang', angle)
+
+    async def _run_tesseract(self, item, basename, tesseract_args, exts):
+        if self.cache:
+            key = await self.cache_key(item, tesseract_args)
+            if all(self.cache.get(key, ext, f'{basename}.{ext}') for ext in exts):
+                return
+        await self._run_command(f'{self.executable} {item} {basename} {tesseract_args}')
+        if self.cache:
+            for ext in exts:
+                self.cache.put(key, ext, f'{basename}.{ext}')
+
+    def _parse_angle(self, hocr_filename):
+        """ Return the orientation of the page in degrees, the same as 'Orientation in degrees'
+            in tesseract's OSD output.
+
+            Lines that aren't upright have a 'textangle' in hocr, which is the counter-clockwise
+            angle of the text (360 minus the orientation).  Go with what most lines say.
+        """
+        with open(hocr_filename, encoding='utf8') as f:
+            hocr = f.read()
+        angles = Counter()
+        for title in re.findall(r"class=['\"]ocr_(?:line|header|caption|textfloat)['\"][^>]*title=['\"]([^'\"]*)", hocr):
+            match = re.search(r'textangle (\d+)', title)
+            angles[(360 - int(match.group(1))) % 360 if match else 0] += 1
+        if not angles:
+            return 0
+        return angles.most_common(1)[0][0]
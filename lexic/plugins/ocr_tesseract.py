@@ -1,9 +1,10 @@
-import logging, os, subprocess, traceback
+import logging, os, subprocess, traceback, math
 
 from tenacity import retry
 
 from ..command import Cmd
 from ..item import ItemList
+from .text_process_tsv import tsv_words
 
 logger = logging.getLogger(__name__)
 
@@ -11,55 +12,376 @@ logger = logging.getLogger(__name__)
     Run ocr
 """
 
+# What tesseract writes for a page without any text
+TSV_HEADER = 'level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext\n'
+
 class Plugin(Cmd):
 
     name = 'ocr_tesseract'
     desc = 'Run ocr using tesseract'
     stage = 'ocr'
     inputs_from = ['image']
+    per_page = True
+    in_memory = True
     
+    tesseract_args = '--psm 1 tsv'
+
     options = ["--ocr_tesseract-program=PROGRAM    path to Tesseract program [default: tesseract]",
                "--ocr_tesseract-aws                run in cloud",
-               "--ocr_tesseract-awsurl=URL         endpoint to use for aws"
+               "--ocr_tesseract-awsurl=URL         endpoint to use for aws (or lexic workers, with a comma-separated list of urls)",
+               "--ocr_tesseract-batch              run tesseract once per batch of pages instead of once per page (not with --stream)",
+               "--ocr_tesseract-recompress         upload pages to aws as losslessly recompressed grayscale or black and white images when they are",
+               "--ocr_tesseract-cascade            ocr each page with a fast pass first, and only redo the pages it isn't confident about (not with -batch or -aws)",
+               "--ocr_tesseract-fast_scale=FRACTION  resolution of the fast pass, as a fraction of the page's [default: 0.5]",
+               "--ocr_tesseract-fast_args=ARGS     extra tesseract options for the fast pass, e.g. '--tessdata-dir /usr/share/tessdata_fast'",
+               "--ocr_tesseract-min_conf=CONF      redo pages whose words have a lower average confidence than this in the fast pass [default: 85]",
     ]
 
+    def __init__(self, config, skip=False):
+        super().__init__(config, skip)
+        self.redone_pages = []  # Pages the fast pass of the cascade wasn't good enough for
+        self.n_requests = 0     # Remote requests sent so far, to take turns between the urls
+        self.batch_tsvs = {}    # First tsv of a batch => all the tsvs its task writes
+        self.warned_batch = False
+
+    @property
+    def tool(self):
+        # Remote OCR doesn't use local cpu, so the scheduler treats it separately
+        if self.config['aws']:
+            return 'remote'
+        return super().tool
+
+    @property
+    def pipe_pages(self):
+        """ Whether the pages are piped through tesseract, with --in_memory (the cache, remote,
+            batch and cascade modes all need the images and tsvs as files)
+        """
+        modes = ['aws', 'batch', 'cascade']
+        return self.keep_in_memory() and not self.cache and not any(self.config[mode] for mode in modes)
+
     async def run(self, item_list):
         logger.info(f'About tesseract {item_list}')
+        if not self.pipe_pages:
+            await self.materialise(item_list)
 
         with item_list as items:
-            n_items = len(items)
-            old_n_threads = self.N_THREADS
             if self.config['aws']:
-                self.N_THREADS=n_items
                 assert self.config['awsurl'] is not None, 'URL for AWS services not specified'
+            for mode in ['batch', 'aws']:
+                self._check_cascade(mode)
+            if self.config['batch']:
+                outputs = await self.run_batched(items)
+            else:
+                for item in items:
+                    basename = self._get_filename_base(item)
+                    tsv_filename = self._change_ext(item, 'tsv')
+                    if self.config['aws']:
+                        run_method = self.call_tesseract_aws
+                    else:
+                        run_method = self.call_tesseract
+                    await self.add_to_queue(tsv_filename, run_method, item, basename)
+                outputs = await self.run_queue()
+
+            if self.transfers:
+                summary = self.transfer_summary()
+                logger.info(summary)
+                await self.add_message(summary)
+            if self.config['cascade'] and not self.skip:
+                await self.add_message(f'{len(self.redone_pages)} of {len(items)} pages needed the full ocr pass')
+            return outputs
+
+    async def run_page(self, page, item):
+        basename = self._get_filename_base(item)
+        tsv_filename = self._change_ext(item, 'tsv')
+        if not self.skip:
+            if self.config['batch'] and not self.warned_batch:
+                # Only called with --stream, where each page moves on as soon as it's done
+                logger.warning('Ignoring --ocr_tesseract-batch with --stream, which ocrs one page at a time')
+                self.warned_batch = True
+            if not self.pipe_pages:
+                await self.materialise(item)
+            self._check_cascade('aws')
+            if self.config['aws']:
+                assert self.config['awsurl'] is not None, 'URL for AWS services not specified'
+                await self.call_tesseract_aws(item, basename)
+            else:
+                await self.call_tesseract(item, basename)
+        return tsv_filename
+
+    def _check_cascade(self, mode):
+        """ The cascade is only done page by page and locally, so stop if it's asked for with mode
+        """
+        if self.config['cascade'] and self.config[mode]:
+            self.error(f'--ocr_tesseract-cascade cannot be used with --ocr_tesseract-{mode}')
 
-            for item in items:
-                basename = self._get_filename_base(item)
+    async def run_batched(self, items):
+        """ Split the pages into one batch per worker, and OCR each batch with a single
+            tesseract process, so its startup and model loading happen once per batch
+        """
+        tsv_filenames = [self._change_ext(item, 'tsv') for item in items]
+        if not self.skip and items:
+            n_batches = max(1, min(len(items), Cmd.N_THREADS))
+            batch_size = math.ceil(len(items) / n_batches)
+            list_dir = os.path.dirname(os.path.abspath(items[0]))
+            batch_method = self.call_tesseract_aws_batch if self.config['aws'] else self.call_tesseract_batch
+            list_filenames = []
+            for i, start in enumerate(range(0, len(items), batch_size)):
+                list_filename = os.path.join(list_dir, f'ocr_batch{i}.txt')
+                list_filenames.append(list_filename)
+                # Queued under the batch's tsvs, so incremental runs skip the batches that are up to date
+                batch_tsvs = tsv_filenames[start:start+batch_size]
+                self.batch_tsvs[os.path.abspath(batch_tsvs[0])] = batch_tsvs
+                await self.add_to_queue(batch_tsvs[0], batch_method, items[start:start+batch_size], list_filename)
+            await self.run_queue()
+            for list_filename in list_filenames:
+                if os.path.exists(list_filename):
+                    os.remove(list_filename)
+        return ItemList(tsv_filenames)
+
+    def task_outputs(self, output_filename):
+        # A batch is queued under its first tsv, but writes them all
+        return self.batch_tsvs.get(os.path.abspath(output_filename)) or super().task_outputs(output_filename)
+
+    async def call_tesseract_batch(self, batch, list_filename):
+        """ OCR every image in batch with one tesseract run (it takes a file listing the
+            images), and split the combined tsv back into a .tsv per image by page_num
+        """
+        try:
+            todo = []
+            for item in batch:
                 tsv_filename = self._change_ext(item, 'tsv')
-                if self.config['aws']:
-                    run_method = self.call_tesseract_aws
-                else:
-                    run_method = self.call_tesseract
-                await self.add_to_queue(tsv_filename, run_method, item, basename)
+                if self.write_skipped_tsv(item, tsv_filename):
+                    continue
+                key = None
+                if self.cache:
+                    key = await self.cache_key(item, *self.cache_args)
+                    if self.cache.get(key, 'tsv', tsv_filename):
+                        continue
+                todo.append((item, tsv_filename, key))
 
-            out_filenames = await self.run_queue()
-            self.N_THREADS = old_n_threads
-            
-            return out_filenames
+            with open(list_filename, 'w') as f:
+                f.writelines(f'{os.path.abspath(item)}\n' for item, _, _ in todo)
+            if not todo:
+                return
+            basename = os.path.splitext(list_filename)[0]
+            await self._run_command(f'{self.executable} {list_filename} {basename} {self.tesseract_args}')
+            self._split_tsv(f'{basename}.tsv', [tsv_filename for _, tsv_filename, _ in todo])
+            os.remove(f'{basename}.tsv')
+            if self.cache:
+                for item, tsv_filename, key in todo:
+                    self.cache.put(key, 'tsv', tsv_filename)
+        except (subprocess.CalledProcessError, IOError):
+            self.error("Tesseract OCR could not be executed")
+
+    async def call_tesseract_aws_batch(self, batch, list_filename):
+        """ OCR a batch of images remotely with one request, which runs a tesseract per image
+        """
+        todo = [item for item in batch if not self.write_skipped_tsv(item, self._change_ext(item, 'tsv'))]
+        if not todo:
+            return
+        uploads = await self.upload_files(todo)
+        cmds = [f'{self.executable} {os.path.basename(upload)} {self._get_filename_base(item)} {self.tesseract_args}'
+                for item, upload in zip(todo, uploads)]
+        try:
+            await self.run_command_aws(cmds, uploads, [self._change_ext(item, 'tsv') for item in todo], self.aws_url())
+        except Exception as e:
+            print(str(e))
+            print(f"ERROR: Tesseract OCR could not be executed on {', '.join(todo)}")
+            traceback.print_exc()
+        finally:
+            self.remove_uploads(todo, uploads)
+
+    async def upload_files(self, items):
+        """ The files to upload to OCR items remotely: smaller copies of the images that
+            recompress to fewer bits per pixel with --ocr_tesseract-recompress, or the images
+        """
+        if not self.config['recompress']:
+            return list(items)
+        return [await self.run_cpu_bound(recompress_image, item, self._change_ext(item, f'up{self._get_filename_ext(item)}'))
+                for item in items]
+
+    def remove_uploads(self, items, uploads):
+        for item, upload in zip(items, uploads):
+            if upload != item and os.path.exists(upload):
+                os.remove(upload)
+
+    def aws_url(self):
+        """ The endpoint to send the next request (a page or a batch of them) to, taking turns
+            between the urls given
+        """
+        urls = [url.strip().rstrip('/') for url in self.config['awsurl'].split(',')]
+        self.n_requests += 1
+        return urls[(self.n_requests - 1) % len(urls)]
+
+    def _split_tsv(self, combined_filename, tsv_filenames):
+        """ Write the rows for page_num n of the combined tsv (the nth image in the list)
+            to tsv_filenames[n-1], each with the header
+        """
+        with open(combined_filename, encoding='utf8') as f:
+            lines = f.readlines()
+        header = lines[0]
+        page_num = header.strip().split('\t').index('page_num')
+        pages = [[] for _ in tsv_filenames]
+        for line in lines[1:]:
+            if line == header:
+                continue
+            fields = line.split('\t')
+            pages[int(fields[page_num])-1].append(line)
+        for tsv_filename, page_lines in zip(tsv_filenames, pages):
+            with open(tsv_filename, 'w', encoding='utf8') as f:
+                f.write(header)
+                f.writelines(page_lines)
+
+    @property
+    def cache_args(self):
+        """ What goes into the cache key with the image, besides the tool version
+        """
+        if self.config['cascade']:
+            return (self.tesseract_args, 'cascade', self.config['fast_scale'], self.config['fast_args'], self.config['min_conf'])
+        return (self.tesseract_args,)
+
+    def write_skipped_tsv(self, item, tsv_filename):
+        """ If the page doesn't need ocr (it's blank or already has text), write an empty tsv
+            for it instead of running tesseract, and return True
+        """
+        if not self.skipped_page(item):
+            return False
+        if self.pipe_pages:
+            Cmd.page_store.put(tsv_filename, TSV_HEADER.encode('utf8'))
+            return True
+        with open(tsv_filename, 'w', encoding='utf8') as f:
+            f.write(TSV_HEADER)
+        return True
 
     async def call_tesseract(self, item, basename):
         try:
-            cmd = f'{self.executable} {item} {basename} --psm 1 tsv'
-            await self._run_command(cmd)
+            # Write the output next to the image, regardless of the current directory
+            basename = os.path.join(os.path.dirname(os.path.abspath(item)), basename)
+            tsv_filename = f'{basename}.tsv'
+            if self.write_skipped_tsv(item, tsv_filename):
+                return
+            if self.pipe_pages:
+                tsv = await self._run_command(f'{self.executable} - stdout {self.tesseract_args}', pipe=True,
+                                              input=await self.read_page_file(item))
+                await self.write_page_file(tsv_filename, tsv)
+                return
+            if self.cache:
+                key = await self.cache_key(item, *self.cache_args)
+                if self.cache.get(key, 'tsv', tsv_filename):
+                    return
+            if not self.config['cascade'] or not await self.call_tesseract_fast(item, basename):
+                cmd = f'{self.executable} {item} {basename} {self.tesseract_args}'
+                await self._run_command(cmd)
+            if self.cache:
+                self.cache.put(key, 'tsv', tsv_filename)
         except (subprocess.CalledProcessError, IOError):
             self.error("Tesseract OCR could not be executed")
 
+    async def call_tesseract_fast(self, item, basename):
+        """ OCR a smaller copy of the page (and with the fast_args, e.g. the fast models).  If the
+            words it finds are confident enough, write them to the page's tsv (scaled back up to
+            the page's coordinates) and return True; otherwise the page needs the full pass.
+        """
+        scale = float(self.config['fast_scale'])
+        fast_image = item
+        if scale < 1:
+            fast_image = self._change_ext(item, f'fast{self._get_filename_ext(item)}')
+            await self.run_cpu_bound(scale_image, item, fast_image, scale)
+        fast_basename = f'{basename}.fast'
+        try:
+            await self._run_command(f'{self.executable} {fast_image} {fast_basename} --psm 1 {self.config["fast_args"] or ""} tsv')
+            confidence = page_confidence(f'{fast_basename}.tsv')
+            page = self._page_of(item)
+            # A page the fast pass finds no words on at all (e.g. blank) isn't worth a second try
+            if confidence is None or confidence >= float(self.config['min_conf']):
+                rescale_tsv(f'{fast_basename}.tsv', f'{basename}.tsv', 1 / min(scale, 1))
+                logger.debug(f'page {page} - fast pass confidence {confidence}, keeping it')
+                return True
+            logger.debug(f'page {page} - fast pass confidence {confidence:.1f}, redoing it with the full pass')
+            self.redone_pages.append(page)
+            return False
+        finally:
+            for filename in (f'{fast_basename}.tsv', fast_image if fast_image != item else None):
+                if filename and os.path.exists(filename):
+                    os.remove(filename)
+
     async def call_tesseract_aws(self, item, basename):
+        if self.write_skipped_tsv(item, self._change_ext(item, 'tsv')):
+            return
+        uploads = await self.upload_files([item])
         try:
             #print(f"Calling aws! {item}")
-            cmd = f'{self.executable} {os.path.basename(item)} {basename} --psm 1 tsv'
-            await self.run_command_aws(cmd, [item], [f'{basename}.tsv'], self.config['awsurl'] )
+            cmd = f'{self.executable} {os.path.basename(uploads[0])} {basename} {self.tesseract_args}'
+            await self.run_command_aws(cmd, uploads, [self._change_ext(item, 'tsv')], self.aws_url())
         except Exception as e:
             print(str(e))
             print(f"ERROR: Tesseract OCR could not be executed on {item}")
-            traceback.print_exc()
\ No newline at end of file
+            traceback.print_exc()
+        finally:
+            self.remove_uploads([item], uploads)
+
+
+def recompress_image(image_filename, out_filename):
+    """ Write the image to out_filename with as few bits per pixel as it takes to keep every
+        pixel the same (8 for a gray page rendered in colour, 1 for black and white), and return
+        it, or return image_filename if that isn't any smaller.  Runs in a worker process.
+    """
+    from PIL import Image, ImageChops
+
+    with Image.open(image_filename) as image:
+        dpi = image.info.get('dpi')
+        if image.mode in ('RGB', 'RGBA'):
+            red, green, blue = image.convert('RGB').split()
+            if ImageChops.difference(red, green).getbbox() is None and ImageChops.difference(red, blue).getbbox() is None:
+                image = red
+        if image.mode == 'L' and sum(image.histogram()[1:255]) == 0:
+            image = image.point(lambda value: 255 if value else 0).convert('1', dither=Image.Dither.NONE)
+        if image.mode not in ('L', '1'):
+            return image_filename   # Really in colour
+        image.save(out_filename, optimize=True, **({'dpi': dpi} if dpi else {}))
+    if os.path.getsize(out_filename) >= os.path.getsize(image_filename):
+        os.remove(out_filename)
+        return image_filename
+    return out_filename
+
+
+def scale_image(image_filename, out_filename, scale):
+    """ Write a copy of the image scaled by scale, with its resolution to match
+    """
+    from PIL import Image
+
+    with Image.open(image_filename) as image:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        # Black and white pages scale down to gray, rather than losing the thin strokes
+        scaled = image.convert('L' if image.mode == '1' else image.mode).resize(size, Image.Resampling.LANCZOS)
+        dpi = image.info.get('dpi')
+        scaled.save(out_filename, **({'dpi': (dpi[0] * scale, dpi[1] * scale)} if dpi else {}))
+
+
+def page_confidence(tsv_filename):
+    """ Return the average confidence of the words in a tesseract tsv, or None if there aren't any
+    """
+    with open(tsv_filename, encoding='utf8') as f:
+        lines = f.read().splitlines()
+    if not lines:
+        return None
+    confidences = [confidence for confidence, _, _ in tsv_words(lines)]
+    if not confidences:
+        return None
+    return sum(confidences) / len(confidences)
+
+
+def rescale_tsv(tsv_filename, out_filename, factor):
+    """ Copy a tesseract tsv, multiplying the word boxes by factor
+    """
+    with open(tsv_filename, encoding='utf8') as f:
+        lines = f.read().splitlines() or [TSV_HEADER.rstrip('\n')]
+    indices = {k: i for i, k in enumerate(lines[0].split('\t'))}
+    columns = [indices[name] for name in ('left', 'top', 'width', 'height')]
+    with open(out_filename, 'w', encoding='utf8') as f:
+        f.write(lines[0] + '\n')
+        for line in lines[1:]:
+            fields = line.split('\t')
+            for column in columns:
+                fields[column] = str(round(int(fields[column]) * factor))
+            f.write('\t'.join(fields) + '\n')
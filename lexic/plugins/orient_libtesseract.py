@@ -0,0 +1,71 @@
+import logging, os
+
+import curio
+
+from ..command import Cmd
+from ..item import ItemList
+from .. import libtesseract
+
+logger = logging.getLogger(__name__)
+
+"""
+    Find the rotation angle of each page with a pool of tesseract engines loaded in-process
+"""
+
+class Plugin(Cmd):
+
+    name = 'orientation_libtesseract'
+    desc = 'Find page orientation using libtesseract engines kept loaded between pages'
+    stage = 'orient'
+    inputs_from = ['image']
+    per_page = True
+    default = False     # Use with --plugins=orientation_libtesseract
+
+    options = ["--orientation_libtesseract-library=PATH   path to libtesseract, if it isn't on the library path",
+               "--orientation_libtesseract-datapath=DIR   directory with the osd traineddata file",
+    ]
+
+    def _find_executable(self):
+        return
+
+    def tool_version(self):
+        return f'libtesseract {self.pool.lib.TessVersion().decode()} osd'
+
+    @property
+    def pool(self):
+        return libtesseract.get_pool(self.config.get('library'), Cmd.N_THREADS, 'osd',
+                                     self.config.get('datapath'), libtesseract.PSM_OSD_ONLY)
+
+    async def run(self, item_list):
+        with item_list as items:
+            for i, item in enumerate(items):
+                angle_filename = self._change_ext(item, 'ang')
+                await self.add_to_queue(angle_filename, self.detect_orientation, i, item, angle_filename)
+            return await self.run_queue()
+
+    async def run_page(self, page, item):
+        angle_filename = self._change_ext(item, 'ang')
+        if not self.skip:
+            await self.detect_orientation(page-1, item, angle_filename)
+        return angle_filename
+
+    async def detect_orientation(self, i, item, angle_filename):
+        """ Write the page's orientation in degrees to angle_filename, defaulting to 0 if it
+            can't be detected
+        """
+        if self.skipped_page(item):
+            angle = None
+        else:
+            try:
+                angle = await curio.run_in_thread(self.pool.run, 'orientation', item)
+            except (OSError, RuntimeError) as e:
+                logger.debug(str(e))
+                angle = None
+        if angle is None:
+            msg = f'page {i+1} - cannot detect orientation, using 0 degrees as rotation angle'
+            angle = 0
+        else:
+            msg = f'page {i+1} - parsed orientation as {angle} degrees'
+        logger.debug(msg)
+        await self.add_message(msg)
+        await self.write_yaml_to_file(angle_filename, angle)
@@ -16,7 +16,11 @@ class Plugin(Cmd):
     desc = 'Find page orientation using tesseract'
     stage = 'orient'
     inputs_from = ['image']
+    per_page = True
+    in_memory = True
     
+    tesseract_args = '-l osd --psm 0'
+
     options = ["--orientation-program=PROGRAM  path to Orientation detect program [default: tesseract]"]
 
     
@@ -27,6 +31,12 @@ class Plugin(Cmd):
                 await self.add_to_queue(angle_filename, self.call_tesseract_for_osd, i, item, angle_filename)
                     
             return await self.run_queue()
+
+    async def run_page(self, page, item):
+        angle_filename = self._change_ext(item, 'ang')
+        if not self.skip:
+            await self.call_tesseract_for_osd(page-1, item, angle_filename)
+        return angle_filename
                 
     async def call_tesseract_for_osd(self, i, item, angle_filename):
         """ Runs tesseract with just the orientation and script detection
@@ -41,14 +51,25 @@ class Plugin(Cmd):
                 Script: Latin
                 Script confidence: 4.67
         """
-        basename = self._get_filename_base(item)
-        cmd = f'{self.executable} {item} {basename} -l osd --psm 0'
+        if self.skipped_page(item):
+            await self.add_message(f'page {i+1} - blank or already has text, using 0 degrees as rotation angle')
+            await self.write_yaml_to_file(angle_filename, 0)
+            return
+        osd_file = self._change_ext(item, 'osd')
+        basename, _ = os.path.splitext(osd_file)
+        cmd = f'{self.executable} {item} {basename} {self.tesseract_args}'
         logger.debug(cmd)
         try:
-            osd_file = self._change_ext(item, 'osd')
-            await self._run_command(cmd)
-            with open(osd_file) as f:
-                lines = f.readlines()
+            if self.keep_in_memory() and not self.cache:
+                # Pipe the image in and the OSD output back, with no files on either side
+                osd = await self._run_command(f'{self.executable} - - {self.tesseract_args}', pipe=True,
+                                              input=await self.read_page_file(item))
+                lines = osd.decode('utf-8').splitlines()
+            else:
+                await self.materialise(item)
+                await self._run_osd(cmd, item, osd_file)
+                with open(osd_file) as f:
+                    lines = f.readlines()
             angle = -1
             for line in lines:
                 if line.startswith('Orientation in degrees'):
@@ -72,4 +93,14 @@ class Plugin(Cmd):
             if os.path.exists(osd_file):
                 os.remove(osd_file)
 
-        await self.write_yaml_to_file(angle_filename, angle)
\ No newline at end of file
+        await self.write_yaml_to_file(angle_filename, angle)
+
+    async def _run_osd(self, cmd, item, osd_file):
+        # Reuse the OSD output from the cache if we've seen this image before
+        if self.cache:
+            key = await self.cache_key(item, self.tesseract_args)
+            if self.cache.get(key, 'osd', osd_file):
+                return
+        await self._run_command(cmd)
+        if self.cache:
+            self.cache.put(key, 'osd', osd_file)
\ No newline at end of file
@@ -1,4 +1,4 @@
-import logging, os, platform, shutil
+import logging, os, platform, shutil, filecmp, hashlib
 
 from ..command import Cmd
 from ..item import ItemList
@@ -32,7 +32,12 @@ class Plugin(Cmd):
 
         # Create the temp directory
 
-        base_tgtdir = os.path.join(dirname, base_filename)
+        if self.scratch_dir:
+            # Everything shares --scratch, so tell same-named PDFs from different directories apart
+            source_hash = hashlib.sha1(dirname.encode()).hexdigest()[:8]
+            base_tgtdir = os.path.join(self.scratch_dir, f'{base_filename}_{source_hash}')
+        else:
+            base_tgtdir = os.path.join(dirname, base_filename)
         tgtdir = base_tgtdir
 
 
@@ -50,6 +55,8 @@ class Plugin(Cmd):
         # 
         if self.skip:
             pass  # Use the existing path on disk
+        elif self.incremental and self._is_same_pdf(abspath, os.path.join(tgtdir, filename)):
+            logger.info(f'Reusing work directory {tgtdir}')
         else:
             # Go to a new directory
             tgtdir = new_tgtdir
@@ -65,3 +72,6 @@ class Plugin(Cmd):
         logging.info(f'Using {tgtdir} as work directory')
         await self.add_message(f'{base_filename} being processed')
         return item_list
+
+    def _is_same_pdf(self, filename, copied_filename):
+        return os.path.isfile(copied_filename) and filecmp.cmp(filename, copied_filename, shallow=False)
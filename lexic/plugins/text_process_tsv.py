@@ -15,6 +15,8 @@ class Plugin(Cmd):
     desc = 'Process output of tesseract tsv file into text'
     stage = 'text_process'
     inputs_from = ['ocr']
+    per_page = True
+    in_memory = True
 
     options = []
 
@@ -27,45 +29,54 @@ class Plugin(Cmd):
         next_items = ItemList()
         with item_list as items:
             for item in self.iterate_with_progress(items):
-                logger.debug(f'Processing tsv {item}')
-                next_file = self._change_ext(item, 'loc')
-
-                if not self.skip:
-                    with open(item, 'r', encoding='utf8') as f:
-                        tsv_contents = f.readlines()
-                    text_locations = await self.process_tsv(tsv_contents)
-                    logger.debug(text_locations)
-                    # Create a file to store each text in a separate file with yaml
-                    with open(next_file, 'w') as loc_file:
-                        yaml.dump(text_locations, loc_file)
+                next_file = await self.run_page(None, item)
                 next_items.append(next_file)
         return next_items
+
+    async def run_page(self, page, item):
+        if item.endswith('.loc'):
+            return item     # Already text locations (e.g. from ocr_libtesseract)
+        logger.debug(f'Processing tsv {item}')
+        next_file = self._change_ext(item, 'loc')
+
+        if not self.skip:
+            tsv = await self.read_page_file(item)
+            tsv_contents = tsv.decode('utf8').splitlines(keepends=True)
+            text_locations = await self.process_tsv(tsv_contents)
+            logger.debug(text_locations)
+            # Create a file to store each text in a separate file with yaml
+            await self.write_page_file(next_file, yaml.dump(text_locations).encode('utf-8'))
+        return next_file
                 
     async def process_tsv(self, tsv):
+        """ Return the text of each word in the lines of a tesseract tsv, by its location
         """
-        """
-        
-        # 
-        text_locations = {}  # (Xl, Yl, Xr, Yr) => text
-        header = tsv[0].strip().split('\t')
-        indices = { k:i for i,k in enumerate(header) }
-        # level, page_num, block_num, par_num, line_num, word_num, left, top, width, height, conf, text
-
-        for line in tsv[1:]:
-            line = line.strip()
-            fields = line.split('\t')
-            confidence = int(fields[indices['conf']])
-            try: 
-                if confidence > 0:
-                    col_names = ['block_num', 'par_num', 'line_num', 'word_num', 'left', 'top', 'width', 'height']
-                    field_values = [int(fields[indices[col_name]]) for col_name in col_names]
-                    text = fields[indices['text']]
-                    text_locations[ tuple(field_values) ] = text
-            except IndexError:
-                logger.debug('Cannot parse line in tsv: ')
-                logger.debug(line)
-
+        text_locations = {}  # (block_num, par_num, line_num, word_num, left, top, width, height) => text
+        for confidence, location, text in tsv_words(tsv):
+            text_locations[location] = text
         return text_locations
 
 
+def tsv_words(tsv):
+    """ Yield the confidence, location and text of each word tesseract found, from the lines
+        of its tsv (the location is its block_num, par_num, line_num, word_num, left, top,
+        width and height)
+    """
+    header = tsv[0].strip().split('\t')
+    indices = { k:i for i,k in enumerate(header) }
+    # level, page_num, block_num, par_num, line_num, word_num, left, top, width, height, conf, text
+    col_names = ['block_num', 'par_num', 'line_num', 'word_num', 'left', 'top', 'width', 'height']
 
+    for line in tsv[1:]:
+        line = line.strip()
+        fields = line.split('\t')
+        # Tesseract 5 writes the confidence with decimals
+        confidence = float(fields[indices['conf']])
+        try:
+            if confidence > 0:
+                field_values = [int(fields[indices[col_name]]) for col_name in col_names]
+                text = fields[indices['text']]
+                yield confidence, tuple(field_values), text
+        except IndexError:
+            logger.debug('Cannot parse line in tsv: ')
+            logger.debug(line)
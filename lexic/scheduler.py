@@ -0,0 +1,141 @@
+import logging
+
+import curio
+import psutil
+
+logger = logging.getLogger(__name__)
+
+"""
+    Decide when each queued task is allowed to start
+"""
+
+class Scheduler:
+    """
+        Shared by all the plugins to limit how many tasks run at once.
+
+        - Keeps up to n_slots tasks running as a sliding window, so a new task
+          starts as soon as any running one finishes
+        - Each tool (e.g. gs, tesseract) can have its own, lower limit
+        - Before starting another task while some are already running, waits
+          until cpu usage and available memory are within max_cpu and min_mem
+
+        Tools in unlimited_tools (remote OCR) don't use local resources, so they
+        only count against their own tool limit, if one is given.
+
+        It also shares a budget of cpu_budget threads out between the commands it
+        runs, so that multi-threaded tools (tesseract's OpenMP) only use several
+        threads each when there are fewer tasks than cpus, and one each otherwise.
+    """
+
+    POLL_INTERVAL = 0.25   # seconds between resource checks
+    unlimited_tools = ['remote']
+
+    def __init__(self, n_slots=1, tool_limits=None, max_cpu=None, min_mem=None, cpu_budget=None):
+        self.n_slots = n_slots
+        self.tool_limits = dict(tool_limits or {})
+        self.max_cpu = max_cpu   # percent
+        self.min_mem = min_mem   # MB
+        self.cpu_budget = cpu_budget   # threads; None to leave the tools to decide
+        self.running = 0
+        self.waiting = 0
+        self.threads_in_use = 0
+        self.slots = curio.Semaphore(n_slots)
+        self.tool_slots = {tool: curio.Semaphore(limit) for tool, limit in self.tool_limits.items()}
+
+    @staticmethod
+    def parse_tool_limits(spec):
+        """ Turn a string like 'gs:2,tesseract:8' into {'gs': 2, 'tesseract': 8}
+        """
+        limits = {}
+        if not spec:
+            return limits
+        for entry in spec.split(','):
+            tool, limit = entry.split(':')
+            limits[tool.strip()] = int(limit)
+        return limits
+
+    async def acquire(self, tool):
+        # Take the tool slot first, so a task waiting on its tool doesn't hold
+        # up a slot that another tool could use
+        if tool in self.tool_slots:
+            await self.tool_slots[tool].acquire()
+        if tool not in self.unlimited_tools:
+            self.waiting += 1
+            try:
+                await self.slots.acquire()
+                await self._wait_for_headroom()
+            finally:
+                self.waiting -= 1
+            self.running += 1
+            # Let any tasks spawned along with this one queue up too, so the thread
+            # budget is shared out between all of them from the start
+            await curio.sleep(0)
+
+    async def release(self, tool):
+        if tool not in self.unlimited_tools:
+            self.running -= 1
+            await self.slots.release()
+        if tool in self.tool_slots:
+            await self.tool_slots[tool].release()
+
+    def take_threads(self):
+        """ Hand out threads for a command about to start: an even share of the budget
+            between the tasks running or waiting to run, and no more than is left over.
+            Give them back with return_threads.  Returns None if there's no budget.
+        """
+        if not self.cpu_budget:
+            return None
+        share = self.cpu_budget // max(1, self.running + self.waiting)
+        threads = max(1, min(share, self.cpu_budget - self.threads_in_use))
+        self.threads_in_use += threads
+        return threads
+
+    def return_threads(self, threads):
+        if threads:
+            self.threads_in_use -= threads
+
+    async def _wait_for_headroom(self):
+        # Always let a task start if nothing else is running, otherwise we could wait forever
+        while self.running > 0 and not self._has_headroom():
+            await curio.sleep(self.POLL_INTERVAL)
+
+    def _has_headroom(self):
+        if self.max_cpu is not None and psutil.cpu_percent() > self.max_cpu:
+            logger.debug(f'Waiting for cpu usage to drop below {self.max_cpu}%')
+            return False
+        if self.min_mem is not None and psutil.virtual_memory().available < self.min_mem * 2**20:
+            logger.debug(f'Waiting for at least {self.min_mem}MB of free memory')
+            return False
+        return True
+
+
+class AdaptiveLimit:
+    """
+        Limits how many requests to a remote service are in flight at once, and adapts
+        the limit to what the service keeps up with: it grows by one for every limit's
+        worth of requests that succeed, and halves whenever one fails (additive increase,
+        multiplicative decrease, the way TCP sizes its window).  It stays between 1 and
+        max_limit.
+    """
+
+    def __init__(self, max_limit, initial=4):
+        self.max_limit = max_limit
+        self.limit = float(max(1, min(initial, max_limit)))
+        self.in_flight = 0
+        self.changed = curio.Condition()
+
+    async def acquire(self):
+        async with self.changed:
+            while self.in_flight >= int(self.limit):
+                await self.changed.wait()
+            self.in_flight += 1
+
+    async def release(self, succeeded):
+        async with self.changed:
+            self.in_flight -= 1
+            if succeeded:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            else:
+                self.limit = max(1.0, self.limit / 2)
+                logger.debug(f'Remote request failed, limiting to {int(self.limit)} at once')
+            await self.changed.notify_all()
@@ -0,0 +1,65 @@
+import logging, os, time, json
+
+import curio
+
+logger = logging.getLogger(__name__)
+
+"""
+    Record what every task and command did, for viewing in chrome://tracing or Perfetto
+"""
+
+class Tracer:
+    """
+        Collects spans (a name, a start and end time, and some details like page number,
+        stage and exit code) and saves them in the Chrome trace event format.
+
+        Each span is put on a lane (a 'thread' in the trace viewer) that no other span is
+        using at the time, so concurrent tasks show up side by side.  The commands run by a
+        task go on the task's own lane, nested under it.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.start = time.perf_counter()
+        self.pid = os.getpid()
+        self.busy_lanes = set()
+        self.n_lanes = 0
+
+    def now(self):
+        return time.perf_counter()
+
+    def take_lane(self):
+        lane = 1
+        while lane in self.busy_lanes:
+            lane += 1
+        self.busy_lanes.add(lane)
+        self.n_lanes = max(self.n_lanes, lane)
+        return lane
+
+    def free_lane(self, lane):
+        self.busy_lanes.discard(lane)
+
+    def add_span(self, name, category, start, end, lane, **details):
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (start - self.start) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': self.pid,
+            'tid': lane,
+            'args': {k: v for k, v in details.items() if v is not None},
+        })
+
+    def save(self, filename):
+        lane_names = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': lane, 'args': {'name': f'lane {lane}'}}
+                      for lane in range(1, self.n_lanes + 1)]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': lane_names + self.events, 'displayTimeUnit': 'ms'}, f)
+        logger.info(f'Saved {len(self.events)} trace events to {filename}')
+
+
+async def current_span():
+    """ Details of the span the current curio task is running in, if any
+    """
+    return getattr(await curio.current_task(), 'trace_span', None)
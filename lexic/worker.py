@@ -0,0 +1,347 @@
+"""
+Serve OCR requests from other lexic runs (with --ocr_tesseract-aws) on this machine
+
+Usage:
+    lexic worker [options]
+    lexic worker -h
+
+Options:
+    -h --help               show this message
+    -v --verbose            show more information
+    --host=HOST             address to listen on (there's no authentication, so only open it up on a trusted network) [default: 127.0.0.1]
+    --port=PORT             port to listen on [default: 8080]
+    --threads=THREADS       number of commands to run at the same time [default: max]
+    --storage=DIR           directory to keep uploaded files in until they're ocr'ed (a temporary one by default)
+    --allow=PROGRAMS        programs the clients may run [default: tesseract]
+
+"""
+import sys, os, re, logging, json, uuid, shlex, shutil, tempfile, base64, subprocess, signal, time, threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from email.parser import BytesParser
+from email.policy import HTTP
+
+from docopt import docopt
+import psutil
+
+from .version import __version__
+from .command import THREAD_LIMIT_VARS
+
+logger = logging.getLogger(__name__)
+
+# A file in the request's directory: no paths, options or settings
+PLAIN_NAME = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.+-]*$')
+# The tesseract options clients send (see ocr_tesseract and orient_tesseract), and what their values look like
+TESSERACT_OPTIONS = {'--psm': re.compile(r'^\d+$'), '--oem': re.compile(r'^\d+$'), '--dpi': re.compile(r'^\d+$'),
+                     '-l': re.compile(r'^[A-Za-z0-9_+]+$')}
+TESSERACT_CONFIGS = ['tsv', 'hocr', 'txt']
+
+"""
+    The server side of the remote OCR protocol used by Cmd.run_command_aws, with a local
+    directory in place of S3:
+
+        GET  /geturl    returns {'url': ..., 'fields': {'key': ...}} to upload one file to,
+                        as a multipart POST of the fields plus the file
+        POST /ocr       runs {'cmd': ..., 'input_files': [[key, name], ...], 'output_files': [name, ...]}
+                        and returns {'message': ..., 'output_files': {name: base64 contents}}
+
+    'cmd' can also be a list of commands (e.g. one per page), which are run side by side.
+    The uploads are kept until a request using them succeeds, so a failed one can be retried.
+    With 'stream_outputs': true in the request, the response has 'output_urls' instead of
+    'output_files', each file to be fetched from GET /download/<key>, and then let go of with
+    DELETE /download/<key>.  Files nobody fetches or lets go of are removed after a while.
+"""
+
+class Worker:
+    """
+        Keeps the uploaded files and runs the commands for each /ocr request in a pool
+        of threads, each command in a scratch directory of its own request.
+    """
+
+    UPLOAD_TTL = 3600       # Seconds to keep an upload that no request has used
+    DOWNLOAD_TTL = 600      # Seconds to keep an output that hasn't been let go of
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, storage_dir, n_threads, allowed_programs):
+        self.storage_dir = storage_dir
+        self.upload_dir = os.path.join(storage_dir, 'uploads')
+        self.download_dir = os.path.join(storage_dir, 'downloads')
+        os.makedirs(self.upload_dir, exist_ok=True)
+        os.makedirs(self.download_dir, exist_ok=True)
+        self.allowed_programs = set(allowed_programs)
+        self.pool = ThreadPoolExecutor(max_workers=n_threads)
+        self.env = dict(os.environ)
+        for var in THREAD_LIMIT_VARS:
+            self.env.setdefault(var, '1')   # The pool runs the commands in parallel instead
+        self.sweep()    # Left over from the last time, with --storage
+
+    def sweep(self, now=None):
+        """ Remove the uploads and outputs that have been waiting longer than their TTL
+        """
+        now = now or time.time()
+        for directory, ttl in [(self.upload_dir, self.UPLOAD_TTL), (self.download_dir, self.DOWNLOAD_TTL)]:
+            for name in os.listdir(directory):
+                filename = os.path.join(directory, name)
+                try:
+                    if now - os.path.getmtime(filename) > ttl:
+                        logger.debug(f'Removing stale {filename}')
+                        os.remove(filename)
+                except FileNotFoundError:
+                    pass    # Fetched and let go of in the meantime
+
+    def sweep_forever(self):
+        while True:
+            time.sleep(self.SWEEP_INTERVAL)
+            self.sweep()
+
+    def new_upload(self, base_url):
+        key = uuid.uuid4().hex
+        return {'url': f'{base_url}/upload', 'fields': {'key': key}}
+
+    def store_upload(self, key, contents):
+        with open(self._upload_path(key), 'wb') as f:
+            f.write(contents)
+
+    def _upload_path(self, key):
+        if not isinstance(key, str) or not key.isalnum():
+            raise ValueError(f'Bad upload key {key!r}')
+        return os.path.join(self.upload_dir, key)
+
+    def _link_upload(self, key, filename):
+        """ Put an upload into a job's directory, leaving the original for a retry
+        """
+        try:
+            os.link(self._upload_path(key), filename)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            shutil.copyfile(self._upload_path(key), filename)    # Can't hard link here
+
+    def _remove_upload(self, key):
+        try:
+            os.remove(self._upload_path(key))
+        except FileNotFoundError:
+            pass    # Used by another request with the same files at the same time
+
+    def download_path(self, key):
+        if not key.isalnum():
+            raise ValueError(f'Bad download key {key!r}')
+        return os.path.join(self.download_dir, key)
+
+    def run(self, request, base_url):
+        """ Run the commands in request on its uploaded files, and return the output files
+        """
+        if not isinstance(request, dict):
+            raise ValueError('Expected a JSON object')
+        cmds = request['cmd']
+        if isinstance(cmds, str):
+            cmds = [cmds]
+        input_files = request.get('input_files', [])
+        output_names = request.get('output_files', [])
+        if not (isinstance(cmds, list) and all(isinstance(cmd, str) for cmd in cmds)
+                and isinstance(input_files, list) and all(isinstance(f, list) and len(f) == 2 for f in input_files)
+                and isinstance(output_names, list)):
+            raise ValueError('Expected cmd, input_files and output_files to be a command or a list of them, '
+                             'a list of [key, name] pairs and a list of names')
+        for name in [name for _, name in input_files] + output_names:
+            self._check_name(name)
+        argvs = [self._parse(cmd, [name for _, name in input_files]) for cmd in cmds]
+
+        job_dir = tempfile.mkdtemp(dir=self.storage_dir, prefix='job')
+        try:
+            for key, name in input_files:
+                self._link_upload(key, os.path.join(job_dir, name))
+            results = list(self.pool.map(lambda argv: self._run_one(argv, job_dir), argvs))
+            failed = [(argv, returncode, output) for argv, (returncode, output) in zip(argvs, results) if returncode != 0]
+            if failed:
+                argv, returncode, output = failed[0]
+                raise RuntimeError(f'{" ".join(argv)} exited with {returncode}: {output}')
+            message = '\n'.join(output for _, output in results)
+            # Only now are the uploads used up; until then the client can retry with the same keys
+            for key, _ in input_files:
+                self._remove_upload(key)
+            if request.get('stream_outputs'):
+                output_urls = {}
+                for name in output_names:
+                    key = uuid.uuid4().hex
+                    os.replace(os.path.join(job_dir, name), self.download_path(key))
+                    os.utime(self.download_path(key))   # Its TTL starts now
+                    output_urls[name] = f'{base_url}/download/{key}'
+                return {'message': message, 'output_urls': output_urls}
+            output_files = {}
+            for name in output_names:
+                with open(os.path.join(job_dir, name), 'rb') as f:
+                    output_files[name] = base64.b64encode(f.read()).decode('ascii')
+            return {'message': message, 'output_files': output_files}
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+    def _run_one(self, argv, job_dir):
+        logger.debug(f'Running {argv} in {job_dir}')
+        proc = subprocess.run(argv, cwd=job_dir, env=self.env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return proc.returncode, proc.stdout.decode('utf-8', 'replace')
+
+    def _parse(self, cmd, input_names):
+        """ Split a command from a client into arguments, only allowing the programs we were
+            told to, with just the arguments lexic sends them, so a client can't point them
+            at anything outside of the request's directory
+        """
+        argv = shlex.split(cmd)
+        if not argv:
+            raise ValueError('Empty command')
+        # The client sends its own path to the program, so look it up on ours instead
+        program = os.path.basename(argv[0])
+        if program not in self.allowed_programs:
+            raise PermissionError(f'{program} is not one of the programs this worker runs')
+        if program == 'tesseract':
+            self._check_tesseract_args(argv[1:], input_names)
+        else:
+            # Other programs only get the names of files in the request's directory
+            for arg in argv[1:]:
+                self._check_plain_name(arg)
+        return [shutil.which(program) or program] + argv[1:]
+
+    def _check_tesseract_args(self, args, input_names):
+        """ Only allow tesseract INPUT OUTPUTBASE followed by the options and configs in
+            TESSERACT_OPTIONS and TESSERACT_CONFIGS (so no -c, --tessdata-dir, --user-words, ...)
+        """
+        if len(args) < 2:
+            raise PermissionError('Tesseract needs an input file and an output name')
+        image, output_base = args[:2]
+        if image not in input_names:
+            raise PermissionError(f'{image} is not one of the uploaded files')
+        self._check_plain_name(output_base)
+        i = 2
+        while i < len(args):
+            arg = args[i]
+            if arg in TESSERACT_OPTIONS:
+                if i + 1 == len(args) or not TESSERACT_OPTIONS[arg].match(args[i+1]):
+                    raise PermissionError(f'Bad value for tesseract option {arg}')
+                i += 2
+            elif arg in TESSERACT_CONFIGS:
+                i += 1
+            else:
+                raise PermissionError(f'Tesseract argument {arg} is not allowed')
+
+    def _check_plain_name(self, arg):
+        if not PLAIN_NAME.match(arg):
+            raise PermissionError(f'Argument {arg} is not a plain filename in the working directory')
+
+    def _check_name(self, name):
+        if not isinstance(name, str) or os.path.basename(name) != name or name in ('', '.', '..'):
+            raise PermissionError(f'{name} is not a plain filename')
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    server_version = f'lexic-worker/{__version__}'
+    worker = None   # Set by serve()
+
+    def do_GET(self):
+        try:
+            if self.path.rstrip('/') == '/geturl':
+                self._send_json(200, self.worker.new_upload(self._base_url()))
+            elif self.path.startswith('/download/'):
+                self._send_file(self.worker.download_path(self.path[len('/download/'):]))
+            else:
+                self._send_json(404, {'message': f'No such endpoint {self.path}'})
+        except (ValueError, FileNotFoundError) as e:
+            self._send_json(404, {'message': str(e)})
+
+    def _base_url(self):
+        host = self.headers.get('Host') or f'{self.server.server_address[0]}:{self.server.server_address[1]}'
+        return f'http://{host}'
+
+    def _send_file(self, filename):
+        """ Stream a file from the download directory.  It's kept (until the client lets go
+            of it, or its TTL is up) so a failed download can be retried.
+        """
+        with open(filename, 'rb') as f:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_DELETE(self):
+        try:
+            if self.path.startswith('/download/'):
+                os.remove(self.worker.download_path(self.path[len('/download/'):]))
+                self._send_json(204, None)
+            else:
+                self._send_json(404, {'message': f'No such endpoint {self.path}'})
+        except (ValueError, FileNotFoundError) as e:
+            self._send_json(404, {'message': str(e)})
+
+    def do_POST(self):
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path.rstrip('/') == '/upload':
+                fields = self._parse_multipart(body)
+                self.worker.store_upload(fields['key'].decode('utf-8'), fields['file'])
+                self._send_json(204, None)
+            elif self.path.rstrip('/') == '/ocr':
+                self._send_json(200, self.worker.run(json.loads(body), self._base_url()))
+            else:
+                self._send_json(404, {'message': f'No such endpoint {self.path}'})
+        except (PermissionError, ValueError, KeyError, FileNotFoundError) as e:
+            logger.info(f'Bad request to {self.path}: {e}')
+            self._send_json(400, {'message': str(e)})
+        except RuntimeError as e:
+            logger.info(str(e))
+            self._send_json(500, {'message': str(e)})
+
+    def _parse_multipart(self, body):
+        """ Return the fields of a multipart/form-data body as name => bytes
+        """
+        header = f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode('utf-8')
+        message = BytesParser(policy=HTTP).parsebytes(header + body)
+        if not message.is_multipart():
+            raise ValueError('Expected a multipart/form-data upload')
+        return {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                for part in message.iter_parts()}
+
+    def _send_json(self, status, response):
+        body = b'' if response is None else json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        if response is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f'{self.address_string()} {format % args}')
+
+
+def serve(host, port, worker):
+    RequestHandler.worker = worker
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=worker.sweep_forever, daemon=True).start()
+    # Clean up when stopped by a service manager as well as with ctrl-c
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f'lexic worker listening on http://{host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        worker.pool.shutdown()
+
+
+def main(argv):
+    args = docopt(__doc__, argv=['worker'] + argv, version=__version__)
+    logging.basicConfig(level=logging.DEBUG if args['--verbose'] else logging.WARNING, format='%(message)s')
+    n_threads = psutil.cpu_count() if args['--threads'] == 'max' else int(args['--threads'])
+    allowed = [program.strip() for program in args['--allow'].split(',') if program.strip()]
+    storage_dir = args['--storage']
+    temporary = storage_dir is None
+    if temporary:
+        storage_dir = tempfile.mkdtemp(prefix='lexic_worker')
+    try:
+        serve(args['--host'], int(args['--port']), Worker(storage_dir, n_threads, allowed))
+    finally:
+        if temporary:
+            shutil.rmtree(storage_dir, ignore_errors=True)
@@ -0,0 +1,59 @@
+from lexic.cache import OcrCache
+import pytest
+import os
+import time
+
+
+class TestOcrCache:
+
+    @pytest.fixture(autouse=True)
+    def cache(self, tmp_path):
+        self.tmp_path = tmp_path
+        # Room for three 100 byte entries
+        self.cache = OcrCache(str(tmp_path / 'cache'), 350 / 2**20)
+
+    def write(self, name, contents):
+        filename = str(self.tmp_path / name)
+        with open(filename, 'w') as f:
+            f.write(contents)
+        return filename
+
+    def put(self, key, size=100):
+        self.cache.put(key, 'tsv', self.write('src.tsv', 'x' * size))
+
+    def test_get_after_put(self):
+        image = self.write('page.png', 'pixels')
+        key = self.cache.key(image, '4.1', '--psm 1 tsv')
+        assert key != self.cache.key(image, '4.1', '--psm 3 tsv')
+        dest = str(self.tmp_path / 'page.tsv')
+        assert not self.cache.get(key, 'tsv', dest)
+        self.cache.put(key, 'tsv', self.write('out.tsv', 'words'))
+        assert self.cache.get(key, 'tsv', dest)
+        with open(dest) as f:
+            assert f.read() == 'words'
+
+    def test_evicts_least_recently_used(self):
+        for i, key in enumerate(['aa1', 'bb2', 'cc3']):
+            self.put(key)
+            # Entries a second apart, so the order doesn't hang on the file system's timestamps
+            past = time.time() - 10 + i
+            os.utime(self.cache._entry_path(key, 'tsv'), (past, past))
+        assert self.cache.get('aa1', 'tsv', str(self.tmp_path / 'hit.tsv'))
+        self.put('dd4')
+        assert not self.cache._entry_path('bb2', 'tsv').exists()
+        assert self.cache._entry_path('aa1', 'tsv').exists()
+        assert self.cache._entry_path('dd4', 'tsv').exists()
+
+    def test_overwriting_an_entry_counts_it_once(self):
+        self.put('aa1')
+        self.put('aa1', 150)
+        assert self.cache.size == 150
+        self.put('bb2')
+        self.put('bb2')
+        assert self.cache._entry_path('aa1', 'tsv').exists()
+        assert self.cache.size == 250
+
+    def test_size_from_existing_entries(self):
+        self.put('aa1')
+        self.put('bb2')
+        assert OcrCache(str(self.tmp_path / 'cache'), 1).size == 200
@@ -0,0 +1,41 @@
+import lexic.command as C
+import pytest
+
+
+class Plugin(C.Cmd):
+
+    name = 'test'
+
+
+class TestCommand:
+
+    @pytest.fixture(autouse=True)
+    def plugin(self, monkeypatch):
+        monkeypatch.setattr(C.Cmd, 'max_dpi', None)
+        monkeypatch.setattr(C.Cmd, 'target_dpi', None)
+        self.plugin = Plugin({'program': 'true'})
+
+    @pytest.mark.parametrize('max_dpi, target_dpi, scanned, expected', [
+        (None, None, (600, 600), (600, 600)),
+        (300, None, (600, 600), (300, 300)),
+        (300, None, (200, 200), (200, 200)),    # Never scaled up to --max_dpi
+        (300, None, (600, 400), (300, 200)),    # Both directions by the same factor
+        (None, 150, (300, 300), (150, 150)),
+        (None, 400, (200, 100), (400, 200)),    # --target_dpi scales up too
+        (100, 400, (200, 200), (400, 400)),     # and wins over --max_dpi
+        (1, None, (600, 30), (1, 1)),           # Never below 1
+    ])
+    def test_render_dpi(self, monkeypatch, max_dpi, target_dpi, scanned, expected):
+        monkeypatch.setattr(C.Cmd, 'max_dpi', max_dpi)
+        monkeypatch.setattr(C.Cmd, 'target_dpi', target_dpi)
+        assert self.plugin.render_dpi(*scanned) == expected
+
+    @pytest.mark.parametrize('filename, page', [
+        ('doc_3.png', 3), ('/work/doc_12.pre.png', 12), ('page_4.blank', 4), ('doc.pdf', None),
+    ])
+    def test_page_of(self, filename, page):
+        assert self.plugin._page_of(filename) == page
+
+    @pytest.mark.parametrize('status, code', [(0, 0), (3 << 8, 3), (9, -9)])
+    def test_exit_code(self, status, code):
+        assert C.Cmd._exit_code(status) == code
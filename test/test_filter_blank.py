@@ -0,0 +1,57 @@
+from lexic.plugins.filter_blank import Plugin, ink_coverage
+import pytest
+import curio
+
+
+class TestFilterBlank:
+
+    @pytest.fixture(autouse=True)
+    def plugin(self, tmp_path):
+        self.work_dir = tmp_path
+        self.plugin = Plugin({'coverage': '0.05', 'drop': False})
+
+    def page(self, page, ink=(), paper=245):
+        """ Write a page image with black boxes (left, top, right, bottom as fractions of the page) on it
+        """
+        from PIL import Image, ImageDraw
+
+        image = Image.new('L', (1000, 1400), paper)
+        draw = ImageDraw.Draw(image)
+        for left, top, right, bottom in ink:
+            draw.rectangle((left * 1000, top * 1400, right * 1000, bottom * 1400), fill=0)
+        filename = str(self.work_dir / f'doc_{page}.png')
+        image.save(filename)
+        return filename
+
+    def check(self, item):
+        curio.run(self.plugin.check_page, item)
+        return (self.work_dir / f'page_{self.plugin._page_of(item)}.blank').read_text()
+
+    def test_empty_page(self):
+        assert ink_coverage(self.page(1)) == 0.0
+        assert self.check(self.page(1)) == 'keep'
+
+    def test_page_with_text(self):
+        item = self.page(1, ink=[(0.1, 0.1, 0.9, 0.15), (0.1, 0.2, 0.6, 0.25)])
+        assert ink_coverage(item) > 5
+        assert self.check(item) == ''
+
+    def test_specks_and_dark_borders_are_blank(self):
+        item = self.page(1, ink=[(0.5, 0.5, 0.502, 0.5015), (0, 0, 0.03, 1), (0, 0.98, 1, 1)])
+        assert ink_coverage(item) < 0.05
+        assert self.check(item) == 'keep'
+
+    def test_dark_paper(self):
+        # The paper is whatever shade most of the page is, so gray paper isn't ink
+        assert ink_coverage(self.page(1, paper=128)) == 0.0
+
+    def test_drop(self):
+        self.plugin.config['drop'] = True
+        assert self.check(self.page(1)) == 'drop'
+
+    def test_pages_with_text_marker_are_not_blank(self):
+        (self.work_dir / 'page_1.text').write_text('keep')
+        # Not rendered, so only a placeholder
+        item = str(self.work_dir / 'doc_1.png')
+        open(item, 'w').close()
+        assert self.check(item) == ''
@@ -0,0 +1,52 @@
+from lexic.fingerprint import Fingerprints
+import pytest
+import os
+
+
+class TestFingerprints:
+
+    @pytest.fixture(autouse=True)
+    def work_dir(self, tmp_path):
+        self.work_dir = tmp_path
+        self.fingerprints = Fingerprints(str(tmp_path))
+        self.input = self.write('doc_1.png', 'page one')
+        self.output = self.write('doc_1.tsv', 'words')
+
+    def write(self, name, contents):
+        filename = str(self.work_dir / name)
+        with open(filename, 'w') as f:
+            f.write(contents)
+        return filename
+
+    def fingerprint(self, config=None, version='1.0', inputs=None):
+        return self.fingerprints.fingerprint('ocr', config or {'psm': 1}, version, inputs or [self.input])
+
+    def test_current_until_something_changes(self):
+        fingerprint = self.fingerprint()
+        assert not self.fingerprints.is_current(self.output, fingerprint)
+        self.fingerprints.record(self.output, fingerprint, [self.output])
+        assert self.fingerprints.is_current(self.output, self.fingerprint())
+        assert not self.fingerprints.is_current(self.output, self.fingerprint(config={'psm': 3}))
+        assert not self.fingerprints.is_current(self.output, self.fingerprint(version='2.0'))
+        self.write('doc_1.png', 'page one, rescanned')
+        assert not self.fingerprints.is_current(self.output, self.fingerprint())
+
+    def test_not_current_once_an_output_is_gone(self):
+        other_output = self.write('doc_1.loc', 'locations')
+        self.fingerprints.record(self.output, self.fingerprint(), [self.output, other_output])
+        os.remove(other_output)
+        assert not self.fingerprints.is_current(self.output, self.fingerprint())
+
+    def test_values_and_lists_are_inputs_too(self):
+        assert self.fingerprint(inputs=[self.input, 1]) != self.fingerprint(inputs=[self.input, 2])
+        assert self.fingerprint(inputs=[[self.input, 1]]) != self.fingerprint(inputs=[[self.input], 1])
+        assert self.fingerprint(inputs=[{'page_1.blank': ''}]) != self.fingerprint(inputs=[{'page_1.blank': 'keep'}])
+
+    def test_records_survive_a_rerun(self):
+        self.fingerprints.record(self.output, self.fingerprint(), [self.output])
+        # A partly written line, as left by a crash
+        with open(self.fingerprints.filename, 'a') as f:
+            f.write('{"key": "doc_2.tsv", "finger')
+        fingerprints = Fingerprints(str(self.work_dir))
+        assert fingerprints.is_current(self.output, self.fingerprint())
+        assert fingerprints.outputs(self.output) == [os.path.abspath(self.output)]
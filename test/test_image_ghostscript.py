@@ -0,0 +1,49 @@
+import lexic.command as C
+from lexic.plugins.image_ghostscript import Plugin, split_pngs
+import pytest
+import io
+
+
+class TestImageGhostscript:
+
+    @pytest.fixture(autouse=True)
+    def plugin(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(C.Cmd, 'N_THREADS', 1)
+        self.work_dir = tmp_path
+        self.filename = str(tmp_path / 'doc')
+        self.plugin = Plugin({'program': 'gs', 'device': 'auto'})
+        self.plugin.colors = {}
+
+    def ranges(self, resolutions):
+        return self.plugin._page_ranges(self.filename, sorted(resolutions), resolutions)
+
+    def test_consecutive_pages_at_the_same_resolution(self):
+        resolutions = {1: [300, 300], 2: [300, 300], 3: [200, 200], 4: [300, 300], 6: [300, 300]}
+        assert self.ranges(resolutions) == [(1, 2, 300, 300), (3, 3, 200, 200), (4, 4, 300, 300), (6, 6, 300, 300)]
+
+    def test_a_share_of_the_pages_per_thread(self, monkeypatch):
+        monkeypatch.setattr(C.Cmd, 'N_THREADS', 3)
+        resolutions = {page: [300, 300] for page in range(1, 8)}
+        assert [(first, last) for first, last, _, _ in self.ranges(resolutions)] == [(1, 3), (4, 6), (7, 7)]
+
+    def test_pages_with_text_on_their_own(self):
+        (self.work_dir / 'page_2.text').write_text('keep')
+        resolutions = {page: [300, 300] for page in range(1, 5)}
+        assert [(first, last) for first, last, _, _ in self.ranges(resolutions)] == [(1, 1), (2, 2), (3, 4)]
+
+    def test_one_device_per_range(self):
+        self.plugin.colors = {1: 'mono', 2: 'mono', 3: 'gray'}
+        resolutions = {page: [300, 300] for page in range(1, 4)}
+        assert [(first, last) for first, last, _, _ in self.ranges(resolutions)] == [(1, 2), (3, 3)]
+        assert [self.plugin.page_device(page) for page in (1, 3)] == ['pngmono', 'pnggray']
+
+    def test_split_pngs(self):
+        from PIL import Image
+
+        pngs = []
+        for size, mode in [((10, 20), '1'), ((300, 100), 'RGB'), ((5, 5), 'L')]:
+            data = io.BytesIO()
+            Image.new(mode, size).save(data, 'PNG')
+            pngs.append(data.getvalue())
+        assert split_pngs(b''.join(pngs)) == pngs
+        assert split_pngs(b'') == []
@@ -0,0 +1,105 @@
+import lexic.command as C
+from lexic.fingerprint import Fingerprints
+from lexic.plugins.image_ghostscript import Plugin as Ghostscript
+import pytest
+import os
+import curio
+
+
+class FakeGhostscript(Ghostscript):
+    """ Writes each page's number instead of rendering it, and remembers the ranges it was asked for
+    """
+
+    def tool_version(self):
+        return ''
+
+    async def call_ghostscript_range(self, item, first, last, filename, res_x, res_y):
+        self.rendered.append((first, last))
+        for page in range(first, last + 1):
+            with open(f'{filename}_{page}.png', 'w') as f:
+                f.write('' if self.skipped_page(f'{filename}_{page}.png') else str(page))
+
+
+class FakeOcr(C.Cmd):
+
+    name = 'fake_ocr'
+
+    def tool_version(self):
+        return ''
+
+
+class TestIncremental:
+
+    @pytest.fixture(autouse=True)
+    def work_dir(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(C.Cmd, 'N_THREADS', 1)
+        self.work_dir = tmp_path
+        self.pdf = str(tmp_path / 'doc.pdf')
+        with open(self.pdf, 'w') as f:
+            f.write('pdf')
+        self.resolutions = {page: [300, 300, 2550, 3300] for page in (1, 2, 3)}
+
+    def mark(self, page, reason, action):
+        with open(self.work_dir / f'page_{page}.{reason}', 'w') as f:
+            f.write(action)
+
+    def render(self):
+        """ Run the image step over the document incrementally, and return the ranges it rendered
+        """
+        plugin = FakeGhostscript({'program': 'gs', 'device': 'auto'})
+        plugin.fingerprints = Fingerprints(str(self.work_dir))
+        plugin.colors = {}
+        plugin.rendered = []
+
+        async def run():
+            await plugin._queue_pages(self.pdf, str(self.work_dir / 'doc'), sorted(self.resolutions), self.resolutions)
+            await plugin.run_queue()
+        curio.run(run)
+        return plugin.rendered
+
+    def test_rerun_skips_rendered_pages(self):
+        assert self.render() == [(1, 3)]
+        assert self.render() == []
+
+    def test_rerun_renders_a_missing_page_of_a_range(self):
+        assert self.render() == [(1, 3)]
+        os.remove(self.work_dir / 'doc_3.png')
+        assert self.render() == [(1, 3)]
+        assert (self.work_dir / 'doc_3.png').read_text() == '3'
+
+    def test_rerun_renders_pages_that_lost_their_text_marker(self, monkeypatch):
+        # A page per gs, so the pages' tasks are the same either way
+        monkeypatch.setattr(C.Cmd, 'N_THREADS', 3)
+        self.mark(2, 'text', 'keep')
+        assert self.render() == [(1, 1), (2, 2), (3, 3)]
+        assert (self.work_dir / 'doc_2.png').read_text() == ''
+        # As with --pdfimages-force_ocr on the second run
+        self.mark(2, 'text', '')
+        assert self.render() == [(2, 2)]
+        assert (self.work_dir / 'doc_2.png').read_text() == '2'
+
+    def test_text_marker_changes_step_fingerprint(self):
+        plugin = FakeGhostscript({'program': 'gs', 'device': 'auto'})
+        plugin.fingerprints = Fingerprints(str(self.work_dir))
+        self.mark(2, 'text', 'keep')
+        before = curio.run(plugin.fingerprint, self.pdf)
+        self.mark(2, 'text', '')
+        assert curio.run(plugin.fingerprint, self.pdf) != before
+
+    def test_renders_pages_with_stale_blank_markers(self):
+        self.mark(2, 'blank', 'keep')
+        self.render()
+        assert (self.work_dir / 'doc_2.png').read_text() == '2'
+
+    def test_blank_marker_changes_fingerprint(self):
+        plugin = FakeOcr({'program': 'tesseract'})
+        plugin.fingerprints = Fingerprints(str(self.work_dir))
+        self.mark(2, 'blank', '')
+
+        async def fingerprints():
+            return [await plugin.fingerprint(self.pdf, pages=[2]), await plugin.fingerprint(self.pdf)]
+        before = curio.run(fingerprints)
+        self.mark(2, 'blank', 'drop')
+        after = curio.run(fingerprints)
+        assert before[0] != after[0]
+        assert before[1] != after[1]
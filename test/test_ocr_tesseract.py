@@ -0,0 +1,46 @@
+from lexic.plugins.ocr_tesseract import Plugin, page_confidence, TSV_HEADER
+import pytest
+
+
+def tsv_row(page_num, word_num, conf, text, level=5):
+    return f'{level}\t{page_num}\t1\t1\t1\t{word_num}\t10\t20\t30\t40\t{conf}\t{text}\n'
+
+
+class TestOcrTesseract:
+
+    @pytest.fixture(autouse=True)
+    def plugin(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.plugin = Plugin({'program': 'tesseract', 'aws': False, 'batch': False, 'cascade': False})
+
+    def write(self, name, contents):
+        filename = str(self.tmp_path / name)
+        with open(filename, 'w', encoding='utf8') as f:
+            f.write(contents)
+        return filename
+
+    def test_split_tsv(self):
+        # As tesseract writes a list of images: the rows numbered by image, and a header per image
+        combined = self.write('ocr_batch0.tsv', TSV_HEADER + tsv_row(1, 1, 90, 'one') + TSV_HEADER
+                              + tsv_row(3, 1, 80, 'three') + tsv_row(3, 2, 70, 'more'))
+        tsvs = [str(self.tmp_path / f'doc_{page}.tsv') for page in (1, 2, 3)]
+        self.plugin._split_tsv(combined, tsvs)
+        contents = [open(tsv, encoding='utf8').read() for tsv in tsvs]
+        assert contents[0] == TSV_HEADER + tsv_row(1, 1, 90, 'one')
+        assert contents[1] == TSV_HEADER    # Nothing found on it
+        assert contents[2] == TSV_HEADER + tsv_row(3, 1, 80, 'three') + tsv_row(3, 2, 70, 'more')
+
+    def test_page_confidence(self):
+        tsv = self.write('doc_1.tsv', TSV_HEADER + tsv_row(1, 0, -1, '', level=1)
+                         + tsv_row(1, 1, 90.5, 'hello') + tsv_row(1, 2, 69.5, 'world'))
+        assert page_confidence(tsv) == 80.0
+
+    @pytest.mark.parametrize('contents', ['', TSV_HEADER, TSV_HEADER + tsv_row(1, 0, -1, '', level=1)])
+    def test_no_words_no_confidence(self, contents):
+        assert page_confidence(self.write('doc_1.tsv', contents)) is None
+
+    def test_cascade_not_with_batch(self):
+        self.plugin.config.update({'cascade': True, 'batch': True})
+        with pytest.raises(SystemExit):
+            self.plugin._check_cascade('batch')
+        self.plugin._check_cascade('aws')
@@ -0,0 +1,96 @@
+from lexic.scheduler import Scheduler, AdaptiveLimit
+import pytest
+import curio
+
+
+class TestScheduler:
+
+    def run_tasks(self, scheduler, tools):
+        """ Run a task per tool through the scheduler, and return the most that ran at once, overall and by tool
+        """
+        running = {}
+        most = {}
+
+        async def task(tool):
+            await scheduler.acquire(tool)
+            try:
+                running[tool] = running.get(tool, 0) + 1
+                running['all'] = running.get('all', 0) + 1
+                for key in (tool, 'all'):
+                    most[key] = max(most.get(key, 0), running[key])
+                await curio.sleep(0.01)
+                running[tool] -= 1
+                running['all'] -= 1
+            finally:
+                await scheduler.release(tool)
+
+        async def main():
+            async with curio.TaskGroup() as g:
+                for tool in tools:
+                    await g.spawn(task, tool)
+        curio.run(main)
+        return most
+
+    def test_slots(self):
+        most = self.run_tasks(Scheduler(n_slots=2), ['gs'] * 6)
+        assert most['all'] == 2
+
+    def test_tool_limits(self):
+        most = self.run_tasks(Scheduler(n_slots=4, tool_limits={'gs': 1}), ['gs'] * 3 + ['tesseract'] * 3)
+        assert most['gs'] == 1
+        assert most['tesseract'] == 3
+
+    def test_remote_tasks_take_no_slots(self):
+        most = self.run_tasks(Scheduler(n_slots=1), ['remote'] * 4 + ['gs'] * 2)
+        assert most['remote'] == 4
+        assert most['gs'] == 1
+
+    def test_waits_for_headroom(self, monkeypatch):
+        scheduler = Scheduler(n_slots=2, max_cpu=50)
+        monkeypatch.setattr(Scheduler, 'POLL_INTERVAL', 0.001)
+        cpu = iter([100, 100, 10])
+        monkeypatch.setattr('lexic.scheduler.psutil.cpu_percent', lambda: next(cpu, 10))
+        self.run_tasks(scheduler, ['gs'] * 2)
+        # The first task always starts; the second waited until the cpu was free
+        assert next(cpu, None) is None
+
+    def test_no_headroom_check_when_idle(self, monkeypatch):
+        monkeypatch.setattr('lexic.scheduler.psutil.cpu_percent', lambda: 100)
+        assert self.run_tasks(Scheduler(n_slots=1, max_cpu=50), ['gs'])['all'] == 1
+
+    @pytest.mark.parametrize('running, waiting, in_use, expected', [
+        (1, 0, 0, 8),   # Alone, so it gets the whole budget
+        (4, 0, 0, 2),   # An even share
+        (16, 0, 0, 1),  # Never less than one
+        (2, 0, 6, 2),   # No more than is left over
+    ])
+    def test_take_threads(self, running, waiting, in_use, expected):
+        scheduler = Scheduler(cpu_budget=8)
+        scheduler.running, scheduler.waiting, scheduler.threads_in_use = running, waiting, in_use
+        assert scheduler.take_threads() == expected
+        scheduler.return_threads(expected)
+        assert scheduler.threads_in_use == in_use
+
+    def test_no_thread_budget(self):
+        assert Scheduler().take_threads() is None
+
+    def test_parse_tool_limits(self):
+        assert Scheduler.parse_tool_limits('gs:2, tesseract:8') == {'gs': 2, 'tesseract': 8}
+        assert Scheduler.parse_tool_limits(None) == {}
+
+
+class TestAdaptiveLimit:
+
+    def test_grows_and_halves(self):
+        limit = AdaptiveLimit(8, initial=4)
+
+        async def requests(n, succeeded):
+            for _ in range(n):
+                await limit.acquire()
+                await limit.release(succeeded)
+        curio.run(requests, 5, True)
+        assert int(limit.limit) == 5
+        curio.run(requests, 1, False)
+        assert int(limit.limit) == 2
+        curio.run(requests, 5, False)
+        assert limit.limit == 1.0
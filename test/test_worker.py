@@ -0,0 +1,154 @@
+import lexic.worker as W
+import pytest
+import os
+import json
+import base64
+import threading
+import uuid
+import time
+import urllib.request
+import urllib.error
+from http.server import ThreadingHTTPServer
+
+
+# Stands in for tesseract: writes the input's contents to OUTPUTBASE.tsv
+FAKE_TESSERACT = """#!/bin/sh
+[ "$2" = fail ] && exit 1
+cat "$1" > "$2.tsv"
+echo "ocr'ed $1"
+"""
+
+
+class TestWorker:
+
+    @pytest.fixture(autouse=True)
+    def server(self, tmp_path, monkeypatch):
+        bin_dir = tmp_path / 'bin'
+        bin_dir.mkdir()
+        tesseract = bin_dir / 'tesseract'
+        tesseract.write_text(FAKE_TESSERACT)
+        tesseract.chmod(0o755)
+        monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+
+        self.worker = W.Worker(str(tmp_path / 'storage'), 2, ['tesseract'])
+        W.RequestHandler.worker = self.worker
+        httpd = ThreadingHTTPServer(('127.0.0.1', 0), W.RequestHandler)
+        httpd.daemon_threads = True
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        self.url = f'http://127.0.0.1:{httpd.server_address[1]}'
+        yield
+        httpd.shutdown()
+        httpd.server_close()
+        self.worker.pool.shutdown()
+
+    def request(self, method, path, body=None, headers={}):
+        """ Return the status and body of a request to the worker
+        """
+        url = path if path.startswith('http') else f'{self.url}{path}'
+        req = urllib.request.Request(url, data=body, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(req) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def upload(self, name, contents):
+        status, body = self.request('GET', '/geturl')
+        assert status == 200
+        signed = json.loads(body)
+        boundary = uuid.uuid4().hex
+        parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode()
+                 for k, v in signed['fields'].items()]
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + contents + b'\r\n')
+        body = b''.join(parts) + f'--{boundary}--\r\n'.encode()
+        status, _ = self.request('POST', signed['url'][len(self.url):], body,
+                                 {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        assert status == 204
+        return [signed['fields']['key'], name]
+
+    def ocr(self, request):
+        status, body = self.request('POST', '/ocr', json.dumps(request).encode(), {'Content-Type': 'application/json'})
+        return status, json.loads(body)
+
+    def test_ocr_returns_base64_outputs(self):
+        uploaded = self.upload('doc_1.png', b'page one')
+        status, response = self.ocr({'cmd': '/usr/bin/tesseract doc_1.png doc_1 --psm 1 tsv',
+                                     'input_files': [uploaded], 'output_files': ['doc_1.tsv']})
+        assert status == 200
+        assert base64.b64decode(response['output_files']['doc_1.tsv']) == b'page one'
+        assert "ocr'ed doc_1.png" in response['message']
+
+    def test_ocr_runs_a_command_per_page(self):
+        uploads = [self.upload(f'doc_{page}.png', f'page {page}'.encode()) for page in (1, 2)]
+        status, response = self.ocr({'cmd': [f'tesseract doc_{page}.png doc_{page} -l eng --psm 1 tsv' for page in (1, 2)],
+                                     'input_files': uploads, 'output_files': ['doc_1.tsv', 'doc_2.tsv']})
+        assert status == 200
+        assert base64.b64decode(response['output_files']['doc_2.tsv']) == b'page 2'
+
+    def test_stream_outputs_until_released(self):
+        uploaded = self.upload('doc_1.png', b'page one')
+        status, response = self.ocr({'cmd': 'tesseract doc_1.png doc_1 --psm 1 tsv', 'input_files': [uploaded],
+                                     'output_files': ['doc_1.tsv'], 'stream_outputs': True})
+        assert status == 200
+        assert 'output_files' not in response
+        download_url = response['output_urls']['doc_1.tsv']
+        assert self.request('GET', download_url) == (200, b'page one')
+        # Still there for a retry, until the client lets go of it
+        assert self.request('GET', download_url) == (200, b'page one')
+        status, _ = self.request('DELETE', download_url)
+        assert status == 204
+        status, _ = self.request('GET', download_url)
+        assert status == 404
+
+    def test_uploads_kept_for_a_retry(self):
+        uploaded = self.upload('doc_1.png', b'page one')
+        status, _ = self.ocr({'cmd': 'tesseract doc_1.png fail --psm 1 tsv', 'input_files': [uploaded], 'output_files': []})
+        assert status == 500
+        status, response = self.ocr({'cmd': 'tesseract doc_1.png doc_1 --psm 1 tsv', 'input_files': [uploaded],
+                                     'output_files': ['doc_1.tsv']})
+        assert status == 200
+        assert base64.b64decode(response['output_files']['doc_1.tsv']) == b'page one'
+        # Used up once the request succeeds
+        assert os.listdir(self.worker.upload_dir) == []
+
+    @pytest.mark.parametrize('request_body', [[], 'x', 1, {'cmd': 1}, {'cmd': 'tesseract', 'input_files': 'x'},
+                                              {'cmd': 'tesseract', 'input_files': [[1, 2]]}])
+    def test_rejects_malformed_requests(self, request_body):
+        status, response = self.ocr(request_body)
+        assert status == 400
+
+    def test_sweep_removes_stale_files(self):
+        uploaded = self.upload('doc_1.png', b'page one')
+        status, response = self.ocr({'cmd': 'tesseract doc_1.png doc_1 --psm 1 tsv', 'input_files': [uploaded],
+                                     'output_files': ['doc_1.tsv'], 'stream_outputs': True})
+        stale = self.upload('doc_2.png', b'page two')
+        self.worker.sweep(now=time.time() + self.worker.DOWNLOAD_TTL + 1)
+        status, _ = self.request('GET', response['output_urls']['doc_1.tsv'])
+        assert status == 404
+        assert os.listdir(self.worker.upload_dir) == [stale[0]]
+        self.worker.sweep(now=time.time() + self.worker.UPLOAD_TTL + 1)
+        assert os.listdir(self.worker.upload_dir) == []
+
+    @pytest.mark.parametrize('cmd', [
+        'rm doc_1.png',
+        'tesseract doc_1.png /tmp/out --psm 1 tsv',
+        'tesseract doc_1.png ../out --psm 1 tsv',
+        'tesseract /etc/passwd out --psm 1 tsv',
+        'tesseract doc_1.png out -c debug_file=/tmp/x tsv',
+        'tesseract doc_1.png out --tessdata-dir /tmp tsv',
+        'tesseract doc_1.png out --user-words words.txt tsv',
+        'tesseract doc_1.png out --psm=/tmp/x tsv',
+        'tesseract doc_1.png out --psm 1 tsv --target-directory=/tmp',
+    ])
+    def test_rejects_unsafe_commands(self, cmd):
+        uploaded = self.upload('doc_1.png', b'page one')
+        status, response = self.ocr({'cmd': cmd, 'input_files': [uploaded], 'output_files': []})
+        assert status == 400
+
+    def test_rejects_unsafe_filenames(self):
+        uploaded = self.upload('doc_1.png', b'page one')
+        status, _ = self.ocr({'cmd': 'tesseract doc_1.png doc_1 --psm 1 tsv', 'input_files': [uploaded],
+                              'output_files': ['../doc_1.tsv']})
+        assert status == 400